@@ -1,28 +1,127 @@
 import os
+import re
 import sys
 import ast
 import pandas
 import numpy
 import json
 import math
+import itertools
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import plotly.express as px
+import dominate
+from dominate.tags import h3, p, a
+from dominate.util import raw
 # import plotly.figure_factory as ff
 from scipy.stats import gaussian_kde
 from scipy.integrate import simps
+from scipy import sparse
 
 
 # Simple implementation of a GCT parser
 # Accepts a GCT file and returns a Pandas Dataframe with a single index
-def read_gct(gct):
-    dataset = pandas.read_csv(gct, sep='\t', header=2, index_col=[
-        0, 1], skip_blank_lines=True)
-    dataset.index.names = ["Name", "Description"]
-    dataset_descriptions = dataset.index.to_frame(index=False)
-    dataset_descriptions.set_index(["Name"], inplace=True)
-    dataset.index = dataset.index.droplevel(1)  # Drop gene descriptions
-    return {'data': dataset, 'row_descriptions': dataset_descriptions["Description"].values, 'input_length': len(dataset.index)}
+def read_gct(gct, dtype=numpy.float64, engine="auto"):
+    with open(gct) as f:
+        f.readline()
+        dimensions = f.readline().split()
+    n_rows = int(dimensions[0]) if len(dimensions) > 0 and dimensions[0].isdigit() else None
+    return read_matrix(gct, skiprows=2, dtype=dtype, n_rows=n_rows, description_column=1, engine=engine)
+
+
+# Read a tab delimited matrix with feature names in the first column, with
+# or without a Description column
+def read_tsv(tsv, dtype=numpy.float64, engine="auto"):
+    return read_matrix(tsv, dtype=dtype, engine=engine)
+
+
+matrix_chunk_rows = 5000
+matrix_na_values = ['', '#N/A', 'N/A', 'NA', 'NaN', 'nan', '-nan', 'NULL', 'null']
+
+
+# Streaming reader for tab delimited expression matrices
+# The column header follows skiprows lines. The first column holds the row
+# names and description_column (by default the column named Description, in
+# any case, if there is one) holds row descriptions; every other column is parsed as dtype. The body is read in chunks of
+# matrix_chunk_rows rows (or record batches of the multi-threaded pyarrow CSV
+# reader, used by default when pyarrow is installed) straight into the value
+# array, which is preallocated when n_rows is known, so no full size text or
+# MultiIndex intermediate is ever held.
+def read_matrix(path, skiprows=0, dtype=numpy.float64, n_rows=None, description_column=None, engine="auto"):
+    with open(path) as f:
+        for _ in range(skiprows):
+            f.readline()
+        header = f.readline().rstrip('\r\n').split('\t')
+    lower = [column.lower() for column in header]
+    if description_column is None and 'description' in lower[1:]:
+        description_column = lower.index('description', 1)
+    value_columns = [column for column in range(1, len(header)) if column != description_column]
+    names = []
+    descriptions = []
+    blocks = []
+    values = numpy.empty((n_rows, len(value_columns)), dtype=dtype) if n_rows is not None else None
+    row = 0
+    for chunk_names, chunk_descriptions, chunk_values in _matrix_chunks(path, skiprows + 1, len(header), description_column, value_columns, dtype, engine):
+        names.append(chunk_names)
+        if description_column is not None:
+            descriptions.append(chunk_descriptions)
+        if values is not None and row + len(chunk_values) <= n_rows:
+            values[row:row + len(chunk_values)] = chunk_values
+        else:  # Row count unknown or wrong in the header, keep the chunks instead
+            if values is not None:
+                blocks.append(values[0:row])
+                values = None
+            blocks.append(chunk_values)
+        row += len(chunk_values)
+    if values is None:
+        values = numpy.concatenate(blocks) if len(blocks) > 0 else numpy.zeros((0, len(value_columns)), dtype=dtype)
+    values = values[0:row]
+    names = numpy.concatenate(names) if len(names) > 0 else numpy.zeros(0, dtype=object)
+    dataset = pandas.DataFrame(values, index=pandas.Index(names, name="Name"), columns=[
+                               header[column] for column in value_columns], copy=False)
+    if description_column is not None:
+        descriptions = numpy.concatenate(descriptions)
+    else:
+        descriptions = None
+    return {'data': dataset, 'row_descriptions': descriptions, 'input_length': len(dataset.index)}
+
+
+# Yield (names, descriptions, values) blocks of a tab delimited matrix body
+def _matrix_chunks(path, skiprows, n_columns, description_column, value_columns, dtype, engine):
+    if engine in ["auto", "pyarrow"]:
+        try:
+            import pyarrow
+            import pyarrow.csv
+        except ImportError:
+            if engine == "pyarrow":
+                sys.exit("The pyarrow reader was requested but pyarrow is not installed.")
+        else:
+            column_names = [str(column) for column in range(n_columns)]
+            text_columns = [0] if description_column is None else [0, description_column]
+            reader = pyarrow.csv.open_csv(path, read_options=pyarrow.csv.ReadOptions(skip_rows=skiprows, column_names=column_names, use_threads=True),
+                                          parse_options=pyarrow.csv.ParseOptions(delimiter='\t'),
+                                          convert_options=pyarrow.csv.ConvertOptions(column_types={name: (pyarrow.string() if column in text_columns else pyarrow.from_numpy_dtype(numpy.dtype(dtype))) for column, name in enumerate(column_names)},
+                                                                                     null_values=matrix_na_values, strings_can_be_null=False))
+            for batch in reader:
+                if batch.num_rows == 0:
+                    continue
+                values = numpy.empty((batch.num_rows, len(value_columns)), dtype=dtype)
+                for position, column in enumerate(value_columns):
+                    values[:, position] = batch.column(column).to_numpy(zero_copy_only=False)
+                descriptions = None if description_column is None else batch.column(
+                    description_column).to_numpy(zero_copy_only=False)
+                yield batch.column(0).to_numpy(zero_copy_only=False), descriptions, values
+            return
+    column_types = {column: dtype for column in value_columns}
+    column_types[0] = str
+    if description_column is not None:
+        column_types[description_column] = str
+    reader = pandas.read_csv(path, sep='\t', skiprows=skiprows, header=None, names=list(range(n_columns)), dtype=column_types,
+                             keep_default_na=False, na_values={column: matrix_na_values for column in value_columns},
+                             skip_blank_lines=True, chunksize=matrix_chunk_rows)
+    for chunk in reader:
+        descriptions = None if description_column is None else chunk[description_column].values
+        yield chunk[0].values, descriptions, chunk[value_columns].to_numpy(dtype=dtype)
 
 
 # Simple implementation of a CHIP Parser for use with ssGSEA
@@ -34,58 +133,237 @@ def read_chip(chip):
     return chip_df
 
 
-def true_value_of_abs_max(series):
-    abs_max_value = series.abs().max()  # Find the maximum absolute value
-    idx_of_max_abs_value = series.abs().idxmax()  # Find the index of the maximum absolute value
-    return series.loc[idx_of_max_abs_value]  # Return the corresponding true value
+chip_index_arrays = ['probes', 'codes', 'symbols']
+
+
+# Compact probe to gene index of a CHIP file or CHIP dataframe
+# Probes map to int32 codes into a sorted array of gene symbols (-1 where a
+# probe has no symbol); duplicated probes keep their first mapping. Gene
+# titles are kept apart from the index (see chip_titles).
+def chip_index_from_frame(chip_df):
+    chip_df = chip_df[~chip_df.index.duplicated()]
+    codes, symbols = pandas.factorize(chip_df["Gene Symbol"].values, sort=True)
+    chip_index = {'probes': numpy.asarray(chip_df.index.astype(str), dtype=str), 'codes': codes.astype(numpy.int32),
+                  'symbols': numpy.asarray(symbols, dtype=str)}
+    if "Gene Title" in chip_df.columns:
+        chip_index['titles'] = numpy.asarray(chip_df["Gene Title"].fillna("").astype(str).values, dtype=str)
+    return chip_index
+
+
+# Read a CHIP file through the persistent CHIP index cache
+# Entries are keyed by the content hash of the file and hold the probe,
+# code and symbol arrays, which are memory mapped on later runs, plus the
+# gene titles, which are only loaded when chip_titles asks for them. The
+# cache is bounded by least recently used eviction (see prune_cache).
+def read_chip_index(chip, cache_dir=None):
+    cache_dir = cache_directory(cache_dir)
+    if cache_dir is None:
+        return chip_index_from_frame(read_chip(chip))
+    entry = os.path.join(cache_dir, "chips", str(os.path.getsize(chip)) + "_" + file_digest(chip))
+    chip_index = load_cache_entry(entry, chip_index_arrays)
+    if chip_index is None:
+        chip_index = chip_index_from_frame(read_chip(chip))
+        store_cache_entry(entry, chip_index, {'path': os.path.abspath(chip), 'size': os.path.getsize(chip)})
+    else:
+        chip_index['entry'] = entry
+    return chip_index
+
+
+# Gene titles of every probe in a CHIP index, or None if the CHIP has none
+def chip_titles(chip_index):
+    if 'titles' in chip_index:
+        return chip_index['titles']
+    if 'entry' in chip_index and os.path.exists(os.path.join(chip_index['entry'], 'titles.npy')):
+        chip_index['titles'] = numpy.load(os.path.join(chip_index['entry'], 'titles.npy'), mmap_mode='r')
+        return chip_index['titles']
+    return None
+
+
+collapse_methods = ["sum", "mean", "median", "max", "absmax"]
+
+
+# Reduce contiguous row segments of a (rows x columns) block
+# starts holds the first row of every segment. NaNs are skipped the way the
+# pandas groupby reductions skip them; absmax keeps the signed value with the
+# largest magnitude (first one on ties) and median sorts each segment by a
+# combined (segment, rank within column) key.
+def _reduce_segments(values, starts, method):
+    if method == "sum":
+        return numpy.add.reduceat(numpy.where(numpy.isnan(values), 0, values), starts, axis=0)
+    if method == "max":
+        return numpy.fmax.reduceat(values, starts, axis=0)
+    missing = numpy.isnan(values)
+    counts = numpy.add.reduceat(~missing, starts, axis=0)
+    if method == "mean":
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(counts > 0, numpy.add.reduceat(numpy.where(missing, 0, values), starts, axis=0) / counts, numpy.nan)
+    segments = numpy.repeat(numpy.arange(len(starts)), numpy.diff(numpy.append(starts, len(values))))
+    rows = numpy.arange(len(values))[:, None]
+    if method == "absmax":
+        magnitude = numpy.where(missing, -1, numpy.abs(values))
+        largest = numpy.maximum.reduceat(magnitude, starts, axis=0)
+        first = numpy.minimum.reduceat(numpy.where(magnitude == largest[segments], rows, len(values)), starts, axis=0)
+        return numpy.take_along_axis(values, first, axis=0)
+    if method == "median":
+        ranks = numpy.empty(values.shape, dtype=numpy.int64)
+        numpy.put_along_axis(ranks, numpy.argsort(values, axis=0, kind='stable'), rows, axis=0)
+        ordered = numpy.take_along_axis(values, numpy.argsort(
+            segments[:, None] * len(values) + ranks, axis=0), axis=0)
+        low = numpy.minimum(starts[:, None] + numpy.maximum(counts - 1, 0) // 2, len(values) - 1)
+        high = numpy.minimum(starts[:, None] + counts // 2, len(values) - 1)
+        return numpy.where(counts > 0, (numpy.take_along_axis(ordered, low, axis=0) + numpy.take_along_axis(ordered, high, axis=0)) / 2, numpy.nan)
+    sys.exit("Collapse method '" + str(method) + "' is not supported. Supported methods are: " + ", ".join(collapse_methods))
+
 
 # Simple implementation of GSEA DEsktop's Collapse Dataset functions for use
 # with ssSGEA
 # Accepts an expression dataset in GCT format, a CHIP file, and a
 # collapse metric and returns a pandas dataframe formatted version of the
 # dataset collapsed from probe level to gene level using the specified metric.
-def collapse_dataset(dataset, chip, method="sum", drop=True):
-    import pandas as pd
+# Probes are mapped to integer gene codes and sorted once so every gene is a
+# contiguous segment, then column blocks are reduced in cpu threads. chip may
+# be a CHIP file, a CHIP dataframe or a CHIP index from read_chip_index; gene
+# titles for row_descriptions are only looked up when titles is True.
+def collapse_dataset(dataset, chip, method="sum", drop=True, dtype=numpy.float64, cpu=1, titles=True):
     if isinstance(dataset, pandas.DataFrame):
         dataset = dataset
     elif isinstance(dataset, dict) == False:
-        dataset = read_gct(dataset)
-    if isinstance(chip, pandas.DataFrame) == False:
-        chip = read_chip(chip)
+        dataset = read_gct(dataset, dtype=dtype)
+    if isinstance(chip, pandas.DataFrame) == True:
+        chip = chip_index_from_frame(chip)
+    elif isinstance(chip, dict) == False:
+        chip = read_chip_index(chip)
     if isinstance(dataset, dict) == True:
         dataset = dataset['data']
+    method = method.lower()
+    if method not in collapse_methods:
+        sys.exit("Collapse method '" + str(method) + "' is not supported. Supported methods are: " + ", ".join(collapse_methods))
     input_len = len(dataset.index)
-    joined_df = chip.join(dataset, how='right')
-    joined_df.index.name = "Name"
-    joined_df.reset_index(drop=False, inplace=True)
-    mappings = joined_df[["Name",
-                          "Gene Symbol"]].drop_duplicates().copy().sort_values('Gene Symbol').rename(columns={'Name': 'Dataset ID(s)'})  # Save mapping details for reporting
-    joined_df = joined_df.drop("Name", axis=1).dropna(subset=['Gene Symbol'])
-    annotations = joined_df[["Gene Symbol",
-                             "Gene Title"]].drop_duplicates().copy()  # Save gene annotations for reporting
-    joined_df.drop("Gene Title", axis=1, inplace=True)
-    value_columns = joined_df.columns.difference(['Gene Symbol'])
-    joined_df[value_columns] = joined_df[value_columns].apply(
-        pd.to_numeric, errors='coerce')
-    # Do Mathematical Collapse Operations
-    if method.lower() == "sum":
-        collapsed_df = joined_df.groupby(["Gene Symbol"]).sum()
-    if method.lower() == "mean":
-        collapsed_df = joined_df.groupby(["Gene Symbol"]).mean()
-    if method.lower() == "median":
-        collapsed_df = joined_df.groupby(["Gene Symbol"]).median()
-    if method.lower() == "max":
-        collapsed_df = joined_df.groupby(["Gene Symbol"]).max()
-    if method.lower() == "absmax":
-        agg_functions = {column: true_value_of_abs_max  for column in value_columns}
-        collapsed_df = joined_df.groupby('Gene Symbol').agg(agg_functions)
-    collapsed_df.index.name = "Name"
-    # Group mapping details
-    mappings = pandas.DataFrame(mappings.groupby(
-        'Gene Symbol', dropna=False)['Dataset ID(s)'].apply(list))
-    mappings['Dataset ID(s)'] = [','.join(map(str, l))
-                                 for l in mappings['Dataset ID(s)']]
-    return {'data': collapsed_df, 'row_descriptions': annotations["Gene Title"].values, 'mappings': mappings, 'input_length': input_len, 'collapse_length': len(collapsed_df.index)}
+    probe_rows = pandas.Index(numpy.asarray(chip['probes'], dtype=object)).get_indexer(dataset.index.astype(str))
+    probe_codes = numpy.where(probe_rows >= 0, numpy.asarray(chip['codes'])[probe_rows], -1)
+    # Code -1 picks the trailing NaN for probes without a gene symbol
+    symbols = pandas.Series(numpy.append(numpy.asarray(chip['symbols'], dtype=object), numpy.nan)[
+        probe_codes], index=dataset.index)
+    # Save mapping details for reporting
+    mappings = pandas.DataFrame({'Dataset ID(s)': dataset.index.astype(str), 'Gene Symbol': symbols.values}).drop_duplicates()
+    mappings = pandas.DataFrame(mappings.sort_values('Gene Symbol', kind='mergesort').groupby(
+        'Gene Symbol', dropna=False, sort=True)['Dataset ID(s)'].agg(','.join))
+    mapped = symbols.notna().values
+    codes, genes = pandas.factorize(symbols.values[mapped], sort=True)
+    order = numpy.argsort(codes, kind='stable')
+    starts = numpy.flatnonzero(numpy.diff(codes[order], prepend=-1))
+    rows = numpy.flatnonzero(mapped)[order]
+    if all(dtype.kind == 'f' for dtype in dataset.dtypes):
+        values = dataset.values[rows]
+    else:
+        values = dataset.iloc[rows].apply(pandas.to_numeric, errors='coerce').values
+    blocks = [block for block in numpy.array_split(numpy.arange(values.shape[1]), max(cpu, 1)) if len(block) > 0]
+    if len(blocks) > 1 and len(starts) > 0:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(blocks)) as pool:
+            collapsed = list(pool.map(lambda block: _reduce_segments(values[:, block], starts, method), blocks))
+    elif len(starts) > 0:
+        collapsed = [_reduce_segments(values, starts, method)]
+    else:
+        collapsed = [numpy.zeros((0, values.shape[1]), dtype=values.dtype)]
+    collapsed_df = pandas.DataFrame(numpy.hstack(collapsed), index=pandas.Index(genes, name="Name"), columns=dataset.columns)
+    # Save gene annotations for reporting, one title per collapsed gene
+    probe_titles = chip_titles(chip) if titles == True else None
+    if probe_titles is not None:
+        row_descriptions = numpy.asarray(probe_titles)[probe_rows[rows[starts]]]
+    else:
+        row_descriptions = None
+    return {'data': collapsed_df, 'row_descriptions': row_descriptions, 'mappings': mappings, 'input_length': input_len, 'collapse_length': len(collapsed_df.index)}
+
+
+# Read a RNK file, with a '#' header line naming the metric or without one
+def read_rnk(rnk):
+    input_ds = pandas.read_csv(
+        rnk, sep='\t', index_col=0, skip_blank_lines=True, header=None)
+    if any(input_ds.index.str.startswith('#')):
+        input_ds = input_ds.rename(columns=input_ds.iloc[int(
+            numpy.where(input_ds.index.str.startswith('#'))[0])])
+        input_ds = input_ds[input_ds.index.str.startswith('#') != True]
+    else:
+        input_ds = input_ds.rename(columns={1: "Preranked Metric"})
+    input_ds.index.name = "Name"
+    return input_ds
+
+
+# Parse (and collapse) the input dataset of a runner
+# GCT files, RNK files when preranked is set, and otherwise tab delimited
+# matrices are read, then collapsed from probes to genes with the CHIP file
+# unless collapse is 'none'. Returns the dataset, the collapse mappings (or
+# None), the number of input features and the number of collapsed genes (or
+# None).
+def parse_input_dataset(dataset, collapse="none", chip=None, dtype=numpy.float64, cpu=1, preranked=False):
+    extension = dataset.split(".")[-1]
+    if extension == "gct" and collapse != "none":
+        input_ds = collapse_dataset(dataset, read_chip_index(chip), method=collapse, drop=True, dtype=dtype, cpu=cpu, titles=False)
+        return {'data': input_ds['data'], 'mappings': input_ds['mappings'],
+                'input_length': input_ds['input_length'], 'collapse_length': input_ds['collapse_length']}
+    if extension == "gct":
+        input_ds = read_gct(dataset, dtype=dtype)
+        return {'data': input_ds['data'], 'mappings': None, 'input_length': input_ds['input_length'], 'collapse_length': None}
+    if extension == "rnk" and preranked == True:
+        input_ds = read_rnk(dataset)
+    else:
+        input_ds = read_tsv(dataset, dtype=dtype)['data']
+    if collapse == "none":
+        return {'data': input_ds, 'mappings': None, 'input_length': len(input_ds.index), 'collapse_length': None}
+    input_ds = collapse_dataset(input_ds, read_chip_index(chip), method=collapse, drop=True, cpu=cpu, titles=False)
+    return {'data': input_ds['data'], 'mappings': input_ds['mappings'],
+            'input_length': input_ds['input_length'], 'collapse_length': input_ds['collapse_length']}
+
+
+dataset_stage_arrays = ['values', 'rows', 'columns', 'index_name', 'lengths']
+dataset_mapping_arrays = ['mapping_symbols', 'mapping_missing', 'mapping_probes']
+
+
+# Parse stage of the runners through the dataset cache
+# Entries are keyed by the content hash of the dataset, and of the CHIP file
+# when collapsing, plus the parse settings, and hold the parsed values, which
+# later runs memory map, their names, the lengths and the collapse mappings.
+# The cache is bounded by least recently used eviction (see prune_cache).
+def read_input_dataset(dataset, collapse="none", chip=None, dtype=numpy.float64, cpu=1, preranked=False, cache_dir=None):
+    import hashlib
+    cache_dir = cache_directory(cache_dir)
+    if cache_dir is None:
+        return parse_input_dataset(dataset, collapse, chip, dtype, cpu, preranked)
+    key = {'dataset': [os.path.getsize(dataset), file_digest(dataset)], 'extension': dataset.split(".")[-1],
+           'preranked': preranked, 'collapse': collapse, 'dtype': str(numpy.dtype(dtype)),
+           'chip': None if collapse == "none" else [os.path.getsize(chip), file_digest(chip)]}
+    entry = os.path.join(cache_dir, "datasets", hashlib.blake2b(json.dumps(key).encode(), digest_size=16).hexdigest())
+    arrays = load_cache_entry(entry, dataset_stage_arrays)
+    if arrays is not None:
+        mappings = None
+        if collapse != "none":
+            mapping_arrays = load_cache_entry(entry, dataset_mapping_arrays)
+            if mapping_arrays is None:
+                return parse_input_dataset(dataset, collapse, chip, dtype, cpu, preranked)
+            symbols = numpy.where(mapping_arrays['mapping_missing'], numpy.nan,
+                                  numpy.asarray(mapping_arrays['mapping_symbols'], dtype=object))
+            mappings = pandas.DataFrame({'Dataset ID(s)': numpy.asarray(mapping_arrays['mapping_probes'], dtype=object)},
+                                        index=pandas.Index(symbols, name='Gene Symbol', dtype=object))
+        data = pandas.DataFrame(arrays['values'], index=pandas.Index(numpy.asarray(arrays['rows'], dtype=object), name=str(arrays['index_name'][0])),
+                                columns=numpy.asarray(arrays['columns'], dtype=object), copy=False)
+        lengths = arrays['lengths'].tolist()
+        return {'data': data, 'mappings': mappings, 'input_length': lengths[0],
+                'collapse_length': None if lengths[1] < 0 else lengths[1]}
+    input_ds = parse_input_dataset(dataset, collapse, chip, dtype, cpu, preranked)
+    stage = {'values': numpy.ascontiguousarray(input_ds['data'].values),
+             'rows': numpy.asarray(input_ds['data'].index.values, dtype=str),
+             'columns': numpy.asarray(input_ds['data'].columns.values, dtype=str),
+             'index_name': numpy.asarray([str(input_ds['data'].index.name)], dtype=str),
+             'lengths': numpy.asarray([input_ds['input_length'], -1 if input_ds['collapse_length'] is None else input_ds['collapse_length']], dtype=numpy.int64)}
+    if input_ds['mappings'] is not None:
+        symbols = input_ds['mappings'].index
+        stage['mapping_missing'] = numpy.asarray(symbols.isna())
+        stage['mapping_symbols'] = numpy.asarray(symbols.fillna("").values, dtype=str)
+        stage['mapping_probes'] = numpy.asarray(input_ds['mappings']['Dataset ID(s)'].values, dtype=str)
+    if stage['values'].dtype.kind == 'f':
+        store_cache_entry(entry, stage, {'path': os.path.abspath(dataset), 'size': os.path.getsize(dataset)})
+    return input_ds
 
 
 # Save a GCT result to a file, ensuring the filename has the extension .gct
@@ -117,6 +395,63 @@ def check_extension(file_name, extension):
     return file_name
 
 
+# Binary dataset handoff between the runners and the engine
+# A dataset is stored as <prefix>.npy holding the values plus <prefix>.rows.tsv
+# and <prefix>.columns.tsv holding the names, so it can be reopened with
+# memory mapping instead of re-parsing a text matrix. A handoff already
+# holding the same dataset is left in place, so a restarted job keeps the
+# file times its permutation checkpoint is keyed on.
+def write_dataset_handoff(dataset, prefix, dtype=numpy.float64):
+    values = dataset.values.astype(dtype, copy=False)
+    if _same_dataset_handoff(values, dataset, prefix):
+        return prefix
+    numpy.save(prefix + '.npy', numpy.ascontiguousarray(values))
+    pandas.DataFrame({dataset.index.name or "Name": dataset.index.values}).to_csv(
+        prefix + '.rows.tsv', sep='\t', index=False)
+    pandas.DataFrame({"Columns": dataset.columns.values}).to_csv(
+        prefix + '.columns.tsv', sep='\t', index=False)
+    return prefix
+
+
+def _same_dataset_handoff(values, dataset, prefix):
+    if not all(os.path.exists(prefix + suffix) for suffix in ['.npy', '.rows.tsv', '.columns.tsv']):
+        return False
+    try:
+        handoff = read_dataset_handoff(prefix)
+    except (OSError, ValueError, pandas.errors.ParserError):
+        return False
+    return handoff.values.dtype == values.dtype and handoff.shape == values.shape and \
+        handoff.index.name == (dataset.index.name or "Name") and \
+        numpy.array_equal(handoff.index.values, dataset.index.values.astype(str)) and \
+        numpy.array_equal(handoff.columns.values, dataset.columns.values.astype(str)) and \
+        numpy.array_equal(handoff.values, values, equal_nan=True)
+
+
+# Open a dataset handoff as a DataFrame backed by a read-only memory map
+def read_dataset_handoff(prefix, mmap_mode='r'):
+    rows = pandas.read_csv(prefix + '.rows.tsv', sep='\t', dtype=str, keep_default_na=False)
+    columns = pandas.read_csv(prefix + '.columns.tsv', sep='\t', dtype=str, keep_default_na=False)
+    values = numpy.load(prefix + '.npy', mmap_mode=mmap_mode)
+    return pandas.DataFrame(values, index=pandas.Index(rows.iloc[:, 0].values, name=rows.columns[0]),
+                            columns=columns.iloc[:, 0].values, copy=False)
+
+
+# Resolve engine input that may be given as a DataFrame or a handoff prefix
+def _engine_dataset(input_ds):
+    if isinstance(input_ds, str):
+        return read_dataset_handoff(input_ds)
+    return input_ds
+
+
+# Values of engine input as a float array, memory mapped when it is a handoff
+# Floating point input keeps its precision so float32 datasets stay float32.
+def _engine_values(data):
+    if isinstance(data, str):
+        data = numpy.load(data + '.npy', mmap_mode='r')
+    data = numpy.asarray(data)
+    return data if data.dtype.kind == 'f' else data.astype(float)
+
+
 # Read CLS function adapted from https://github.com/broadinstitute/gsea_python/blob/ccal-refactor/gsea/Utils.py
 def read_cls(path):
     """
@@ -177,60 +512,255 @@ def match_phenotypes(expr, phen):
     return phen
 
 
-# Simple GMT/GMX to Dict parser
-def read_sets(gene_sets_dbfile_list):
+# Directory for on-disk caches shared between runs
+# Uses cache_dir when given, otherwise $GSEA_CACHE_DIR or ~/.cache/gsea2.
+# Returns None when the directory can not be created so callers can run
+# without caching.
+def cache_directory(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.environ.get("GSEA_CACHE_DIR", os.path.join(
+            os.path.expanduser("~"), ".cache", "gsea2"))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        return None
+    return cache_dir
+
+
+# Content hash of a file, read in blocks so large databases are not loaded whole
+def file_digest(path):
+    import hashlib
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+cache_max_bytes = 2 * 1024 ** 3
+cache_folders = ["chips", "sets", "datasets", "nulls", "stages"]
+
+
+# Load the arrays of a cache entry directory with memory mapping
+# Returns None when the entry is missing or unreadable. The entry's time
+# stamp is refreshed so prune_cache evicts least recently used entries first.
+def load_cache_entry(entry, names):
+    if not os.path.isdir(entry):
+        return None
+    try:
+        arrays = {name: numpy.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in names}
+        os.utime(entry)
+    except (OSError, ValueError):
+        return None
+    return arrays
+
+
+# Store a dict of arrays as a cache entry directory, one .npy per array
+# Entries are written to a staging directory and renamed into place so other
+# jobs never see a partial entry. Failures to write leave the cache untouched.
+# Callers storing many entries at once can pass prune=False and call
+# prune_cache once afterwards.
+def store_cache_entry(entry, arrays, source=None, prune=True):
+    import shutil
+    import tempfile
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        staging = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        for name, values in arrays.items():
+            numpy.save(os.path.join(staging, name + '.npy'), values)
+        if source is not None:
+            with open(os.path.join(staging, 'source.json'), 'w') as f:
+                json.dump(source, f)
+        try:
+            os.rename(staging, entry)
+        except OSError:  # Another job stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+    except OSError:
+        return
+    if prune:
+        prune_cache(os.path.dirname(os.path.dirname(entry)))
+
+
+# Evict least recently used entries of a cache until it holds at most
+# max_bytes. Entries of every cache folder under cache_root count against
+# the one limit, other files there are left alone.
+def prune_cache(cache_root, max_bytes=None):
+    import shutil
+    if max_bytes is None:
+        max_bytes = int(os.environ.get("GSEA_CACHE_MAX_BYTES", cache_max_bytes))
+    entries = []
+    for folder_name in cache_folders:
+        cache_folder = os.path.join(cache_root, folder_name)
+        if not os.path.isdir(cache_folder):
+            continue
+        for name in os.listdir(cache_folder):
+            entry = os.path.join(cache_folder, name)
+            if name.startswith("tmp") or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(folder, file_name))
+                       for folder, _, file_names in os.walk(entry) for file_name in file_names)
+            entries.append((os.path.getmtime(entry), size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+# Parse one GMT/GMX/JSON gene sets file into name:members and name:description dicts
+def parse_sets_file(gsdb):
     genesets = {}
     genesets_descr = {}
-    genesets_len = {}
-    for gsdb in gene_sets_dbfile_list:
-        gsdb_split = gsdb.split(".")
-        if gsdb_split[-1] == "gmt":
-            with open(gsdb) as f:
-                temp = f.read().splitlines()
-                for i in range(len(temp)):
-                    gs_line = temp[i].split("\t")
-                    gene_set_name = gs_line[0]
-                    gene_set_desc = gs_line[1]
-                    gene_set_tags = gs_line[2:len(gs_line)]
-                    genesets[gene_set_name] = list(set(gene_set_tags))
-                    # Not used yet but should end up in reports eventually
-                    genesets_descr[gene_set_name] = gene_set_desc
-        elif gsdb_split[-1] == "gmx":  # is a gmx formatted file
-            df_temp = pandas.read_csv(
-                gsdb, sep='\t', skip_blank_lines=True).transpose().dropna(how='all')
-            for i in range(len(df_temp)):
-                gs_line = df_temp.iloc[i][~df_temp.iloc[i].isnull()]
-                gene_set_name = gs_line.name
-                gene_set_desc = gs_line[0]
-                gene_set_tags = gs_line[1:len(gs_line)]
+    gsdb_split = gsdb.split(".")
+    if gsdb_split[-1] == "gmt":
+        with open(gsdb) as f:
+            temp = f.read().splitlines()
+            for i in range(len(temp)):
+                gs_line = temp[i].split("\t")
+                gene_set_name = gs_line[0]
+                gene_set_desc = gs_line[1]
+                gene_set_tags = gs_line[2:len(gs_line)]
                 genesets[gene_set_name] = list(set(gene_set_tags))
                 # Not used yet but should end up in reports eventually
                 genesets_descr[gene_set_name] = gene_set_desc
-        elif gsdb_split[-1] == "json":
-            with open(gsdb) as f:
-                temp = json.load(f)
-            gene_set_tags = {key: temp[key]['geneSymbols']
-                             for key in temp.keys()}
-            genesets.update(gene_set_tags)
-            gene_set_desc = {key: temp[key]['msigdbURL']
-                             for key in temp.keys()}
-            genesets_descr.update(gene_set_desc)
-        else:
+    elif gsdb_split[-1] == "gmx":  # is a gmx formatted file
+        df_temp = pandas.read_csv(
+            gsdb, sep='\t', skip_blank_lines=True, dtype=str)
+        for gene_set_name in df_temp.columns:
+            gs_line = df_temp[gene_set_name].dropna()
+            if len(gs_line) == 0:
+                continue
+            genesets[gene_set_name] = list(set(gs_line.iloc[1:]))
+            # Not used yet but should end up in reports eventually
+            genesets_descr[gene_set_name] = gs_line.iloc[0]
+    elif gsdb_split[-1] == "json":
+        with open(gsdb) as f:
+            temp = json.load(f)
+        genesets = {key: temp[key]['geneSymbols'] for key in temp.keys()}
+        genesets_descr = {key: temp[key]['msigdbURL'] for key in temp.keys()}
+    else:
+        sys.exit("The Gene Set Database format was not recognised.")
+    return genesets, genesets_descr
+
+
+# Compile name:members and name:description dicts into arrays
+# Gene symbols are interned into one array in order of first appearance and
+# each set becomes a row of an int32 CSR structure (indptr, indices) over it.
+def compile_sets(genesets, genesets_descr):
+    names = list(genesets.keys())
+    indptr = numpy.zeros(len(names) + 1, dtype=numpy.int64)
+    indptr[1:] = numpy.cumsum([len(genesets[name]) for name in names])
+    gene_codes = {}
+    indices = numpy.fromiter((gene_codes.setdefault(gene, len(gene_codes)) for name in names
+                              for gene in genesets[name]), dtype=numpy.int32, count=indptr[-1])
+    return {'names': numpy.asarray(names, dtype=str), 'descriptions': numpy.asarray([str(genesets_descr.get(name, "")) for name in names], dtype=str),
+            'genes': numpy.asarray(list(gene_codes), dtype=str), 'indptr': indptr, 'indices': indices}
+
+
+# Expand compiled gene sets back into name:members and name:description dicts
+def expand_sets(compiled):
+    members = numpy.asarray(compiled['genes'], dtype=object)[compiled['indices']]
+    names = compiled['names'].tolist()
+    genesets = {name: genes.tolist() for name, genes in zip(
+        names, numpy.split(members, compiled['indptr'][1:-1]))}
+    genesets_descr = dict(zip(names, compiled['descriptions'].tolist()))
+    return genesets, genesets_descr
+
+
+compiled_sets_arrays = ['names', 'descriptions', 'genes', 'indptr', 'indices']
+
+
+# Load a gene sets file through the compiled cache
+# Entries are keyed by the file format, size and content hash (not the path,
+# since job inputs are often staged to a new path for every run) and stored
+# as one .npy per array so later runs memory map them instead of parsing. The
+# cache is bounded by least recently used eviction (see prune_cache).
+def read_compiled_sets(gsdb, cache_dir=None):
+    cache_dir = cache_directory(cache_dir)
+    if cache_dir is None:
+        return compile_sets(*parse_sets_file(gsdb))
+    key = gsdb.split(".")[-1] + "_" + str(os.path.getsize(gsdb)) + "_" + file_digest(gsdb)
+    entry = os.path.join(cache_dir, "sets", key)
+    compiled = load_cache_entry(entry, compiled_sets_arrays)
+    if compiled is None:
+        compiled = compile_sets(*parse_sets_file(gsdb))
+        store_cache_entry(entry, compiled, {'path': os.path.abspath(gsdb), 'size': os.path.getsize(gsdb)})
+    return compiled
+
+
+# Simple GMT/GMX to Dict parser
+# Each file is read through the compiled gene set cache (see read_compiled_sets)
+def read_sets(gene_sets_dbfile_list, cache_dir=None):
+    genesets = {}
+    genesets_descr = {}
+    for gsdb in gene_sets_dbfile_list:
+        if gsdb.split(".")[-1] not in ["gmt", "gmx", "json"]:
             sys.exit("The Gene Set Database format was not recognised.")
+        file_sets, file_descr = expand_sets(read_compiled_sets(gsdb, cache_dir))
+        genesets.update(file_sets)
+        genesets_descr.update(file_descr)
     genesets_len = {key: len(value) for key, value in genesets.items()}
     return {'genesets': genesets, 'descriptions': genesets_descr, 'lengths': genesets_len}
 
 
 # Restrict Gene sets to input universe
+# Every member is looked up in the dataset index in one vectorized pass
+# through the set x gene CSR matrix of build_membership_matrix, which is also
+# returned for downstream use. Filtered members follow the dataset order.
 def filter_sets(genesets_dict, dataset_index):
-    genesets_filtered = {}
-    genesets_len_filtered = {}
-    for (key, value) in genesets_dict.items():
-        genesets_filtered[key] = list(
-            set(genesets_dict[key]) & set(list(dataset_index.values)))
-    genesets_len_filtered = {key: len(value)
-                             for key, value in genesets_filtered.items()}
-    return {'genesets': genesets_filtered, 'lengths': genesets_len_filtered}
+    membership = build_membership_matrix(genesets_dict, dataset_index)
+    features = numpy.asarray(dataset_index.values, dtype=object)[membership.indices]
+    set_names = list(genesets_dict.keys())
+    genesets_filtered = {key: value.tolist() for key, value in zip(
+        set_names, numpy.split(features, membership.indptr[1:-1]))}
+    genesets_len_filtered = dict(
+        zip(set_names, numpy.diff(membership.indptr).tolist()))
+    return {'genesets': genesets_filtered, 'lengths': genesets_len_filtered, 'membership': membership}
+
+
+redundancy_block_size = 1000
+
+
+# Cluster near-duplicate gene sets by the Jaccard index of their members
+# Overlaps come from the sparse self-product of the set x gene membership
+# matrix (as returned by filter_sets), computed for redundancy_block_size
+# sets at a time so only pairs at or above threshold are ever kept. Sets are
+# then visited from largest to smallest: an unclustered set becomes the
+# representative of a new cluster that takes in every unclustered set whose
+# Jaccard index with it is at least threshold. Returns the Size, Cluster,
+# Representative and Jaccard (to the representative) of every set.
+def set_redundancy_clusters(membership, set_names, threshold):
+    membership = sparse.csr_matrix(membership, dtype=numpy.int32)
+    sizes = numpy.diff(membership.indptr)
+    transposed = membership.T.tocsc()
+    pairs = [(numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0))]
+    for start in range(0, membership.shape[0], redundancy_block_size):
+        overlap = (membership[start:start + redundancy_block_size] @ transposed).tocoo()
+        rows = overlap.row + start
+        jaccard = overlap.data / (sizes[rows] + sizes[overlap.col] - overlap.data)
+        keep = (jaccard >= threshold) & (rows != overlap.col)
+        pairs.append((rows[keep], overlap.col[keep], jaccard[keep]))
+    rows, columns, jaccard = [numpy.concatenate(values) for values in zip(*pairs)]
+    neighbors = sparse.csr_matrix((jaccard, (rows, columns)), shape=(len(sizes), len(sizes)))
+    cluster = numpy.full(len(sizes), -1, dtype=numpy.int64)
+    representative = numpy.arange(len(sizes))
+    similarity = numpy.ones(len(sizes))
+    n_clusters = 0
+    for row in numpy.argsort(-sizes, kind='mergesort'):
+        if cluster[row] >= 0:
+            continue
+        cluster[row] = n_clusters
+        members = neighbors.indices[neighbors.indptr[row]:neighbors.indptr[row + 1]]
+        member_jaccard = neighbors.data[neighbors.indptr[row]:neighbors.indptr[row + 1]]
+        free = cluster[members] < 0
+        cluster[members[free]] = n_clusters
+        representative[members[free]] = row
+        similarity[members[free]] = member_jaccard[free]
+        n_clusters += 1
+    set_names = numpy.asarray(set_names, dtype=object)
+    return pandas.DataFrame({'Size': sizes, 'Cluster': cluster + 1, 'Representative': set_names[representative],
+                             'Jaccard': similarity}, index=pandas.Index(set_names, name="Set"))
 
 
 # Get file paths
@@ -571,15 +1101,45 @@ def get_leading_edge(page_str):
     gene_list = content[3]['text']
     gene_list_index = content[3]['x']
     running_es = content[3]['y']
-    running_es_dict = dict(zip(gene_list, running_es))
     gene_list_neg_metric = content[0]['y']
     gene_list_pos_metric = content[1]['y']
     gene_list_metric = [x if abs(x) >= abs(y) else y for x, y in zip(
         gene_list_neg_metric, gene_list_pos_metric)]
+    return leading_edge_table(set_members, gene_list, gene_list_index, running_es, gene_list_metric)
+
 
-    es_position = max(range(len(running_es)), key=lambda i: abs(running_es[i]))
-    es_index = gene_list_index[es_position]
-    set_es = running_es[es_position]
+# Compute the leading edge table for a set directly from the ranked list
+# Used with the python engine, whose enrichment plots carry no embedded data
+def get_running_leading_edge(ranked_genes, set_members, exponent):
+    ranked_genes = ranked_genes.sort_values(
+        ranked_genes.columns[0], ascending=False, kind='mergesort')
+    metric = ranked_genes.iloc[:, 0].values.astype(float)
+    positions = numpy.sort(ranked_genes.index.get_indexer(list(set_members)))
+    positions = positions[positions >= 0]
+    running_es = running_enrichment(numpy.abs(metric) ** exponent, positions)
+    return leading_edge_table(set(set_members), list(ranked_genes.index.values), list(range(1, len(metric) + 1)), list(running_es), list(metric))
+
+
+# Compute the leading edge table for a set from the structured running
+# enrichment arrays of a run (see read_running_enrichment)
+def get_structured_leading_edge(running, set_name):
+    row = running['rows'][set_name]
+    hits = slice(running['indptr'][row], running['indptr'][row + 1])
+    positions = running['positions'][hits]
+    gene_list = running['features'][positions].tolist()
+    return leading_edge_table(set(gene_list), gene_list, (positions + 1).tolist(), running['running_es'][hits].tolist(),
+                              running['metric'][positions].tolist(), es_index=int(running['peak'][row]) + 1,
+                              set_es=float(running['peak_es'][row]))
+
+
+# The peak of the running enrichment score is located in running_es unless
+# its rank (es_index) and value (set_es) are given
+def leading_edge_table(set_members, gene_list, gene_list_index, running_es, gene_list_metric, es_index=None, set_es=None):
+    running_es_dict = dict(zip(gene_list, running_es))
+    if es_index is None:
+        es_position = max(range(len(running_es)), key=lambda i: abs(running_es[i]))
+        es_index = gene_list_index[es_position]
+        set_es = running_es[es_position]
     gene_ranks = dict(zip(gene_list, gene_list_index))
     gene_metrics = dict(zip(gene_list, gene_list_metric))
     set_ranks = {k: int(v) for k, v in gene_ranks.items() if k in set_members}
@@ -625,6 +1185,80 @@ def highlight_leading_edge(column):
     default = ''
     return [highlight if v == 'Yes' else default for v in column]
 
+
+# Worker state for per-set report pages, set once per pool process so the
+# ranked list, expression data and null distributions are shared read-only
+_report_worker = {}
+
+
+def _init_report_worker(report_inputs):
+    _report_worker.update(report_inputs)
+
+
+# Render the detailed report page of one gene set over its enrichment plot page
+# A task is (set name, enrichment details frame, filtered set members,
+# heatmap sort order, page path).
+def render_set_report(task):
+    set_name, report_set, filtered_gs, ascending, page_path = task
+    inputs = _report_worker
+    set_enrichment_score = report_set.loc['Enrichment'].values[0]
+    if inputs['heatmap'] == "prerank":
+        heatmap_title = "Ranked List Heatmap for "
+        heatmap_fig = plot_set_prerank_heatmap(
+            inputs['input_ds'], inputs['phenotypes'], inputs['ranked_genes'], filtered_gs, ascending=ascending)
+    else:
+        heatmap_title = "Row Normalized Expression Heatmap for "
+        heatmap_fig = plot_set_heatmap(
+            inputs['input_ds'], inputs['phenotypes'], inputs['ranked_genes'], filtered_gs, ascending=ascending)
+    null_es_fig = set_perm_indepkde_displot(
+        inputs['random_es_distribution'].loc[set_name], set_enrichment_score)
+    with open(page_path, 'r') as page:
+        page_str = page.read()
+    if inputs.get('running_enrichment') is not None and set_name in inputs['running_enrichment']['rows']:
+        leading_edge_table, leading_edge_subset = get_structured_leading_edge(
+            inputs['running_enrichment'], set_name)
+    elif inputs['engine'] == "python":
+        leading_edge_table, leading_edge_subset = get_running_leading_edge(
+            inputs['ranked_genes'], filtered_gs, inputs['exponent'])
+    else:
+        leading_edge_table, leading_edge_subset = get_leading_edge(page_str)
+    doc = dominate.document(title=set_name)
+    doc += h3("Enrichment Details")
+    doc += raw(report_set.to_html(header=False,
+                                  render_links=True, escape=False, justify='left'))
+    doc += raw("<br>")
+    doc += h3("Enrichment Plot")
+    doc += raw(page_str.replace("<!doctype html>", ""))
+    doc += raw("<br>")
+    doc += h3("Table: GSEA details")
+    doc += raw(leading_edge_table.to_html())
+    doc += p('Investigate core enrichment with ', a("MSigDB Webtools",
+                                                    href='https://www.gsea-msigdb.org/gsea/msigdb/annotate.jsp?geneIdList=' + leading_edge_subset, target='_blank'), " or ", a("Query NDEx", href='https://www.ndexbio.org/iquery/?genes=' + leading_edge_subset, target='_blank'))
+    doc += raw("<br>")
+    doc += h3(heatmap_title + set_name)  # add a title for the heatmap
+    doc += raw(heatmap_fig)
+    doc += raw("<br>")
+    doc += h3("Random Enrichment Score Distribution for " +
+              set_name)  # add a title for the ES distplot
+    doc += raw(null_es_fig)
+    with open(page_path, 'w') as f:
+        f.write(doc.render())
+    return page_path
+
+
+# Render the report pages of many gene sets over a process pool of cpu workers
+# report_inputs holds the shared 'input_ds', 'phenotypes', 'ranked_genes',
+# 'random_es_distribution', 'heatmap' ('expression' or 'prerank'), 'engine'
+# and 'exponent' entries, and optionally the 'running_enrichment' arrays of
+# the run, which leading edges are computed from when present.
+def render_set_reports(tasks, report_inputs, cpu=1):
+    if cpu > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(cpu, len(tasks)), initializer=_init_report_worker, initargs=(report_inputs,)) as pool:
+            return list(pool.map(render_set_report, tasks))
+    _init_report_worker(report_inputs)
+    return [render_set_report(task) for task in tasks]
+
 def compute_corr_area(ranked_genes, dist):
     try:
         if dist == "pos":
@@ -633,4 +1267,1367 @@ def compute_corr_area(ranked_genes, dist):
             corr_area = round(simps(abs(ranked_genes.iloc[:, 0].values[ranked_genes.iloc[:, 0].values < 0])) / simps(abs(ranked_genes.iloc[:, 0].values)) * 100, 1)
     except IndexError:
             corr_area = "N/A"
-    return (corr_area)
\ No newline at end of file
+    return (corr_area)
+
+# In-process enrichment engine
+# A NumPy implementation of the 'ks' and 'ksa' enrichment algorithms that
+# writes the same result files as the GSEA.jl command line so the runners can
+# post-process either engine's output identically. Sets whose filtered
+# members are identical are scored and permuted once (see unique_memberships)
+# and every set name still gets its own row in the results.
+python_engine_algorithms = ["ks", "ksa"]
+python_engine_metrics = ["signal-to-noise-ratio", "t-test", "mean-difference"]
+permutation_batch_size = 1000
+permutation_block_size = 500
+contrast_batch_size = 16
+metric_batch_size = 100
+sample_batch_size = 256
+
+
+# Build a sparse gene set x gene membership matrix over an ordered gene index
+# Rows follow the order of the gene set dict and columns follow the gene index,
+# genes missing from the index are dropped and column indices are sorted.
+def build_membership_matrix(genesets_dict, gene_index):
+    gene_index = pandas.Index(gene_index)
+    first = ~gene_index.duplicated()
+    set_lengths = numpy.fromiter((len(members) for members in genesets_dict.values()),
+                                 dtype=numpy.int64, count=len(genesets_dict))
+    members = numpy.fromiter(itertools.chain.from_iterable(genesets_dict.values()),
+                             dtype=object, count=set_lengths.sum())
+    columns = gene_index[first].get_indexer(members)
+    rows = numpy.repeat(numpy.arange(len(set_lengths)), set_lengths)
+    found = columns >= 0
+    membership = sparse.csr_matrix((numpy.ones(numpy.count_nonzero(found), dtype=numpy.int8), (rows[found], numpy.flatnonzero(
+        first)[columns[found]])), shape=(len(set_lengths), len(gene_index)))
+    membership.sum_duplicates()
+    membership.data[:] = 1
+    membership.sort_indices()
+    return membership
+
+
+# Group the rows of a CSR membership matrix that have identical members
+# Each row's sorted column indices are hashed as a dict key. Returns the first
+# row of every distinct membership and, for each row, the index of its
+# distinct membership, so per-set work is done once on membership[rows] and
+# fanned back out to every set with results[codes].
+def unique_memberships(membership):
+    distinct = {}
+    codes = numpy.empty(membership.shape[0], dtype=numpy.int64)
+    for row in range(membership.shape[0]):
+        codes[row] = distinct.setdefault(membership.indices[membership.indptr[row]:membership.indptr[row + 1]].tobytes(), len(distinct))
+    rows = numpy.zeros(len(distinct), dtype=numpy.int64)
+    rows[codes[::-1]] = numpy.arange(len(codes))[::-1]
+    return rows, codes
+
+
+# Score many gene sets of the same size from their positions in the ranked list
+# Accepts a (sets x size) array of ascending positions and the per-gene weights
+# of the ranked list. The KS running sum only changes direction at hits, so the
+# statistic is evaluated at the hits instead of over the whole list.
+def _enrichment_at_hits(positions, weights, algorithm):
+    n_genes = len(weights)
+    size = positions.shape[1]
+    hit_weights = weights[positions]
+    total = hit_weights.sum(axis=1, keepdims=True)
+    hit_steps = numpy.divide(hit_weights, total, out=numpy.full(
+        hit_weights.shape, 1 / size), where=total > 0)
+    hit_cdf = numpy.cumsum(hit_steps, axis=1)
+    miss_step = 1 / max(n_genes - size, 1)
+    if algorithm == "ks":
+        # Misses seen up to (and just before) the j-th hit
+        miss_cdf = (positions - numpy.arange(size)) * miss_step
+        peaks = numpy.maximum((hit_cdf - miss_cdf).max(axis=1), 0)
+        troughs = numpy.minimum((hit_cdf - hit_steps - miss_cdf).min(axis=1), 0)
+        return numpy.where(peaks >= -troughs, peaks, troughs)
+    elif algorithm == "ksa":
+        # Closed form of the running sum's area, normalized by the list length
+        remaining = n_genes - positions
+        hit_area = (hit_steps * remaining).sum(axis=1)
+        miss_area = (n_genes * (n_genes + 1) / 2 -
+                     remaining.sum(axis=1)) * miss_step
+        return (hit_area - miss_area) / n_genes
+    else:
+        sys.exit("The python engine does not support the '" + str(algorithm) +
+                 "' algorithm. Supported algorithms are: " + ", ".join(python_engine_algorithms))
+
+
+# Score every row of a CSR membership matrix against the ranked list weights
+# Sets are grouped by size so each group is scored as one dense array. When
+# gene_ranks is given the membership columns are genes in a fixed order and
+# gene_ranks maps each of them to its position in the ranked list.
+def score_gene_sets(membership, weights, algorithm, gene_ranks=None):
+    sizes = numpy.diff(membership.indptr)
+    scores = numpy.zeros(len(sizes))
+    for size in numpy.unique(sizes[sizes > 0]):
+        rows = numpy.flatnonzero(sizes == size)
+        positions = membership.indices[membership.indptr[rows][:, None] +
+                                       numpy.arange(size)]
+        if gene_ranks is not None:
+            positions = gene_ranks[positions]
+            positions.sort(axis=1)
+        scores[rows] = _enrichment_at_hits(positions, weights, algorithm)
+    return scores
+
+
+# Full running enrichment score of a single set over the ranked list
+def running_enrichment(weights, positions):
+    hits = numpy.zeros(len(weights), dtype=bool)
+    hits[positions] = True
+    hit_weights = numpy.where(hits, weights, 0)
+    if hit_weights.sum() > 0:
+        hit_steps = hit_weights / hit_weights.sum()
+    else:
+        hit_steps = hits / max(hits.sum(), 1)
+    miss_steps = ~hits / max(len(weights) - hits.sum(), 1)
+    return numpy.cumsum(hit_steps - miss_steps)
+
+
+# Running enrichment score of every row of a CSR membership matrix at its hits
+# The membership columns are positions in the ranked list. Sets are grouped
+# by size as in score_gene_sets. Returns the running score at each hit in CSR
+# order, the position of each set's peak (the hit with the highest score, or
+# the miss just before the hit with the lowest one, whichever is further from
+# zero; -1 for empty sets) and the running score there.
+def running_enrichment_at_hits(membership, weights):
+    n_genes = len(weights)
+    sizes = numpy.diff(membership.indptr)
+    running_es = numpy.zeros(len(membership.indices))
+    peak = numpy.full(len(sizes), -1, dtype=numpy.int64)
+    peak_es = numpy.zeros(len(sizes))
+    for size in numpy.unique(sizes[sizes > 0]):
+        rows = numpy.flatnonzero(sizes == size)
+        hits = membership.indptr[rows][:, None] + numpy.arange(size)
+        positions = membership.indices[hits].astype(numpy.int64)
+        hit_weights = weights[positions]
+        total = hit_weights.sum(axis=1, keepdims=True)
+        hit_steps = numpy.divide(hit_weights, total, out=numpy.full(
+            hit_weights.shape, 1 / size), where=total > 0)
+        at_hits = numpy.cumsum(hit_steps, axis=1) - (positions - numpy.arange(size)) / max(n_genes - size, 1)
+        before_hits = at_hits - hit_steps
+        running_es[hits] = at_hits
+        highest = at_hits.argmax(axis=1)
+        lowest = before_hits.argmin(axis=1)
+        group = numpy.arange(len(rows))
+        peaks = numpy.maximum(at_hits[group, highest], 0)
+        troughs = numpy.minimum(before_hits[group, lowest], 0)
+        positive = peaks >= -troughs
+        peak[rows] = numpy.where(positive, positions[group, highest], positions[group, lowest] - 1)
+        peak_es[rows] = numpy.where(positive, peaks, troughs)
+    return running_es, peak, peak_es
+
+
+# Save the running enrichment of every set as set_x_running_enrichment.npz
+# The file holds the set names, the ranked features and metric, and per set
+# (in CSR layout over indptr) the ranked positions of its hits and the running
+# score at each, plus the position and value of its peak, so leading edges can
+# be computed without the plot pages. The leading edge of every set is
+# written to set_x_leading_edge.tsv alongside. membership must be over ranked
+# positions.
+def write_running_enrichment(set_names, membership, ranked_metric, weights, output_dir):
+    running_es, peak, peak_es = running_enrichment_at_hits(membership, weights)
+    running = {'sets': numpy.asarray(set_names, dtype=str), 'indptr': membership.indptr.astype(numpy.int64),
+               'positions': membership.indices.astype(numpy.int32), 'running_es': running_es,
+               'peak': peak, 'peak_es': peak_es, 'features': numpy.asarray(ranked_metric.index.values, dtype=str),
+               'metric': ranked_metric.values.astype(float)}
+    numpy.savez(os.path.join(output_dir, 'set_x_running_enrichment.npz'), **running)
+    leading_edge_statistics(running).to_csv(os.path.join(output_dir, 'set_x_leading_edge.tsv'), sep="\t")
+
+
+# Leading edge of every set from its running enrichment arrays
+# Core genes are the hits up to the peak of a positive running score, or past
+# the trough of a negative one, listed in ranked list order. As in GSEA
+# Desktop, Tag % is the share of the set's hits in the core, List % the share
+# of the ranked list up to (or past) the peak and Signal % combines the two
+# as tag * (1 - list) * N / (N - size). All sets are handled in one pass over
+# the hits.
+def leading_edge_statistics(running):
+    n_genes = len(running['features'])
+    sizes = numpy.diff(running['indptr'])
+    rows = numpy.repeat(numpy.arange(len(sizes)), sizes)
+    positions = running['positions']
+    peak = running['peak']
+    positive = running['peak_es'] >= 0
+    core = numpy.where(positive[rows], positions <= peak[rows], positions > peak[rows])
+    core_sizes = numpy.bincount(rows[core], minlength=len(sizes))
+    list_sizes = numpy.where(positive, peak + 1, n_genes - peak - 1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        tag = core_sizes / sizes
+        list_fraction = list_sizes / n_genes
+        signal = tag * (1 - list_fraction) * n_genes / (n_genes - sizes)
+    core_genes = numpy.split(running['features'][positions[core]].astype(object),
+                             numpy.cumsum(core_sizes)[:-1])
+    return pandas.DataFrame({'Size': sizes, 'Peak Rank': peak + 1, 'Peak Enrichment': running['peak_es'],
+                             'Tag %': tag * 100, 'List %': list_fraction * 100, 'Signal %': signal * 100,
+                             'Leading Edge Size': core_sizes,
+                             'Core Enrichment': [",".join(genes) for genes in core_genes]},
+                            index=pandas.Index(running['sets'], name="Set"))
+
+
+# Running enrichment arrays of a ranked list and name:members dict, for runs
+# whose engine does not write them ('ks' and 'ksa' share the running sum)
+def write_ranked_running_enrichment(ranked_metric, genesets_dict, exponent, output_dir):
+    membership = build_membership_matrix(genesets_dict, ranked_metric.index)
+    weights = numpy.abs(ranked_metric.values) ** exponent
+    write_running_enrichment(list(genesets_dict.keys()), membership, ranked_metric, weights, output_dir)
+
+
+# Load set_x_running_enrichment.npz with a set name to row lookup added as 'rows'
+def read_running_enrichment(path):
+    with numpy.load(path) as arrays:
+        running = {name: arrays[name] for name in arrays.files}
+    running['rows'] = {name: row for row, name in enumerate(running['sets'].tolist())}
+    return running
+
+
+# Leading edge overlap analysis
+# The leading edges of the significant sets are packed as rows of a bit
+# matrix over the union of their genes, and pairwise intersections are
+# counted with popcounts of the ANDed rows, one block of rows at a time so the
+# intermediate stays within overlap_block_words words. Sets are then
+# clustered by average linkage on 1 - Jaccard and clusters are cut where the
+# average Jaccard drops below leading_edge_cluster_jaccard.
+overlap_block_words = 1 << 23
+leading_edge_cluster_jaccard = 0.5
+
+
+# Pack lists of genes as the rows of a uint64 bit matrix over the union of
+# their genes, numbered in order of first appearance
+def pack_gene_lists(gene_lists):
+    gene_codes = {}
+    codes = numpy.fromiter((gene_codes.setdefault(gene, len(gene_codes)) for genes in gene_lists
+                            for gene in genes), dtype=numpy.int64)
+    rows = numpy.repeat(numpy.arange(len(gene_lists)), [len(genes) for genes in gene_lists])
+    words = numpy.zeros((len(gene_lists), max(math.ceil(len(gene_codes) / 64), 1)), dtype=numpy.uint64)
+    numpy.bitwise_or.at(words, (rows, codes >> 6), numpy.left_shift(numpy.uint64(1), (codes & 63).astype(numpy.uint64)))
+    return words, list(gene_codes)
+
+
+# Number of set bits along the last axis of a uint64 array
+# Uses numpy.bitwise_count when available, otherwise a table of the bit
+# counts of all 16 bit values.
+_popcount_table = []
+
+
+def bit_counts(words):
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(words).sum(axis=-1, dtype=numpy.int64)
+    if len(_popcount_table) == 0:
+        table = numpy.zeros(1 << 16, dtype=numpy.uint8)
+        for bit in range(16):
+            table[(numpy.arange(1 << 16) >> bit) & 1 == 1] += 1
+        _popcount_table.append(table)
+    return _popcount_table[0][numpy.ascontiguousarray(words).view(numpy.uint16)].sum(axis=-1, dtype=numpy.int64)
+
+
+# Pairwise intersection sizes and Jaccard indices of the rows of a bit matrix
+# Only blocks on and above the diagonal are counted and mirrored below it.
+def bitset_overlap(words):
+    n_sets, n_words = words.shape
+    sizes = bit_counts(words)
+    intersections = numpy.empty((n_sets, n_sets), dtype=numpy.int64)
+    block = max(overlap_block_words // max(n_sets * n_words, 1), 1)
+    for start in range(0, n_sets, block):
+        stop = min(start + block, n_sets)
+        counts = bit_counts(words[start:stop, None, :] & words[None, start:, :])
+        intersections[start:stop, start:] = counts
+        intersections[start:, start:stop] = counts.T
+    union = sizes[:, None] + sizes[None, :] - intersections
+    jaccard = numpy.divide(intersections, union, out=numpy.zeros(intersections.shape), where=union > 0)
+    return intersections, jaccard
+
+
+# Cluster sets by average linkage on Jaccard distance
+# Returns the cluster label of every set and a leaf order that keeps the
+# members of a cluster together.
+def cluster_by_jaccard(jaccard, threshold):
+    if len(jaccard) < 2:
+        return numpy.ones(len(jaccard), dtype=int), numpy.arange(len(jaccard))
+    from scipy.cluster.hierarchy import linkage, fcluster, leaves_list
+    from scipy.spatial.distance import squareform
+    distance = 1 - jaccard
+    numpy.fill_diagonal(distance, 0)
+    tree = linkage(squareform(distance, checks=False), method='average')
+    return fcluster(tree, t=1 - threshold, criterion='distance'), leaves_list(tree)
+
+
+# Leading edge overlap of the sets with an adjusted p-value below fdr
+# stats is set_x_statistic_x_number.tsv and leading_edge set_x_leading_edge.tsv.
+# Writes the pairwise matrices, in cluster order, to
+# set_x_set_x_leading_edge_intersection.tsv and
+# set_x_set_x_leading_edge_jaccard.tsv, and one row per cluster (member count,
+# the member with the largest absolute NES as representative, the mean
+# pairwise Jaccard, the core genes shared by at least half of the members and
+# the member sets) to leading_edge_cluster_x_summary.tsv. Returns the summary,
+# or None when fewer than two sets are significant.
+def write_leading_edge_overlap(stats, leading_edge, output_dir, fdr=0.25):
+    cores = leading_edge['Core Enrichment'].reindex(stats.index)
+    significant = stats.index[(stats['Adjusted P-Value'].values < fdr) & (cores.fillna("").values != "")]
+    if len(significant) < 2:
+        return None
+    gene_lists = [cores[name].split(",") for name in significant]
+    words, genes = pack_gene_lists(gene_lists)
+    intersections, jaccard = bitset_overlap(words)
+    labels, order = cluster_by_jaccard(jaccard, leading_edge_cluster_jaccard)
+    names = significant[order]
+    for values, file_name in [(intersections, 'set_x_set_x_leading_edge_intersection.tsv'),
+                              (jaccard, 'set_x_set_x_leading_edge_jaccard.tsv')]:
+        pandas.DataFrame(values[numpy.ix_(order, order)], index=pandas.Index(names, name="Set"),
+                         columns=names).to_csv(os.path.join(output_dir, file_name), sep="\t")
+    strength = numpy.abs(stats.loc[significant, 'Normalized Enrichment'].values)
+    summary = []
+    for label in numpy.unique(labels):
+        members = numpy.flatnonzero(labels == label)
+        members = members[numpy.argsort(-strength[members], kind='mergesort')]
+        pairs = jaccard[numpy.ix_(members, members)]
+        mean_jaccard = (pairs.sum() - len(members)) / (len(members) * (len(members) - 1)) if len(members) > 1 else 1.0
+        gene_counts = numpy.unpackbits(words[members].view(numpy.uint8), axis=1,
+                                       bitorder='little')[:, :len(genes)].sum(axis=0)
+        shared = numpy.flatnonzero(2 * gene_counts >= len(members))
+        shared = shared[numpy.argsort(-gene_counts[shared], kind='mergesort')]
+        summary.append({'Sets': len(members), 'Representative': significant[members[0]], 'Mean Jaccard': mean_jaccard,
+                        'Shared Core Genes': ",".join(genes[gene] for gene in shared),
+                        'Gene Sets': ",".join(significant[members])})
+    summary = pandas.DataFrame(summary).sort_values('Sets', ascending=False, kind='mergesort')
+    summary.index = pandas.Index(numpy.arange(1, len(summary) + 1), name="Cluster")
+    summary.to_csv(os.path.join(output_dir, 'leading_edge_cluster_x_summary.tsv'), sep="\t")
+    return summary
+
+
+# Draw sorted random gene sets of one size without replacement
+# Uses Floyd's algorithm vectorized over permutations, so the cost scales with
+# nperm x size rather than nperm x list length.
+def _sample_positions(rng, n_genes, size, nperm, selected=None):
+    if selected is None:
+        selected = numpy.zeros((nperm, n_genes), dtype=bool)
+    rows = numpy.arange(nperm)
+    positions = numpy.empty((nperm, size), dtype=numpy.int64)
+    for column, limit in enumerate(range(n_genes - size, n_genes)):
+        draw = rng.integers(0, limit + 1, size=nperm)
+        draw = numpy.where(selected[rows, draw], limit, draw)
+        selected[rows, draw] = True
+        positions[:, column] = draw
+    selected[rows[:, None], positions] = False  # Leave the buffer clean for reuse
+    positions.sort(axis=1)
+    return positions
+
+
+# Gene set permutation null for each set in a CSR membership matrix
+# With set permutation the null of a set only depends on its size and the
+# ranked list weights, so it is drawn once per distinct size and shared by
+# every set of that size. Returns a (sets x nperm) matrix of random scores.
+def set_permutation_null(membership, weights, algorithm, nperm, seed, library=None):
+    sizes = numpy.diff(membership.indptr)
+    distinct_sizes, size_codes = numpy.unique(sizes, return_inverse=True)
+    size_null = size_permutation_null(
+        distinct_sizes, weights, algorithm, nperm, seed, library)
+    return size_null[size_codes.ravel()]
+
+
+# Random enrichment scores for a list of set sizes
+# Each size gets its own generator seeded from (seed, size), so the null of a
+# size does not depend on which other sizes are present in the run.
+# Permutations are drawn in batches to bound the sampling buffer.
+def size_permutation_null(sizes, weights, algorithm, nperm, seed, library=None):
+    return size_permutation_nulls(sizes, numpy.asarray(weights)[None, :], algorithm, nperm, seed, library)[0]
+
+
+# Random enrichment scores for a list of set sizes under several ranked lists
+# Accepts a (lists x genes) weight matrix. Every batch of sampled positions is
+# scored against all of the lists, so the sampling is shared and each list
+# gets exactly the null size_permutation_null would give it on its own.
+# When library is a null library directory (see null_library) the nulls
+# found there are memory mapped instead of drawn, and new ones are added.
+def size_permutation_nulls(sizes, weights, algorithm, nperm, seed, library=None):
+    size_nulls = numpy.zeros((weights.shape[0], len(sizes), nperm))
+    batch_size = min(nperm, permutation_batch_size)
+    selected = numpy.zeros((batch_size, weights.shape[1]), dtype=bool)
+    if library is not None:
+        keys = [null_library_key(list_weights, algorithm, nperm, seed) for list_weights in weights]
+        stored = set()
+    for row, size in enumerate(sizes):
+        if size == 0:
+            continue
+        columns = range(weights.shape[0])
+        if library is not None:
+            entries = [os.path.join(library, key + "_" + str(size)) for key in keys]
+            loaded = {}
+            for column, entry in enumerate(entries):
+                if entry not in loaded:
+                    loaded[entry] = load_cache_entry(entry, ['null'])
+                if loaded[entry] is not None:
+                    size_nulls[column, row] = loaded[entry]['null']
+            columns = [column for column, entry in enumerate(entries) if loaded[entry] is None]
+            if len(columns) == 0:
+                continue
+        rng = numpy.random.default_rng([seed, size])
+        for start in range(0, nperm, batch_size):
+            batch = min(batch_size, nperm - start)
+            positions = _sample_positions(
+                rng, weights.shape[1], size, batch, selected[0:batch])
+            for column in columns:
+                size_nulls[column, row, start:start + batch] = _enrichment_at_hits(
+                    positions, weights[column], algorithm)
+        if library is not None:
+            for column in columns:
+                if entries[column] not in stored:
+                    store_cache_entry(entries[column], {'null': size_nulls[column, row]}, prune=False)
+                    stored.add(entries[column])
+    if library is not None and len(stored) > 0:
+        prune_cache(os.path.dirname(library))
+    return size_nulls
+
+
+# Persistent set permutation null library
+# The random scores of a set size only depend on the algorithm, the ranked
+# list weights, the number of permutations and the seed. With uniform weights
+# ('--exponent 0') the weights reduce to the list length, so the nulls are
+# shared by every ranked list of the same length, e.g. every job on one
+# platform; otherwise the weights are hashed. Each (key, size) null is one
+# cache entry, memory mapped when reused and evicted least recently used
+# first by prune_cache.
+def null_library(settings, cache_dir=None):
+    if not settings.get('null_library', False):
+        return None
+    cache_dir = cache_directory(cache_dir)
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "nulls")
+
+
+# Null library key of one ranked list's weights
+def null_library_key(weights, algorithm, nperm, seed):
+    import hashlib
+    weights = numpy.ascontiguousarray(weights, dtype=numpy.float64)
+    if len(weights) == 0 or numpy.all(weights == weights[0]):
+        weights_key = "uniform"
+    else:
+        weights_key = hashlib.blake2b(weights.tobytes(), digest_size=16).hexdigest()
+    return "_".join([str(algorithm), str(len(weights)), str(nperm), str(seed), weights_key])
+
+
+# Compute a two class ranking metric for many labelings at once
+# Accepts a genes x samples array and a (labelings x samples) boolean matrix
+# flagging the samples of class 1, and returns a genes x labelings matrix of
+# class 1 vs class 0 metrics. Per-class sums and sums of squares for every
+# labeling come from two matrix products. Standard deviations use GSEA
+# Desktop's floor of 0.2 * |mean| (0.2 when the mean is 0).
+def rank_metric_matrix(data, labels, metric):
+    labels = labels.astype(data.dtype)
+    class1_n = labels.sum(axis=1)
+    class0_n = data.shape[1] - class1_n
+    row_means = data.mean(axis=1, keepdims=True)
+    centered = data - row_means  # Centering keeps the sums of squares well conditioned
+    class1_sum = centered @ labels.T
+    class0_sum = centered.sum(axis=1, keepdims=True) - class1_sum
+    class1_mean = class1_sum / class1_n
+    class0_mean = class0_sum / class0_n
+    if metric == "mean-difference":
+        return class1_mean - class0_mean
+    squares = centered ** 2
+    class1_sq = squares @ labels.T
+    class0_sq = squares.sum(axis=1, keepdims=True) - class1_sq
+    class1_var = numpy.maximum(class1_sq - class1_n * class1_mean ** 2, 0) / numpy.maximum(class1_n - 1, 1)
+    class0_var = numpy.maximum(class0_sq - class0_n * class0_mean ** 2, 0) / numpy.maximum(class0_n - 1, 1)
+    class1_sd = _floor_standard_deviation(numpy.sqrt(class1_var), class1_mean + row_means)
+    class0_sd = _floor_standard_deviation(numpy.sqrt(class0_var), class0_mean + row_means)
+    if metric == "signal-to-noise-ratio":
+        return (class1_mean - class0_mean) / (class1_sd + class0_sd)
+    elif metric == "t-test":
+        return (class1_mean - class0_mean) / numpy.sqrt(class1_sd ** 2 / class1_n + class0_sd ** 2 / class0_n)
+    else:
+        sys.exit("The python engine does not support the '" + str(metric) +
+                 "' metric. Supported metrics are: " + ", ".join(python_engine_metrics))
+
+
+def _floor_standard_deviation(standard_deviation, mean):
+    floor = numpy.where(mean == 0, 0.2, 0.2 * numpy.abs(mean))
+    return numpy.maximum(standard_deviation, floor)
+
+
+# Worker state for phenotype permutations, set once per pool process so the
+# expression matrix and membership matrix are not pickled for every chunk.
+# When data is a handoff prefix each worker memory maps it instead.
+_permutation_worker = {}
+
+
+def _init_permutation_worker(data, membership, settings):
+    _permutation_worker['data'] = _engine_values(data)
+    _permutation_worker['membership'] = membership
+    _permutation_worker['settings'] = settings
+
+
+# Score every gene set against the ranked lists of a chunk of labelings
+def _permutation_chunk(labels):
+    data = _permutation_worker['data']
+    membership = _permutation_worker['membership']
+    settings = _permutation_worker['settings']
+    n_genes = data.shape[0]
+    null = numpy.zeros((membership.shape[0], len(labels)))
+    for start in range(0, len(labels), metric_batch_size):
+        metrics = rank_metric_matrix(
+            data, labels[start:start + metric_batch_size], settings['metric'])
+        for column in range(metrics.shape[1]):
+            order = numpy.argsort(-metrics[:, column], kind='mergesort')
+            gene_ranks = numpy.empty(n_genes, dtype=numpy.int64)
+            gene_ranks[order] = numpy.arange(n_genes)
+            weights = numpy.abs(metrics[order, column]) ** settings['exponent']
+            null[:, start + column] = score_gene_sets(
+                membership, weights, settings['algorithm'], gene_ranks)
+    return null
+
+
+# Number of distinct labelings of the samples that keep the class sizes
+def distinct_labelings(class1):
+    class1 = numpy.asarray(class1, dtype=bool)
+    return math.comb(len(class1), int(class1.sum()))
+
+
+# Distinct permuted labelings of the samples for phenotype permutation
+# When the C(n, k) ways to choose the k class 1 samples number at most nperm,
+# every labeling is enumerated once, which gives exact permutation p-values.
+# Otherwise nperm labelings are drawn at random without repeats, duplicate
+# draws being replaced by further draws from the same generator. Returns a
+# (labelings x samples) boolean matrix flagging the class 1 samples.
+def permuted_labelings(class1, nperm, seed):
+    class1 = numpy.asarray(class1, dtype=bool)
+    n_samples, n_class1 = len(class1), int(class1.sum())
+    n_labelings = distinct_labelings(class1)
+    if n_labelings <= nperm:
+        labels = numpy.zeros((n_labelings, n_samples), dtype=bool)
+        for row, chosen in enumerate(itertools.combinations(range(n_samples), n_class1)):
+            labels[row, list(chosen)] = True
+        return labels
+    rng = numpy.random.default_rng(seed)
+    labels = numpy.zeros((0, n_samples), dtype=bool)
+    while len(labels) < nperm:
+        labels = numpy.vstack([labels, rng.permuted(numpy.tile(class1, (nperm - len(labels), 1)), axis=1)])
+        _, first = numpy.unique(numpy.packbits(labels, axis=1), axis=0, return_index=True)
+        labels = labels[numpy.sort(first)]
+    return labels
+
+
+# Phenotype permutation null for each set in a CSR membership matrix
+# All permuted labelings (see permuted_labelings) are built up front as one
+# boolean matrix, then scored in blocks of permutation_block_size labelings,
+# each split into chunks across a process pool of cpu workers. data is a genes x samples array or a handoff
+# prefix, and the membership columns must follow its rows. With a
+# checkpoint_dir every finished block is saved there, so a restarted run with
+# the same inputs and seed resumes after the last saved block and returns the
+# same null. Returns a (sets x labelings) matrix, with fewer than nperm
+# columns when the labelings were enumerated.
+def phenotype_permutation_null(data, class1, membership, settings, cpu=1, checkpoint_dir=None):
+    labels = permuted_labelings(class1, settings['number_of_permutations'], settings['random_seed'])
+    if checkpoint_dir is not None:
+        open_checkpoint(checkpoint_dir, _permutation_checkpoint_key(data, labels, membership, settings))
+    pool = None
+    if cpu > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=cpu, initializer=_init_permutation_worker, initargs=(data, membership, settings))
+        map_chunks = pool.map
+    else:
+        _init_permutation_worker(data, membership, settings)
+        map_chunks = map
+    null = [numpy.zeros((membership.shape[0], 0))]
+    try:
+        for block, start in enumerate(range(0, len(labels), permutation_block_size)):
+            block_null = read_checkpoint_block(checkpoint_dir, block)
+            if block_null is None:
+                chunks = [chunk for chunk in numpy.array_split(labels[start:start + permutation_block_size], max(
+                    cpu, 1) * 4) if len(chunk) > 0]
+                block_null = numpy.hstack(list(map_chunks(_permutation_chunk, chunks)))
+                write_checkpoint_block(checkpoint_dir, block, block_null)
+            null.append(block_null)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return numpy.hstack(null)
+
+
+# Identify the inputs of a phenotype permutation run: the dataset, the
+# permuted labelings (which follow from the class labels and seed), the gene
+# set membership and the scoring settings. A handoff dataset is identified by
+# the path, size and modification time of its files, which places the key in
+# the job directory without reading the matrix; only an in-memory dataset
+# has its values hashed.
+def _permutation_checkpoint_key(data, labels, membership, settings):
+    import hashlib
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(data, str):
+        for suffix in ['.npy', '.rows.tsv', '.columns.tsv']:
+            stat = os.stat(data + suffix)
+            digest.update(json.dumps([os.path.abspath(data + suffix), stat.st_size, stat.st_mtime_ns]).encode())
+    else:
+        values = _engine_values(data)
+        digest.update(str(values.shape).encode())
+        for start in range(0, values.shape[0], 1024):
+            digest.update(numpy.ascontiguousarray(values[start:start + 1024]).tobytes())
+    for array in [labels, membership.indptr, membership.indices]:
+        digest.update(numpy.ascontiguousarray(array).tobytes())
+    digest.update(json.dumps([settings['metric'], settings['algorithm'], settings['exponent'],
+                              permutation_block_size]).encode())
+    return digest.hexdigest()
+
+
+# Prepare a checkpoint directory for a run identified by key, discarding
+# blocks left by a run with different inputs
+def open_checkpoint(checkpoint_dir, key):
+    import shutil
+    key_path = os.path.join(checkpoint_dir, 'checkpoint.json')
+    if os.path.exists(key_path):
+        with open(key_path) as f:
+            if json.load(f).get('key') == key:
+                return
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with open(key_path, 'w') as f:
+        json.dump({'key': key}, f)
+
+
+# Saved result of a checkpointed block, or None if it has not been run yet
+def read_checkpoint_block(checkpoint_dir, block):
+    if checkpoint_dir is None:
+        return None
+    path = os.path.join(checkpoint_dir, 'block_' + str(block) + '.npy')
+    if not os.path.exists(path):
+        return None
+    try:
+        return numpy.load(path)
+    except (OSError, ValueError):
+        return None
+
+
+# Save the result of a block, renamed into place so an interrupted write is
+# never mistaken for a finished block
+def write_checkpoint_block(checkpoint_dir, block, values):
+    if checkpoint_dir is None:
+        return
+    path = os.path.join(checkpoint_dir, 'block_' + str(block) + '.npy')
+    with open(path + '.tmp', 'wb') as f:
+        numpy.save(f, values)
+    os.replace(path + '.tmp', path)
+
+
+# Benjamini-Hochberg adjustment of a vector of p-values
+def adjust_pvalues(pvalues):
+    pvalues = numpy.asarray(pvalues, dtype=float)
+    if len(pvalues) == 0:
+        return pvalues
+    order = numpy.argsort(pvalues)
+    ranked = pvalues[order] * len(pvalues) / numpy.arange(1, len(pvalues) + 1)
+    ranked = numpy.minimum.accumulate(ranked[::-1])[::-1]
+    adjusted = numpy.empty_like(ranked)
+    adjusted[order] = numpy.minimum(ranked, 1)
+    return adjusted
+
+
+# Normalize enrichment scores and compute p-values against each set's null
+# Positive and negative scores are compared with the same-signed side of the
+# null, as in GSEA Desktop, and adjusted separately for each direction.
+def enrichment_statistics(set_names, scores, null):
+    return summary_statistics(set_names, scores, null_summary(scores, null))
+
+
+# Per-set counts and sums of a null that enrichment statistics need
+# Holds the number of same-signed null scores, their sum and the number of
+# them at least as extreme as the set's score. Summaries of successive nulls
+# of the same sets add up to the summary of the combined null.
+def null_summary(scores, null):
+    positive = scores >= 0
+    same_sign = numpy.where(positive[:, None], null >= 0, null < 0)
+    exceeding = numpy.where(positive[:, None], null >= scores[:, None], null <= scores[:, None]) & same_sign
+    return {'count': same_sign.sum(axis=1), 'sum': numpy.where(same_sign, null, 0).sum(axis=1),
+            'exceeding': exceeding.sum(axis=1)}
+
+
+# Enrichment statistics from the null summaries of the sets
+# When the summary records the permutations each set used (see
+# sequential_null_summary) they are reported in a 'Permutations' column.
+def summary_statistics(set_names, scores, summary):
+    positive = scores >= 0
+    null_means = numpy.abs(summary['sum']) / numpy.maximum(summary['count'], 1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        normalized = numpy.where(null_means > 0, scores / null_means, numpy.nan)
+        pvalues = numpy.where(summary['count'] > 0, summary['exceeding'] / summary['count'], numpy.nan)
+    adjusted = numpy.full(len(scores), numpy.nan)
+    for direction in [positive, ~positive]:
+        testable = direction & ~numpy.isnan(pvalues)
+        adjusted[testable] = adjust_pvalues(pvalues[testable])
+    stats = pandas.DataFrame({'Enrichment': scores, 'Normalized Enrichment': normalized,
+                             'P-Value': pvalues, 'Adjusted P-Value': adjusted}, index=pandas.Index(set_names, name="Set"))
+    if 'permutations' in summary:
+        stats['Permutations'] = summary['permutations']
+    return stats
+
+
+# Adaptive sequential permutation (Besag-Clifford)
+# Starting from the null summary of the first number_of_permutations, sets
+# keep drawing permutations in rounds until number_of_exceedances null
+# scores at least as extreme as their own have been seen, or the total
+# reaches maximum_number_of_permutations. Each round doubles the total, so
+# sets that are clearly not significant stop after the first round while
+# significant ones get fine p-values. draw_null(rows, seed, nperm, round)
+# returns a (rows x permutations) null for a subset of the sets, and may
+# return fewer than nperm permutations when it has exhausted them. When the
+# settings give the number_of_labelings a phenotype permutation can draw, a
+# round that would reach it enumerates them all instead, and that exact null
+# replaces the random draws of the active sets. Returns the summary with the
+# permutations used by each set.
+def sequential_null_summary(scores, null, draw_null, settings):
+    summary = null_summary(scores, null)
+    summary['permutations'] = numpy.full(len(scores), null.shape[1], dtype=numpy.int64)
+    total = null.shape[1]
+    maximum = settings['maximum_number_of_permutations']
+    labelings = settings.get('number_of_labelings')
+    for round in itertools.count(1):
+        active = numpy.flatnonzero(summary['exceeding'] < settings['number_of_exceedances'])
+        if total >= maximum or len(active) == 0 or (labelings is not None and total >= labelings):
+            break
+        nperm = min(total, maximum - total)
+        seed = int(numpy.random.SeedSequence([settings['random_seed'], round]).generate_state(1)[0])
+        if labelings is not None and total + nperm >= labelings:
+            for key, values in null_summary(scores[active], draw_null(active, seed, labelings, round)).items():
+                summary[key][active] = values
+            summary['permutations'][active] = labelings
+            break
+        round_null = draw_null(active, seed, nperm, round)
+        for key, values in null_summary(scores[active], round_null).items():
+            summary[key][active] += values
+        summary['permutations'][active] += round_null.shape[1]
+        total += round_null.shape[1]
+        if round_null.shape[1] < nperm:
+            break
+    return summary
+
+
+# Enrichment statistics of every set from the scores and first null of its
+# distinct membership (see unique_memberships), fanned out with codes
+# Adaptive permutation runs when maximum_number_of_permutations exceeds the
+# first null, unless that null already holds every phenotype labeling.
+def engine_statistics(set_names, scores, null, codes, settings, draw_null):
+    if settings.get('maximum_number_of_permutations', 0) <= settings['number_of_permutations'] or \
+            null.shape[1] < settings['number_of_permutations']:
+        stats = enrichment_statistics(set_names, scores[codes], null[codes])
+    else:
+        summary = sequential_null_summary(scores, null, draw_null, settings)
+        stats = summary_statistics(set_names, scores[codes], {key: values[codes] for key, values in summary.items()})
+    if settings.get('tail_pvalues', False):
+        permutations = stats['Permutations'].values if 'Permutations' in stats else numpy.full(len(stats), null.shape[1])
+        exact = permutations >= settings.get('number_of_labelings', numpy.inf)
+        stats['Tail P-Value'], stats['Tail Fit'] = tail_pvalues(scores[codes], null[codes], stats['P-Value'].values, exact)
+    return stats
+
+
+tail_exceedances = 10
+tail_size = 250
+tail_minimum_size = 50
+tail_fit_pvalue = 0.05
+
+
+# Generalized Pareto fit to the upper tail of a sample of null scores
+# The tail starts as the tail_size largest values (at most a quarter of the
+# sample) and shrinks by 10 until a Kolmogorov-Smirnov test no longer rejects
+# the fit at tail_fit_pvalue, as in Knijnenburg et al. (2009). A negative
+# shape is kept, so the fitted tail may be bounded. Returns the tail
+# threshold, the fraction of the sample above it, the shape and scale of the
+# last fit, whether it passed and the mean excess over the threshold, or None
+# when the sample is too small.
+def fit_null_tail(values):
+    from scipy.stats import genpareto, kstest
+    values = numpy.sort(values)[::-1]
+    fit = None
+    for size in range(min(tail_size, len(values) // 4), tail_minimum_size - 1, -10):
+        threshold = (values[size - 1] + values[size]) / 2
+        excesses = values[:size] - threshold
+        shape, _, scale = genpareto.fit(excesses, floc=0)
+        good = kstest(excesses, 'genpareto', args=(shape, 0, scale)).pvalue >= tail_fit_pvalue
+        fit = (threshold, size / len(values), shape, scale, good, excesses.mean())
+        if good:
+            break
+    return fit
+
+
+# Tail approximated p-values for sets whose scores lie beyond most of their null
+# Sets exceeded by fewer than tail_exceedances same-signed null scores get
+# the fraction of the null in the tail times the generalized Pareto survival
+# of their excess over the tail threshold, which resolves p-values far below
+# 1 / nperm. Past the end point of a bounded (negative shape) fit, where its
+# survival is 0, the exponential tail with the same mean excess is used
+# instead. The other sets keep their empirical p-value, and so do the sets
+# flagged in exact, whose null enumerated every phenotype labeling. A fit
+# only depends on the null, so identical nulls (every set of a size under set
+# permutation) are fitted once. Returns the p-values and a 'good', 'poor'
+# (the goodness of fit test rejected every tail size), 'beyond-endpoint',
+# 'empirical' or 'exact' flag.
+def tail_pvalues(scores, null, pvalues, exact=None):
+    from scipy.stats import genpareto
+    tail = numpy.array(pvalues, dtype=float)
+    fit_flags = numpy.full(len(scores), "empirical", dtype=object)
+    if exact is not None:
+        fit_flags[exact] = "exact"
+    fits = {}
+    for row, score in enumerate(scores):
+        if fit_flags[row] == "exact":
+            continue
+        side = null[row][null[row] >= 0] if score >= 0 else -null[row][null[row] < 0]
+        if numpy.count_nonzero(side >= abs(score)) >= tail_exceedances:
+            continue
+        key = (score >= 0, side.tobytes())
+        if key not in fits:
+            fits[key] = fit_null_tail(side)
+        if fits[key] is None or abs(score) <= fits[key][0]:
+            continue
+        threshold, fraction, shape, scale, good, mean_excess = fits[key]
+        if shape < 0 and abs(score) - threshold >= -scale / shape:
+            tail[row] = fraction * numpy.exp(-(abs(score) - threshold) / mean_excess)
+            fit_flags[row] = "beyond-endpoint"
+        else:
+            tail[row] = fraction * genpareto.sf(abs(score) - threshold, shape, 0, scale)
+            fit_flags[row] = "good" if good else "poor"
+    return tail, fit_flags
+
+
+# Choose the sets that get an enrichment plot, the top n in each direction
+def select_sets_to_plot(stats, nplot, candidates=None):
+    if candidates is not None:
+        stats = stats[stats.index.isin(candidates)]
+    positive = stats[stats['Enrichment'] > 0].sort_values(
+        'Normalized Enrichment', ascending=False)
+    negative = stats[stats['Enrichment'] < 0].sort_values(
+        'Normalized Enrichment', ascending=True)
+    return positive.index[0:nplot].to_list() + negative.index[0:nplot].to_list()
+
+
+# Plot the running enrichment score of a set along the ranked list
+def plot_set_enrichment(ranked_metric, positions, running_es, set_name, high_text, low_text):
+    rank = numpy.arange(1, len(ranked_metric) + 1)
+    fig = make_subplots(rows=3, cols=1, shared_xaxes=True, row_heights=[
+                        0.5, 0.15, 0.35], vertical_spacing=0.02)
+    fig.append_trace(go.Scatter(x=rank, y=running_es, mode='lines', line=dict(
+        color='#20d9ba', width=2), name='Running ES', text=ranked_metric.index.values), row=1, col=1)
+    fig.append_trace(go.Scatter(x=positions + 1, y=numpy.zeros(len(positions)), mode='markers', marker=dict(symbol='line-ns-open', size=24, color='black'),
+                                name='Set Members', text=ranked_metric.index.values[positions], hovertemplate="%{text}<br>Rank %{x}"), row=2, col=1)
+    fig.append_trace(go.Scatter(x=rank, y=ranked_metric.values, mode='lines', fill='tozeroy', line=dict(
+        color='grey', width=1), name='Ranking Metric', text=ranked_metric.index.values), row=3, col=1)
+    fig = fig.update_layout(title=set_name, showlegend=False, yaxis=dict(title="Enrichment Score"), yaxis2=dict(showticklabels=False), yaxis3=dict(title="Ranking Metric"),
+                            xaxis3=dict(title=str(high_text) + " <-- Rank in Gene List --> " + str(low_text)), margin=dict(autoexpand=True, t=48), height=800, width=1280)
+    return fig.to_html(full_html=True, include_plotlyjs='cdn')
+
+
+# Run preranked (gene set permutation) GSEA in-process
+# Accepts a ranked list (first column, or the handoff prefix of one), the filtered name:members dict and the
+# settings dict that is also passed to GSEA.jl, and writes
+# set_x_statistic_x_number.tsv, set_x_index_x_enrichment.tsv and the enrichment
+# plot pages to output_dir. P-values come from the adaptive sequential null
+# when the settings ask for it (see engine_statistics).
+def run_prerank_engine(ranked_genes, genesets_dict, settings, output_dir):
+    ranked_metric = ranked_list(ranked_genes)
+    weights = numpy.abs(ranked_metric.values) ** settings['exponent']
+    set_names = list(genesets_dict.keys())
+    membership = build_membership_matrix(genesets_dict, ranked_metric.index)
+    unique_rows, codes = unique_memberships(membership)
+    unique_membership = membership[unique_rows]
+    library = null_library(settings)
+    scores = score_gene_sets(unique_membership, weights, settings['algorithm'])
+    null = set_permutation_null(unique_membership, weights, settings['algorithm'],
+                                settings['number_of_permutations'], settings['random_seed'], library)
+
+    # Adaptive rounds draw from their own seeds and are not kept in the library
+    def draw_null(rows, seed, nperm, round):
+        return set_permutation_null(unique_membership[rows], weights, settings['algorithm'], nperm, seed)
+    stats = engine_statistics(set_names, scores, null, codes, settings, draw_null)
+    write_engine_results(stats, null[codes], ranked_metric, membership, weights, settings, output_dir)
+    return stats
+
+
+# The first column of a preranked list (or the handoff prefix of one) as a
+# float Series sorted in decreasing order, ties kept in list order
+def ranked_list(ranked_genes):
+    ranked_genes = _engine_dataset(ranked_genes)
+    ranked_genes = ranked_genes.iloc[:, [0]].sort_values(
+        ranked_genes.columns[0], ascending=False, kind='mergesort')
+    return ranked_genes.iloc[:, 0].astype(float)
+
+
+# Result directory of each contrast in a batch run, numbered like the plot pages
+def contrast_directories(contrasts, root_dir):
+    return {contrast: os.path.join(root_dir, str(index + 1) + "_" + re.sub(r'[^0-9a-z._-]+', '_', str(contrast).lower()))
+            for index, contrast in enumerate(contrasts)}
+
+
+# Run preranked GSEA in-process for every column of a ranked matrix
+# Each column is one contrast. The gene index and membership matrix are built
+# once, and the set permutations for each size are sampled once per block of
+# contrast_batch_size contrasts and scored against all of them, so each
+# contrast gets the same results as a run_prerank_engine call on its column.
+# The usual result files are written to one directory per contrast (see
+# contrast_directories) and the NES of every set in every contrast to
+# set_x_contrast_x_normalized_enrichment.tsv.
+def run_prerank_batch_engine(ranked_genes, genesets_dict, settings, output_dir):
+    ranked_genes = _engine_dataset(ranked_genes)
+    values = numpy.asarray(ranked_genes.values, dtype=float)
+    n_genes = values.shape[0]
+    set_names = list(genesets_dict.keys())
+    membership = build_membership_matrix(genesets_dict, ranked_genes.index)
+    unique_rows, codes = unique_memberships(membership)
+    distinct_sizes, size_codes = numpy.unique(
+        numpy.diff(membership.indptr), return_inverse=True)
+    directories = contrast_directories(ranked_genes.columns, output_dir)
+    library = null_library(settings)
+    normalized = {}
+    for block in range(0, values.shape[1], contrast_batch_size):
+        columns = numpy.arange(block, min(block + contrast_batch_size, values.shape[1]))
+        orders = numpy.argsort(-values[:, columns], axis=0, kind='mergesort')
+        weights = numpy.abs(numpy.take_along_axis(
+            values[:, columns], orders, axis=0).T) ** settings['exponent']
+        size_nulls = size_permutation_nulls(distinct_sizes, weights, settings['algorithm'],
+                                            settings['number_of_permutations'], settings['random_seed'], library)
+        for offset, column in enumerate(columns):
+            contrast = ranked_genes.columns[column]
+            order = orders[:, offset]
+            gene_ranks = numpy.empty(n_genes, dtype=numpy.int64)
+            gene_ranks[order] = numpy.arange(n_genes)
+            ranked_membership = membership.copy()
+            ranked_membership.indices = gene_ranks[membership.indices].astype(membership.indices.dtype)
+            ranked_membership.has_sorted_indices = False
+            ranked_membership.sort_indices()
+            ranked_metric = pandas.Series(values[order, column], index=pandas.Index(
+                ranked_genes.index.values[order], name=ranked_genes.index.name), name=contrast)
+            scores = score_gene_sets(ranked_membership[unique_rows], weights[offset], settings['algorithm'])[codes]
+            null = size_nulls[offset][size_codes.ravel()]
+            stats = enrichment_statistics(set_names, scores, null)
+            if settings.get('tail_pvalues', False):
+                stats['Tail P-Value'], stats['Tail Fit'] = tail_pvalues(scores, null, stats['P-Value'].values)
+            os.makedirs(directories[contrast], exist_ok=True)
+            write_engine_results(stats, null, ranked_metric, ranked_membership,
+                                 weights[offset], settings, directories[contrast])
+            normalized[contrast] = stats['Normalized Enrichment']
+    normalized = pandas.DataFrame(normalized, index=pandas.Index(set_names, name="Set"),
+                                  columns=ranked_genes.columns)
+    normalized.to_csv(os.path.join(
+        output_dir, 'set_x_contrast_x_normalized_enrichment.tsv'), sep="\t")
+    return normalized
+
+
+# Run two class (metric-rank) GSEA in-process
+# Accepts the expression dataset, the phenotypes table with 0/1 'Phenotypes'
+# matched to the dataset columns, the filtered name:members dict and the
+# settings dict passed to GSEA.jl. Genes are ranked by the class 1 vs class 0
+# metric and the null is drawn by phenotype ('sample') or gene set ('set')
+# permutation. Writes feature_x_metric_x_score.tsv alongside the files
+# written by run_prerank_engine. When input_ds is a handoff prefix the pool
+# workers memory map the dataset rather than receiving a copy. Phenotype
+# permutations are checkpointed to checkpoint_dir when one is given, and the
+# checkpoint is removed once the results are written. Both permutation types
+# support adaptive sequential permutation (see engine_statistics).
+def run_metric_rank_engine(input_ds, phenotypes, genesets_dict, settings, output_dir, cpu=1, checkpoint_dir=None):
+    handoff = input_ds if isinstance(input_ds, str) else None
+    input_ds = _engine_dataset(input_ds)
+    data = _engine_values(input_ds.values)
+    class1 = phenotypes['Phenotypes'].values.astype(int) == 1
+    metric = rank_metric_matrix(data, class1[None, :], settings['metric'])[:, 0]
+    order = numpy.argsort(-metric, kind='mergesort')
+    ranked_metric = pandas.Series(metric[order], index=pandas.Index(
+        input_ds.index.values[order], name=settings['feature_name']), name=settings['score_name'])
+    ranked_metric.to_frame().to_csv(os.path.join(
+        output_dir, 'feature_x_metric_x_score.tsv'), sep="\t")
+    weights = numpy.abs(ranked_metric.values) ** settings['exponent']
+    set_names = list(genesets_dict.keys())
+    membership = build_membership_matrix(genesets_dict, ranked_metric.index)
+    unique_rows, codes = unique_memberships(membership)
+    unique_membership = membership[unique_rows]
+    scores = score_gene_sets(unique_membership, weights, settings['algorithm'])
+    if settings['permutation'] == "set":
+        library = null_library(settings)
+        null = set_permutation_null(unique_membership, weights, settings['algorithm'],
+                                    settings['number_of_permutations'], settings['random_seed'], library)
+
+        # Adaptive rounds draw from their own seeds and are not kept in the library
+        def draw_null(rows, seed, nperm, round):
+            return set_permutation_null(unique_membership[rows], weights, settings['algorithm'], nperm, seed)
+    else:
+        # Permuted lists are ranked from the dataset rows in their own order
+        data_membership = build_membership_matrix(genesets_dict, input_ds.index)[unique_rows]
+        null = phenotype_permutation_null(
+            handoff or data, class1, data_membership, settings, cpu, checkpoint_dir)
+
+        # Later adaptive rounds are checkpointed to their own subdirectories
+        # and stop at the distinct labelings of the samples
+        settings = dict(settings, number_of_labelings=distinct_labelings(class1))
+
+        def draw_null(rows, seed, nperm, round):
+            return phenotype_permutation_null(
+                handoff or data, class1, data_membership[rows], dict(settings, random_seed=seed, number_of_permutations=nperm),
+                cpu, None if checkpoint_dir is None else os.path.join(checkpoint_dir, 'round_' + str(round)))
+    stats = engine_statistics(set_names, scores, null, codes, settings, draw_null)
+    write_engine_results(stats, null[codes], ranked_metric, membership, weights, settings, output_dir)
+    if checkpoint_dir is not None:
+        import shutil
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    return stats
+
+
+# Worker state for single sample scoring, set once per pool process. When
+# values is a handoff prefix each worker memory maps it instead.
+_data_rank_worker = {}
+
+
+def _init_data_rank_worker(values, membership, settings):
+    _data_rank_worker['values'] = _engine_values(values)
+    _data_rank_worker['membership'] = membership
+    _data_rank_worker['settings'] = settings
+
+
+# Score every gene set in every sample of a chunk of sample columns
+# Each sample column is ranked by one argsort over the chunk. The 'ksa' area
+# is linear in per-gene terms, so it is computed for all sets and samples with
+# three sparse products; 'ks' needs the hits in rank order and is scored per
+# sample.
+def _data_rank_chunk(columns):
+    values = numpy.asarray(_data_rank_worker['values'][:, columns])
+    membership = _data_rank_worker['membership']
+    settings = _data_rank_worker['settings']
+    n_genes, n_samples = values.shape
+    order = numpy.argsort(-values, axis=0, kind='mergesort')
+    gene_ranks = numpy.empty(values.shape, dtype=numpy.int64)
+    numpy.put_along_axis(gene_ranks, order, numpy.arange(n_genes)[:, None], axis=0)
+    weights = numpy.abs(values) ** settings['exponent']
+    if settings['algorithm'] == "ksa":
+        sizes = numpy.diff(membership.indptr)[:, None].astype(float)
+        remaining = n_genes - gene_ranks
+        hit_weight = membership @ weights
+        hit_area = membership @ (weights * remaining)
+        remaining_sum = membership @ remaining
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            hit_area = numpy.where(hit_weight > 0, hit_area / hit_weight, remaining_sum / sizes)
+        miss_area = (n_genes * (n_genes + 1) / 2 - remaining_sum) / numpy.maximum(n_genes - sizes, 1)
+        return numpy.where(sizes > 0, (hit_area - miss_area) / n_genes, 0)
+    scores = numpy.zeros((membership.shape[0], n_samples))
+    for sample in range(n_samples):
+        scores[:, sample] = score_gene_sets(membership, weights[order[:, sample], sample],
+                                            settings['algorithm'], gene_ranks[:, sample])
+    return scores
+
+
+# Run single sample GSEA (data-rank) in-process
+# Accepts the genes x samples dataset, the filtered name:members dict and the
+# settings dict passed to GSEA.jl, scores every set in every sample and writes
+# set_x_sample_x_enrichment.tsv. Sample chunks are spread over a process pool
+# of cpu workers, which memory map the dataset when input_ds is a handoff prefix.
+def run_data_rank_engine(input_ds, genesets_dict, settings, output_dir, cpu=1):
+    handoff = input_ds if isinstance(input_ds, str) else None
+    input_ds = _engine_dataset(input_ds)
+    values = _engine_values(input_ds.values)
+    membership = build_membership_matrix(genesets_dict, input_ds.index)
+    unique_rows, codes = unique_memberships(membership)
+    membership = membership[unique_rows]
+    n_chunks = max(max(cpu, 1) * 4, math.ceil(values.shape[1] / sample_batch_size))
+    chunks = [chunk for chunk in numpy.array_split(
+        numpy.arange(values.shape[1]), n_chunks) if len(chunk) > 0]
+    if cpu > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=cpu, initializer=_init_data_rank_worker, initargs=(handoff or values, membership, settings)) as pool:
+            scores = list(pool.map(_data_rank_chunk, chunks))
+    else:
+        _init_data_rank_worker(values, membership, settings)
+        scores = [_data_rank_chunk(chunk) for chunk in chunks]
+    scores = pandas.DataFrame(numpy.hstack([numpy.zeros((membership.shape[0], 0))] + scores)[codes],
+                              index=pandas.Index(list(genesets_dict.keys()), name="Set"), columns=input_ds.columns)
+    scores.to_csv(os.path.join(output_dir, 'set_x_sample_x_enrichment.tsv'), sep="\t")
+    return scores
+
+
+# Write the engine result tables, running enrichment arrays and enrichment
+# plots in the GSEA.jl layout
+def write_engine_results(stats, null, ranked_metric, membership, weights, settings, output_dir):
+    set_names = stats.index.to_list()
+    order = numpy.argsort(-stats['Enrichment'].values, kind='mergesort')
+    stats = stats.iloc[order]
+    stats.to_csv(os.path.join(output_dir, 'set_x_statistic_x_number.tsv'), sep="\t")
+    null_df = pandas.DataFrame(null[order], index=stats.index, columns=numpy.arange(1, null.shape[1] + 1))
+    null_df.to_csv(os.path.join(output_dir, 'set_x_index_x_enrichment.tsv'), sep="\t")
+    write_running_enrichment(set_names, membership, ranked_metric, weights, output_dir)
+    write_engine_plots(stats, ranked_metric, membership, set_names, weights, settings, output_dir)
+
+
+# Write the enrichment plots of the top sets in the GSEA.jl layout
+# stats is the table as written to set_x_statistic_x_number.tsv and set_names
+# gives the set of each membership row.
+def write_engine_plots(stats, ranked_metric, membership, set_names, weights, settings, output_dir, candidates=None):
+    plot_paths = enumerate_plot_paths(stats, output_dir)
+    set_rows = {name: row for row, name in enumerate(set_names)}
+    for set_name in select_sets_to_plot(stats, settings['number_of_sets_to_plot'], candidates):
+        row = set_rows[set_name]
+        positions = membership.indices[membership.indptr[row]:membership.indptr[row + 1]]
+        with open(plot_paths[set_name], 'w') as f:
+            f.write(plot_set_enrichment(ranked_metric, positions, running_enrichment(
+                weights, positions), set_name, settings['high_text'], settings['low_text']))
+
+
+# Engine jobs
+# A job is a JSON serializable dict describing one enrichment run: the gsea
+# subcommand ('user-rank', 'metric-rank' or 'data-rank', or 'user-rank-batch'
+# for a python engine batch of preranked contrasts), the engine, the
+# absolute output directory and either the gsea command line (julia engine)
+# or the dataset handoff prefix, settings, filtered gene sets, phenotypes and
+# permutation checkpoint directory (python engine). Jobs can be executed in-process or submitted to a warm
+# engine server listening on a Unix domain socket. Only the python engine
+# runs warm there; julia jobs still start a fresh gsea process.
+def engine_job(command, engine, directory, arguments=None, dataset=None, gene_sets=None, settings=None, phenotypes=None, cpu=1, checkpoint=None):
+    job = {'command': command, 'engine': engine,
+           'directory': os.path.abspath(directory), 'cpu': cpu}
+    if engine == "python":
+        job['dataset'] = os.path.join(job['directory'], dataset)
+        job['gene_sets'] = gene_sets
+        job['settings'] = settings
+        if phenotypes is not None:
+            job['phenotypes'] = [int(phenotype) for phenotype in phenotypes]
+        if checkpoint is not None:
+            job['checkpoint'] = os.path.join(job['directory'], checkpoint)
+    else:
+        job['arguments'] = [str(argument) for argument in arguments]
+    return job
+
+
+engine_commands = {'python': ['user-rank', 'user-rank-batch', 'metric-rank', 'data-rank'],
+                   'julia': ['user-rank', 'metric-rank', 'data-rank']}
+
+
+# Check that a job runs a known engine entry point on its own directory
+# Julia jobs may only run the gsea command with the job's subcommand and
+# directory, and python jobs may only read their dataset and checkpoint from
+# inside that directory. Anything else exits without running, since jobs
+# also arrive from other processes through the engine server socket.
+def validate_engine_job(job):
+    directory = job.get('directory')
+    if not isinstance(directory, str) or not os.path.isabs(directory) or not os.path.isdir(directory):
+        sys.exit("The engine job directory must be an existing absolute path.")
+    if job.get('engine') not in engine_commands or job.get('command') not in engine_commands[job['engine']]:
+        sys.exit("Unknown engine command '" + str(job.get('command')) + "' for engine '" + str(job.get('engine')) + "'.")
+    if job['engine'] == "python":
+        root = os.path.realpath(directory)
+        for path in [job.get('dataset'), job.get('checkpoint', directory)]:
+            if not isinstance(path, str) or os.path.commonpath([root, os.path.realpath(path)]) != root:
+                sys.exit("Engine job inputs must be inside the job directory " + directory + ".")
+    else:
+        arguments = job.get('arguments')
+        if not isinstance(arguments, list) or arguments[0:3] != ['gsea', job['command'], directory] or \
+                not all(isinstance(argument, str) for argument in arguments):
+            sys.exit("Julia engine jobs must run 'gsea " + job['command'] + "' on the job directory.")
+
+
+# Execute an engine job in the current process
+def execute_engine_job(job):
+    validate_engine_job(job)
+    if job['engine'] != "python":
+        import subprocess
+        subprocess.check_output(job['arguments'], cwd=job['directory'])
+    elif job['command'] == "user-rank":
+        run_prerank_engine(job['dataset'], job['gene_sets'], job['settings'], job['directory'])
+    elif job['command'] == "user-rank-batch":
+        run_prerank_batch_engine(job['dataset'], job['gene_sets'], job['settings'], job['directory'])
+    elif job['command'] == "metric-rank":
+        phenotypes = pandas.DataFrame({'Phenotypes': job['phenotypes']})
+        run_metric_rank_engine(job['dataset'], phenotypes, job['gene_sets'], job['settings'],
+                               job['directory'], cpu=job['cpu'], checkpoint_dir=job.get('checkpoint'))
+    elif job['command'] == "data-rank":
+        run_data_rank_engine(job['dataset'], job['gene_sets'], job['settings'],
+                             job['directory'], cpu=job['cpu'])
+    else:
+        sys.exit("Unknown engine command '" + str(job['command']) + "'.")
+
+
+# Send a job to the engine server at socket_path and wait for it to finish
+# Jobs travel as one line of JSON and the server answers with one line of
+# JSON. Returns False when no server is reachable so the caller can run the
+# job itself, and exits if the server reports that the job failed.
+def submit_engine_job(job, socket_path):
+    import socket
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+    except OSError:
+        return False
+    with connection, connection.makefile('rw') as stream:
+        stream.write(json.dumps(job) + "\n")
+        stream.flush()
+        reply = stream.readline()
+    if reply == "":
+        sys.exit("The engine server at " + socket_path + " closed the connection before the job finished.")
+    reply = json.loads(reply)
+    if reply['status'] != "ok":
+        sys.exit("The engine server failed to run the job:\n" + str(reply['message']))
+    return True
+
+
+# Run a job on the engine server when one is configured and listening,
+# otherwise run it in this process (or as a gsea subprocess for julia)
+# With memoize the job's results are kept in the stage cache (see
+# engine_stage_entry), and a job whose inputs were already run restores them
+# instead of running again.
+def run_engine_job(job, socket_path=None, memoize=False, cache_dir=None):
+    entry = engine_stage_entry(job, cache_dir) if memoize else None
+    if entry is not None and restore_stage_entry(entry, job['directory']):
+        if job['engine'] == "python" and job['command'] in replotted_engine_commands:
+            plot_engine_job(job)
+        return
+    if not (socket_path and submit_engine_job(job, socket_path)):
+        execute_engine_job(job)
+    if entry is not None:
+        store_stage_entry(entry, job['directory'], engine_job_outputs(job), {
+            'command': job['command'], 'engine': job['engine'], 'directory': job['directory']})
+
+
+# Stage memoization
+# Parsing and collapsing the dataset is cached by read_input_dataset, gene
+# set and CHIP parsing by their own caches, and filtering the gene sets is a
+# single pass over the membership matrix that is cheaper to redo than to
+# load. The engine stage carries the permutation workload, so its results are
+# cached under a content hash of everything that determines them: the
+# command, the engine, the input files, gene sets, phenotypes and settings.
+# Settings that only select what gets plotted are left out of the hash for
+# the python engine commands whose plots are redrawn from the cached tables,
+# so changing --nplot reuses the permutations. The julia engine draws its own
+# plots, so all of its arguments are part of the hash. Entries live in the
+# stages/ directory of the cache and are bounded by least recently used
+# eviction (see prune_cache).
+replotted_engine_commands = ["user-rank", "metric-rank"]
+plot_settings = ['number_of_sets_to_plot', 'more_sets_to_plot', 'gene_sets_to_plot', 'number_of_jobs']
+
+
+# Cache entry of an engine job, or None when caching is unavailable
+def engine_stage_entry(job, cache_dir=None):
+    import hashlib
+    cache_dir = cache_directory(cache_dir)
+    if cache_dir is None:
+        return None
+    directory = job['directory']
+    if job['engine'] == "python":
+        settings = dict(job['settings'])
+        if job['command'] in replotted_engine_commands:
+            settings = {key: value for key, value in settings.items() if key not in plot_settings}
+        key = {'settings': settings, 'gene_sets': job['gene_sets'], 'phenotypes': job.get('phenotypes'),
+               'inputs': [file_digest(job['dataset'] + suffix) for suffix in ['.npy', '.rows.tsv', '.columns.tsv']]}
+    else:
+        arguments = ["." if argument == directory else argument for argument in job['arguments']]
+        key = {'arguments': arguments,
+               'inputs': [file_digest(os.path.join(directory, argument)) for argument in arguments
+                          if argument != "." and os.path.isfile(os.path.join(directory, argument))]}
+    digest = hashlib.blake2b(json.dumps(key).encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_dir, "stages", job['command'] + "_" + job['engine'] + "_" + digest)
+
+
+engine_result_tables = {'user-rank': ['set_x_statistic_x_number.tsv', 'set_x_index_x_enrichment.tsv'],
+                        'metric-rank': ['set_x_statistic_x_number.tsv', 'set_x_index_x_enrichment.tsv', 'feature_x_metric_x_score.tsv'],
+                        'data-rank': ['set_x_sample_x_enrichment.tsv']}
+python_engine_result_tables = ['set_x_running_enrichment.npz', 'set_x_leading_edge.tsv']
+
+
+# Result files of a finished engine job, relative to its directory
+# Only the files the engine itself writes are listed: its result tables
+# (engine_result_tables, plus the running enrichment arrays of the python
+# engine) and the plot pages of the sets in its statistics table, which are
+# left out for the commands whose plots are redrawn from the tables. Files
+# the runners add to the directory afterwards are never part of a stage.
+def engine_job_outputs(job):
+    directory = job['directory']
+    if job['command'] == "user-rank-batch":
+        tables = {'user-rank': engine_result_tables['user-rank'] + python_engine_result_tables}
+        outputs = ['set_x_contrast_x_normalized_enrichment.tsv']
+        for contrast_dir in contrast_directories(_engine_dataset(job['dataset']).columns, directory).values():
+            folder = os.path.relpath(contrast_dir, directory)
+            outputs += [os.path.join(folder, file_name) for file_name in engine_stage_files(contrast_dir, 'user-rank', tables, True)]
+    else:
+        tables = engine_result_tables
+        if job['engine'] == "python":
+            tables = {command: files + python_engine_result_tables for command, files in tables.items()}
+        plots = not (job['engine'] == "python" and job['command'] in replotted_engine_commands)
+        outputs = engine_stage_files(directory, job['command'], tables, plots)
+    return [file_name for file_name in outputs if os.path.isfile(os.path.join(directory, file_name))]
+
+
+# Result tables and, when plots is set, plot pages of one engine result directory
+def engine_stage_files(directory, command, tables, plots):
+    files = list(tables.get(command, []))
+    stats_path = os.path.join(directory, 'set_x_statistic_x_number.tsv')
+    if plots and os.path.exists(stats_path):
+        stats = pandas.read_csv(stats_path, sep="\t", index_col=0)
+        files += [os.path.basename(path) for path in enumerate_plot_paths(stats, directory).values()]
+    return files
+
+
+# Store result files (paths relative to root_dir) as a stage cache entry
+# Written through a staging directory and renamed into place like
+# store_cache_entry.
+def store_stage_entry(entry, root_dir, files, source=None):
+    import shutil
+    import tempfile
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        staging = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        for file_name in files:
+            target = os.path.join(staging, "files", file_name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(root_dir, file_name), target)
+        if source is not None:
+            with open(os.path.join(staging, 'source.json'), 'w') as f:
+                json.dump(source, f)
+        try:
+            os.rename(staging, entry)
+        except OSError:  # Another job stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+    except OSError:
+        return
+    prune_cache(os.path.dirname(os.path.dirname(entry)))
+
+
+# Copy the result files of a stage cache entry into root_dir
+# Returns False when the entry is missing or can not be restored.
+def restore_stage_entry(entry, root_dir):
+    import shutil
+    if not os.path.isdir(os.path.join(entry, "files")):
+        return False
+    try:
+        shutil.copytree(os.path.join(entry, "files"), root_dir, dirs_exist_ok=True)
+        os.utime(entry)
+    except (OSError, shutil.Error):
+        return False
+    return True
+
+
+# Redraw the enrichment plot pages of the top sets in a results directory
+# Earlier pages are removed first, since the per-set report pages are rendered
+# over them. stats is set_x_statistic_x_number.tsv in the order the engine
+# wrote it and genesets_dict holds the members of its sets. When candidates
+# is given only those sets are eligible, e.g. redundancy cluster representatives.
+def redraw_set_plots(stats, ranked_metric, genesets_dict, settings, output_dir, candidates=None):
+    for page_path in enumerate_plot_paths(stats, output_dir).values():
+        if os.path.exists(page_path):
+            os.remove(page_path)
+    set_names = stats.index.to_list()
+    weights = numpy.abs(ranked_metric.values) ** settings['exponent']
+    membership = build_membership_matrix(
+        {name: genesets_dict[name] for name in set_names}, ranked_metric.index)
+    write_engine_plots(stats, ranked_metric, membership, set_names, weights, settings, output_dir, candidates)
+
+
+# Remove the plots of sets other than the candidates, for engine plots of
+# algorithms that cannot be redrawn in-process
+def drop_set_plots(stats, output_dir, candidates):
+    for name, page_path in enumerate_plot_paths(stats, output_dir).items():
+        if name not in candidates and os.path.exists(page_path):
+            os.remove(page_path)
+
+
+# Redraw the enrichment plots of a python engine job from its result tables
+def plot_engine_job(job):
+    directory = job['directory']
+    stats = pandas.read_csv(os.path.join(directory, 'set_x_statistic_x_number.tsv'), sep="\t", index_col=0)
+    if job['command'] == "metric-rank":
+        ranked_metric = pandas.read_csv(os.path.join(
+            directory, 'feature_x_metric_x_score.tsv'), sep="\t", index_col=0, float_precision='round_trip').iloc[:, 0]
+    else:
+        ranked_metric = ranked_list(job['dataset'])
+    weights = numpy.abs(ranked_metric.values) ** job['settings']['exponent']
+    membership = build_membership_matrix(job['gene_sets'], ranked_metric.index)
+    write_engine_plots(stats, ranked_metric, membership, list(job['gene_sets'].keys()),
+                       weights, job['settings'], directory)
@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import signal
+import argparse
+import socketserver
+import traceback
+
+
+# Each connection carries one engine job as a line of JSON. Jobs run in a
+# child forked from the warm server process, so the libraries imported at
+# startup are already loaded and a failing job cannot take the server down.
+# Only python engine jobs benefit: julia jobs are still run as a new gsea
+# process. execute_engine_job rejects anything but the known engine entry
+# points run on the job's own directory.
+class EngineJobHandler(socketserver.StreamRequestHandler):
+    engine = None
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline())
+            self.engine.execute_engine_job(job)
+            reply = {"status": "ok"}
+        except SystemExit as e:
+            reply = {"status": "error", "message": str(e.code)}
+        except Exception:
+            reply = {"status": "error", "message": traceback.format_exc()}
+        self.wfile.write((json.dumps(reply) + "\n").encode())
+
+
+class EngineServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Long-lived GSEA engine server. run.gsea2.py, run.prerank_gsea2.py and run.ssgsea2.py submit jobs to it with --engine-socket. Only --engine python jobs are warmed: they run in a fork of this process with the engine already imported. Julia jobs are accepted but launch a new gsea process as usual, with its full start-up and compilation time.")
+    ap.add_argument("--libdir", action="store",
+                    dest="libdir", help="Working directory to load support library from.")
+    ap.add_argument("--socket", action="store", dest="socket", default=os.environ.get("GSEA_ENGINE_SOCKET"),
+                    help="Path of the Unix domain socket to listen on.")
+    ap.add_argument("--max-jobs", action="store", dest="max_jobs",
+                    default=4, type=int, help="Maximum number of jobs run at once.")
+    options = ap.parse_args()
+
+    if options.socket == None:
+        sys.exit("A socket path is required, either with --socket or GSEA_ENGINE_SOCKET.")
+
+    # Import the engine and its dependencies once so forked jobs start warm
+    sys.path.insert(1, options.libdir)
+    import GSEAlib
+    EngineJobHandler.engine = GSEAlib
+
+    # Replace a stale socket left by a server that did not shut down cleanly
+    if os.path.exists(options.socket):
+        os.remove(options.socket)
+
+    # The socket is only usable by the user running the server
+    EngineServer.max_children = options.max_jobs
+    umask = os.umask(0o177)
+    try:
+        server = EngineServer(options.socket, EngineJobHandler)
+    finally:
+        os.umask(umask)
+    os.chmod(options.socket, 0o600)
+    with server:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print("GSEA engine server listening on", options.socket)
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            os.remove(options.socket)
+
+
+if __name__ == '__main__':
+    main()
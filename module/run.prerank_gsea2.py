@@ -1,6 +1,5 @@
 import os
 import sys
-import subprocess
 from optparse import OptionParser
 from datetime import datetime
 from zipfile import ZipFile
@@ -28,206 +27,24 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-def main():
-    usage = "%prog [options]" + "\n"
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--libdir", action="store",
-                    dest="libdir", help="Working directory to load support library from.")
-    ap.add_argument("--dataset", action="store", dest="dataset",
-                    help="Input Expression Dataset.")
-    ap.add_argument("--gsdb", action="store", dest="gsdb",
-                    help="Gene Set Database File.")
-    ap.add_argument("--nperm", action="store", dest="nperm",
-                    default=1000, type=int, help="Number of permutations.")
-    # ap.add_argument("--cls", action="store", dest="cls", help="CLS file.")
-    # ap.add_argument("--reverse", action="store", type=str2bool, nargs='?', const=True, dest="reverse",
-    #                 default=False, help="Reverse the phenotype comparison defined in the CLS file.")
-    # ap.add_argument("--perm", action="store", dest="perm", default="sample",
-    #                 help="Permutation mode. Options are 'sample' (phenotype) and 'set' (gene set).")
-    ap.add_argument("--collapse", action="store", dest="collapse", default="none",
-                    help="Method for computing mathematical collapse. Supports 'none' ('no collapse'), 'sum', 'mean', 'median', 'max', 'absmax'")
-    ap.add_argument("--chip", action="store", dest="chip",
-                    default="none", help="Chip file used for performing collapse.")
-    # ap.add_argument("--metric", action="store",
-    #                 dest="rank_metric", help="Metric for ranking genes.")
-    ap.add_argument("--alg", action="store", dest="method",
-                    help="Enrichment Method. 'ks' (Kolmogorov-Smirnov, classic GSEA), 'ksa' (Kolmogorov-Smirnov area), kli, kliop, kliom")
-    ap.add_argument("--exponent", action="store", dest="exponent", default=1.0,
-                    type=float, help="Weight for ks or ksa enrichment method.")
-    ap.add_argument("--max", action="store", dest="max",
-                                    default=500, type=int, help="Max gene set size.")
-    ap.add_argument("--min", action="store", dest="min",
-                                    default=15, type=int, help="Min gene set size.")
-    ap.add_argument("--seed", action="store", dest="seed",
-                    default="timestamp", help="Random seed used for permutations.")
-    ap.add_argument("--ogllv", action="store", type=str2bool, nargs='?', const=True, dest="override",
-                    default=False, help="Override reasonableness check for input dataset gene list size.")
-    ap.add_argument("--nplot", action="store", dest="nplot", default=25,
-                    type=int, help="Number of enrichment results to plot.")
-    ap.add_argument("--zip", action="store", type=str2bool, nargs='?', const=True,
-                                    dest="zip", default=True, help="Create ZIP bundle of results.")
-    ap.add_argument("--cpu", action="store", dest="cpu",
-                                    default=1, type=int, help="Job CPU Count.")
-    options = ap.parse_args()
-
-    sys.path.insert(1, options.libdir)
-    import GSEAlib
-
-    # Make a directory to store processed input files
-    os.mkdir("input")
-
-    # Generate and set the random seed at the Python level and save it to pass to GSEA
-    if options.seed == "timestamp":
-        options.seed = int(round(datetime.now().timestamp()))
-        random.seed(options.seed)
-    else:
-        options.seed = int(round(float(options.seed)))
-        random.seed(options.seed)
+# Zip up everything in the working directory
+def zip_results():
+    gsea_files = []
+    for folderName, subfolders, filenames in os.walk(os.path.relpath(os.getcwd())):
+        for filename in filenames:
+            # create complete filepath of file in directory
+            filePath = os.path.join(folderName, filename)
+            # Add file to zip
+            gsea_files.append(filePath)
+    with ZipFile("gsea_results.zip", "w") as gsea_zip:
+        for filename in gsea_files:
+            gsea_zip.write(filename)
 
-    # Parse GCT file
-    if options.dataset.split(".")[-1] == "gct":
-        if options.collapse != "none":
-            chip_file = GSEAlib.read_chip(options.chip)
-            input_ds = GSEAlib.collapse_dataset(
-                options.dataset, chip_file, method=options.collapse, drop=True)
-            input_ds['mappings'].to_csv(
-                'input/collapse_dataset_mapping_details.tsv', sep="\t", na_rep="No Symbol Mapping")
-            collapse_length = input_ds['collapse_length']
-        else:
-            input_ds = GSEAlib.read_gct(options.dataset)
-        input_length = input_ds['input_length']
-        input_ds = input_ds['data']
-    elif options.dataset.split(".")[-1] == "rnk":
-        input_ds = pandas.read_csv(
-            options.dataset, sep='\t', index_col=0, skip_blank_lines=True, header=None)
-        if any(input_ds.index.str.startswith('#')):
-            input_ds = input_ds.rename(columns=input_ds.iloc[int(
-                numpy.where(input_ds.index.str.startswith('#'))[0])])
-            input_ds = input_ds[input_ds.index.str.startswith('#') != True]
-        else:
-            input_ds = input_ds.rename(columns={1: "Preranked Metric"})
-        input_ds.index.name = "Name"
-        input_length = len(input_ds.index)
-        if options.collapse != "none":
-            chip_file = GSEAlib.read_chip(options.chip)
-            input_ds = GSEAlib.collapse_dataset(
-                input_ds, chip_file, method=options.collapse, drop=True)
-            input_ds['mappings'].to_csv(
-                'input/collapse_dataset_mapping_details.tsv', sep="\t", na_rep="No Symbol Mapping")
-            input_length = input_ds['input_length']
-            collapse_length = input_ds['collapse_length']
-            input_ds = input_ds['data']
-    else:
-        input_ds = pandas.read_csv(
-            options.dataset, sep='\t', index_col=0, skip_blank_lines=True)
-        if "description" in input_ds.columns.str.lower():
-            description_loc = input_ds.columns.str.lower().to_list().index('description')
-            input_ds.drop(
-                input_ds.columns[[description_loc]], axis=1, inplace=True)
-        input_ds.index.name = "Name"
-        input_length = len(input_ds.index)
-        if options.collapse != "none":
-            chip_file = GSEAlib.read_chip(options.chip)
-            input_ds = GSEAlib.collapse_dataset(
-                input_ds, chip_file, method=options.collapse, drop=True)
-            input_ds['mappings'].to_csv(
-                'input/collapse_dataset_mapping_details.tsv', sep="\t", na_rep="No Symbol Mapping")
-            input_length = input_ds['input_length']
-            collapse_length = input_ds['collapse_length']
-            input_ds = input_ds['data']
 
-    if len(input_ds) < 10000 and options.override == False and options.collapse == "none":
-        sys.exit(print("Only ", len(input_ds), "genes were identified in the dataset.\nEither the dataset did not contain all expressed genes, or collapse dataset may need to be run with an appropriate chip file.\n\nIf this was intentional, to bypass this check you can set 'override gene list length validation' (--ogllv) to 'True' but this is not recommended."))
-    if len(input_ds) < 10000 and options.override == False and options.collapse != "none":
-        sys.exit(print("Only ", len(input_ds), "genes were identified in the dataset.\nEither the dataset did not contain all expressed genes, or there was possibly a problem with the chip selected for collapse dataset.\n\nIf this was intentional, to bypass this check you can set 'override gene list length validation' (--ogllv) to 'True' but this is not recommended."))
-    if len(input_ds) < 10000 and options.override == True:
-        print("Only", len(input_ds), "genes were identified in the dataset, but the user specified overriding this check. Continuing analysis, as-is however this is not recommended. The input dataset should include all expressed genes.")
-
-    # # Parse CLS file
-    # labels, phenotypes = GSEAlib.read_cls(options.cls)
-    # phenotypes = GSEAlib.match_phenotypes(input_ds, phenotypes)
-    # if options.reverse == True and phenotypes.columns[0] == "Labels":
-    #     phenotypes["Phenotypes"] = numpy.where((phenotypes["Phenotypes"] == 0) | (
-    #         phenotypes["Phenotypes"] == 1), phenotypes["Phenotypes"] ^ 1, phenotypes["Phenotypes"])
-    #     labels = {0: labels[1], 1: labels[0]}
-    # phenotypes = phenotypes.sort_values('Phenotypes')
-    #
-    # # Order the dataset using the phenotypes and write out both files
-    # input_ds = input_ds.reindex(columns=phenotypes.index)
-    input_ds.to_csv('input/gene_by_sample.tsv', sep="\t")
-    # pandas.DataFrame(phenotypes['Phenotypes']).transpose().to_csv(
-    #     'input/target_by_sample.tsv', sep="\t", index=False)
-    # No CLS in Preranked, use;
-
-    labels = {0: 'Positive', 1: 'Negative'}
-    phenotypes = pandas.DataFrame([['User_Metric', 0]], columns=[
-                                  'Labels', 'Phenotypes'])
-
-    # Parse GMT/GMX gene sets files from a list of inputs and create a name:members dict written out as a json file
-    if options.gsdb != None:
-        with open(options.gsdb) as f:
-            gene_sets_dbfile_list = f.read().splitlines()
-
-    gs_data = GSEAlib.read_sets(gene_sets_dbfile_list)
-    genesets = gs_data['genesets']
-    genesets_descr = gs_data['descriptions']
-    with open('input/raw_set_to_genes.json', 'w') as path:
-        json.dump(genesets, path,  indent=2)
-
-    # Filter gene sets to just genes in input dataset
-    gs_data_subset = GSEAlib.filter_sets(genesets, input_ds.index)
-    gs_data_subset_sets = gs_data_subset['genesets']
-    gs_data_subset_lengths = gs_data_subset['lengths']
-    passing_lengths = dict((key, value) for key, value in gs_data_subset_lengths.items(
-    ) if (value >= max(options.min, 1) and value <= options.max))
-    passing_sets = {key: gs_data_subset_sets[key]
-                    for key in passing_lengths.keys()}
-    with open('input/filtered_set_to_genes.json', 'w') as path:
-        json.dump(genesets, path,  indent=2)
-
-    # Construct GSEA Settings json file
-    gsea_settings = {
-        "number_of_permutations": options.nperm,
-        "permutation": 'set',
-        "feature_name": "Features",
-        # "metric": options.rank_metric,
-        "score_name": "Ranking Metric",
-        "algorithm": options.method,
-        "exponent": options.exponent,
-        "maximum_gene_set_size": options.max,
-        "minimum_gene_set_size": options.min,
-        "remove_gene_set_genes": True,
-        "random_seed": options.seed,
-        "high_text" : str(labels[0]),
-        "low_text" : str(labels[1]),
-        "number_of_jobs": options.cpu,
-        "number_of_sets_to_plot": options.nplot,
-        "gene_sets_to_plot": []
-    }
-
-    with open('input/gsea_settings.json', 'w') as path:
-        json.dump(gsea_settings, path,  indent=2)
-
-    # Run GSEA
-    subprocess.check_output(['gsea', 'user-rank',
-                             str(os.getcwd()),
-                             'input/gene_by_sample.tsv',
-                             'input/filtered_set_to_genes.json',
-                             '--minimum-set-size', str(options.min),
-                             '--maximum-set-size', str(options.max),
-                             # '--metric', str(options.rank_metric),
-                             '--algorithm', str(options.method),
-                             '--exponent', str(options.exponent),
-                             '--permutation', 'set',
-                             '--number-of-permutations', str(options.nperm),
-                             '--random-seed', str(options.seed),
-                             '--number-of-sets-to-plot', str(options.nplot),
-                             '--feature-name', 'Features',
-                             '--score-name', 'Ranking_Metric',
-                             '--low-text', str(labels[1]),
-                             '--high-text', str(labels[0]),
-                             '--write-set-x-index-x-enrichment-tsv']
-                            )
+# Write the enrichment reports, per-set pages, heat map page and index of a
+# finished run in the working directory
+def write_reports(options, input_ds, phenotypes, labels, genesets, genesets_descr, passing_lengths, input_length, collapse_length=None):
+    import GSEAlib
 
     # Parse Results
     genesets_descr = pandas.DataFrame.from_dict(
@@ -237,18 +54,29 @@ def main():
     gsea_stats = pandas.read_csv(
         'set_x_statistic_x_number.tsv', sep="\t", index_col=0)
     plot_paths = GSEAlib.enumerate_plot_paths(gsea_stats, os.getcwd())
-    ranked_genes = pandas.read_csv(
-        'input/gene_by_sample.tsv', sep="\t", index_col=0)
+    ranked_genes = GSEAlib.read_dataset_handoff('input/gene_by_sample')
     random_es_distribution = pandas.read_csv(
         'set_x_index_x_enrichment.tsv', sep="\t", index_col=0)
 
-    # Add set sizes to enrichment report
-    gsea_stats.insert(0, 'Size', '')
-    for gs in range(len(gsea_stats)):
-        gsea_stats.loc[gsea_stats.index[gs],
-                       'Size'] = passing_lengths[gsea_stats.index[gs]]
-    gsea_stats.to_csv(
-        'set_x_statistic_x_number.tsv', sep="\t")
+    # Add set sizes to enrichment report, once
+    if 'Size' not in gsea_stats.columns:
+        gsea_stats.insert(0, 'Size', '')
+        for gs in range(len(gsea_stats)):
+            gsea_stats.loc[gsea_stats.index[gs],
+                           'Size'] = passing_lengths[gsea_stats.index[gs]]
+        gsea_stats.to_csv(
+            'set_x_statistic_x_number.tsv', sep="\t")
+
+    # Shared read-only inputs for rendering the per-set report pages
+    ranked_genes_index = set(ranked_genes.index.values)
+    running_enrichment = None
+    if os.path.exists('set_x_running_enrichment.npz'):
+        running_enrichment = GSEAlib.read_running_enrichment('set_x_running_enrichment.npz')
+    report_inputs = {'input_ds': input_ds, 'phenotypes': phenotypes, 'ranked_genes': ranked_genes,
+                     'random_es_distribution': random_es_distribution, 'heatmap': "prerank",
+                     'engine': options.engine, 'exponent': options.exponent,
+                     'running_enrichment': running_enrichment}
+    report_tasks = []
 
     # Positive Enrichment Report
     gsea_pos = gsea_stats[gsea_stats.loc[:, "Enrichment"] > 0]
@@ -257,54 +85,22 @@ def main():
             ["Enrichment"], axis=0, ascending=(False)).reset_index()
         gsea_pos.insert(1, 'Details', '')
         for gs in range(len(gsea_pos)):
-            # Compute original set size, filtered set, and filtered size
-            unfiltered_len = len(genesets[gsea_pos.iloc[gs]['index']])
-            filtered_gs = list(set(genesets[gsea_pos.iloc[gs]['index']]) & set(
-                list(ranked_genes.index.values)))
-            filtered_len = len(filtered_gs)
-            if plot_paths[gsea_pos.iloc[gs]['index']] in plots:
+            set_name = gsea_pos.iloc[gs]['index']
+            if plot_paths[set_name] in plots:
                 # Get Enrichment Statistics for the set of interest
                 report_set = pandas.DataFrame(gsea_pos.iloc[gs]).copy(
                     deep=True)
                 report_set.rename({'index': 'Gene Set'}, axis=0, inplace=True)
-                set_enrichment_score = report_set.loc['Enrichment'].values[0]
-                # Only do plotting work if we need to
-                heatmap_fig = GSEAlib.plot_set_prerank_heatmap(
-                    input_ds, phenotypes, ranked_genes, filtered_gs, ascending=True)
-                null_es_fig = GSEAlib.set_perm_indepkde_displot(
-                    random_es_distribution.loc[gsea_pos.iloc[gs]['index']], set_enrichment_score)
                 # Edit in the needed information to the per-set enrichment reports
                 report_set.loc["Details"] = "Dataset: " + os.path.splitext(os.path.basename(options.dataset))[
                     0] + "<br>Enriched in Phenotype: \"" + str(labels[0]) + "\" of comparison " + str(labels[0]) + " vs " + str(labels[1])
-                page = open(plot_paths[gsea_pos.iloc[gs]['index']], 'r')
-                page_str = page.read()
-                leading_edge_table, leading_edge_subset = GSEAlib.get_leading_edge(
-                    page_str)
-                doc = dominate.document(title=gsea_pos.iloc[gs]['index'])
-                doc += h3("Enrichment Details")
-                doc += raw(report_set.to_html(header=False,
-                                              render_links=True, escape=False, justify='left'))
-                doc += raw("<br>")
-                doc += h3("Enrichment Plot")
-                doc += raw(page_str.replace("<!doctype html>", ""))
-                doc += raw("<br>")
-                doc += h3("Table: GSEA details")
-                doc += raw(leading_edge_table.to_html())
-                doc += p('Investigate core enrichment with ', a("MSigDB Webtools",
-                                                                href='https://www.gsea-msigdb.org/gsea/msigdb/annotate.jsp?geneIdList=' + leading_edge_subset, target='_blank'), " or ", a("Query NDEx", href='https://www.ndexbio.org/iquery/?genes=' + leading_edge_subset, target='_blank'))
-                doc += raw("<br>")
-                doc += h3("Ranked List Heatmap for " +
-                          gsea_pos.iloc[gs]['index'])  # add a title for the heatmap
-                doc += raw(heatmap_fig)
-                doc += raw("<br>")
-                doc += h3("Random Enrichment Score Distribution for " +
-                          gsea_pos.iloc[gs]['index'])  # add a title for the ES distplot
-                doc += raw(null_es_fig)
-                with open(plot_paths[gsea_pos.iloc[gs]['index']], 'w') as f:
-                    f.write(doc.render())
+                # Only do plotting work if we need to, pages are rendered in parallel below
+                filtered_gs = list(set(genesets[set_name]) & ranked_genes_index)
+                report_tasks.append(
+                    (set_name, report_set, filtered_gs, True, plot_paths[set_name]))
                 # HTMLify the positive report
                 gsea_pos.at[gs, "Details"] = "<a href=" + \
-                    plot_paths[gsea_pos.iloc[gs]['index']] + " target='_blank'>Details...</a>"
+                    plot_paths[set_name] + " target='_blank'>Details...</a>"
         gsea_pos["index"] = gsea_pos.apply(
             lambda row: "<a href='{}' target='_blank'>{}</a>".format(row.URL, row['index']), axis=1)
         gsea_pos.drop("URL", axis=1, inplace=True)
@@ -321,54 +117,22 @@ def main():
             ["Enrichment"], axis=0, ascending=(True)).reset_index()
         gsea_neg.insert(1, 'Details', '')
         for gs in range(len(gsea_neg)):
-            # Compute original set size, filtered set, and filtered size
-            unfiltered_len = len(genesets[gsea_neg.iloc[gs]['index']])
-            filtered_gs = list(set(genesets[gsea_neg.iloc[gs]['index']]) & set(
-                list(ranked_genes.index.values)))
-            filtered_len = len(filtered_gs)
-            if plot_paths[gsea_neg.iloc[gs]['index']] in plots:
+            set_name = gsea_neg.iloc[gs]['index']
+            if plot_paths[set_name] in plots:
                 # Get Enrichment Statistics for the set of interest
                 report_set = pandas.DataFrame(gsea_neg.iloc[gs]).copy(
                     deep=True)
                 report_set.rename({'index': 'Gene Set'}, axis=0, inplace=True)
-                set_enrichment_score = report_set.loc['Enrichment'].values[0]
-                # Only do plotting work if we need to
-                heatmap_fig = GSEAlib.plot_set_prerank_heatmap(
-                    input_ds, phenotypes, ranked_genes, filtered_gs, ascending=False)
-                null_es_fig = GSEAlib.set_perm_indepkde_displot(
-                    random_es_distribution.loc[gsea_neg.iloc[gs]['index']], set_enrichment_score)
                 # Edit in the needed information to the per-set enrichment reports
                 report_set.loc["Details"] = "Dataset: " + os.path.splitext(os.path.basename(options.dataset))[
                     0] + "<br>Enriched in Phenotype: \"" + str(labels[1]) + "\" of comparison " + str(labels[0]) + " vs " + str(labels[1])
-                page = open(plot_paths[gsea_neg.iloc[gs]['index']], 'r')
-                page_str = page.read()
-                leading_edge_table, leading_edge_subset = GSEAlib.get_leading_edge(
-                    page_str)
-                doc = dominate.document(title=gsea_neg.iloc[gs]['index'])
-                doc += h3("Enrichment Details")
-                doc += raw(report_set.to_html(header=False,
-                                              render_links=True, escape=False, justify='left'))
-                doc += raw("<br>")
-                doc += h3("Enrichment Plot")
-                doc += raw(page_str.replace("<!doctype html>", ""))
-                doc += raw("<br>")
-                doc += h3("Table: GSEA details")
-                doc += raw(leading_edge_table.to_html())
-                doc += p('Investigate core enrichment with ', a("MSigDB Webtools",
-                                                                href='https://www.gsea-msigdb.org/gsea/msigdb/annotate.jsp?geneIdList=' + leading_edge_subset, target='_blank'), " or ", a("Query NDEx", href='https://www.ndexbio.org/iquery/?genes=' + leading_edge_subset, target='_blank'))
-                doc += raw("<br>")
-                doc += h3("Ranked List Heatmap for " +
-                          gsea_neg.iloc[gs]['index'])  # add a title for the heatmap
-                doc += raw(heatmap_fig)
-                doc += raw("<br>")
-                doc += h3("Random Enrichment Score Distribution for " +
-                          gsea_neg.iloc[gs]['index'])  # add a title for the ES distplot
-                doc += raw(null_es_fig)
-                with open(plot_paths[gsea_neg.iloc[gs]['index']], 'w') as f:
-                    f.write(doc.render())
+                # Only do plotting work if we need to, pages are rendered in parallel below
+                filtered_gs = list(set(genesets[set_name]) & ranked_genes_index)
+                report_tasks.append(
+                    (set_name, report_set, filtered_gs, False, plot_paths[set_name]))
                 # HTMLify the negative report
                 gsea_neg.at[gs, "Details"] = "<a href=" + \
-                    plot_paths[gsea_neg.iloc[gs]['index']] + " target='_blank'>Details...</a>"
+                    plot_paths[set_name] + " target='_blank'>Details...</a>"
         gsea_neg["index"] = gsea_neg.apply(
             lambda row: "<a href='{}' target='_blank'>{}</a>".format(row.URL, row['index']), axis=1)
         gsea_neg.drop("URL", axis=1, inplace=True)
@@ -378,6 +142,14 @@ def main():
     gsea_neg.to_html(open('gsea_report_for_negative_enrichment.html',
                           'w'), render_links=True, escape=False, justify='center')
 
+    # Render the per-set report pages across the job's CPUs
+    GSEAlib.render_set_reports(report_tasks, report_inputs, cpu=options.cpu)
+
+    # Overlap and clusters of the leading edges of the significant sets
+    if os.path.exists('set_x_leading_edge.tsv'):
+        GSEAlib.write_leading_edge_overlap(gsea_stats, pandas.read_csv(
+            'set_x_leading_edge.tsv', sep="\t", index_col=0), os.getcwd(), fdr=options.leading_edge_fdr)
+
     # Create Report for Dataset top markers
     dataset_markers = numpy.append(ranked_genes.sort_values(ranked_genes.columns[0], ascending=False).index.values[0:50], ranked_genes.sort_values(
         ranked_genes.columns[0], ascending=False).index.values[len(ranked_genes) - 50:len(ranked_genes)])
@@ -455,10 +227,28 @@ def main():
     gsea_index += h3("Gene set details")
     gsea_index += ul(
         li("Gene set size filters (min=" + str(options.min) + ", max=" + str(options.max) + ") resulted in filtering out " +
-           str(len(genesets) - len(passing_sets)) + " / " + str(len(genesets)) + " gene sets"),
-        li("The remaining " + str(len(passing_sets)) +
+           str(len(genesets) - len(passing_lengths)) + " / " + str(len(genesets)) + " gene sets"),
+        li("The remaining " + str(len(passing_lengths)) +
            " gene sets were used in the analysis")
     )
+    if os.path.exists('set_x_redundancy_cluster.tsv'):
+        redundancy = pandas.read_csv('set_x_redundancy_cluster.tsv', sep="\t", index_col=0)
+        gsea_index += ul(
+            li(str(len(redundancy)) + " gene sets form " + str(redundancy['Cluster'].nunique()) + " redundancy clusters (Jaccard index >= " +
+               str(options.redundancy_jaccard) + "), " + {"none": "all gene sets were tested and plotted",
+                                                        "plot": "only cluster representatives were plotted",
+                                                        "test": "only the " + str(len(gsea_stats)) + " cluster representatives were tested"}[options.representatives]),
+            li(a("Redundancy cluster and representative of every gene set (.tsv file)",
+                 href='set_x_redundancy_cluster.tsv')))
+    if os.path.exists('set_x_leading_edge.tsv'):
+        gsea_index += ul(li(a("Leading edge (core enrichment) genes of every gene set (.tsv file)",
+                              href='set_x_leading_edge.tsv')))
+    if os.path.exists('leading_edge_cluster_x_summary.tsv'):
+        gsea_index += ul(
+            li(a("Clusters of significant gene sets (adjusted pValue < " + str(options.leading_edge_fdr) + ") with overlapping leading edges (.tsv file)",
+                 href='leading_edge_cluster_x_summary.tsv')),
+            li(a("Pairwise leading edge Jaccard index of the significant gene sets (.tsv file)",
+                 href='set_x_set_x_leading_edge_jaccard.tsv')))
     gsea_index += h3("Gene markers for the " +
                      str(labels[0]) + " vs. " + str(labels[1]) + " comparison")
     gsea_index += ul(
@@ -498,18 +288,371 @@ def main():
     with open('index.html', 'w') as f:
         f.write(gsea_index.render())
 
+
+def main():
+    usage = "%prog [options]" + "\n"
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--libdir", action="store",
+                    dest="libdir", help="Working directory to load support library from.")
+    ap.add_argument("--dataset", action="store", dest="dataset",
+                    help="Input Expression Dataset.")
+    ap.add_argument("--gsdb", action="store", dest="gsdb",
+                    help="Gene Set Database File.")
+    ap.add_argument("--nperm", action="store", dest="nperm",
+                    default=1000, type=int, help="Number of permutations.")
+    # ap.add_argument("--cls", action="store", dest="cls", help="CLS file.")
+    # ap.add_argument("--reverse", action="store", type=str2bool, nargs='?', const=True, dest="reverse",
+    #                 default=False, help="Reverse the phenotype comparison defined in the CLS file.")
+    # ap.add_argument("--perm", action="store", dest="perm", default="sample",
+    #                 help="Permutation mode. Options are 'sample' (phenotype) and 'set' (gene set).")
+    ap.add_argument("--collapse", action="store", dest="collapse", default="none",
+                    help="Method for computing mathematical collapse. Supports 'none' ('no collapse'), 'sum', 'mean', 'median', 'max', 'absmax'")
+    ap.add_argument("--chip", action="store", dest="chip",
+                    default="none", help="Chip file used for performing collapse.")
+    # ap.add_argument("--metric", action="store",
+    #                 dest="rank_metric", help="Metric for ranking genes.")
+    ap.add_argument("--alg", action="store", dest="method",
+                    help="Enrichment Method. 'ks' (Kolmogorov-Smirnov, classic GSEA), 'ksa' (Kolmogorov-Smirnov area), kli, kliop, kliom")
+    ap.add_argument("--exponent", action="store", dest="exponent", default=1.0,
+                    type=float, help="Weight for ks or ksa enrichment method.")
+    ap.add_argument("--max", action="store", dest="max",
+                                    default=500, type=int, help="Max gene set size.")
+    ap.add_argument("--min", action="store", dest="min",
+                                    default=15, type=int, help="Min gene set size.")
+    ap.add_argument("--seed", action="store", dest="seed",
+                    default="timestamp", help="Random seed used for permutations.")
+    ap.add_argument("--ogllv", action="store", type=str2bool, nargs='?', const=True, dest="override",
+                    default=False, help="Override reasonableness check for input dataset gene list size.")
+    ap.add_argument("--nplot", action="store", dest="nplot", default=25,
+                    type=int, help="Number of enrichment results to plot.")
+    ap.add_argument("--zip", action="store", type=str2bool, nargs='?', const=True,
+                                    dest="zip", default=True, help="Create ZIP bundle of results.")
+    ap.add_argument("--cpu", action="store", dest="cpu",
+                                    default=1, type=int, help="Job CPU Count.")
+    ap.add_argument("--engine", action="store", dest="engine", default="julia",
+                    help="Enrichment engine. 'julia' (GSEA.jl command line) or 'python' (in-process, supports 'ks' and 'ksa').")
+    ap.add_argument("--write-tsv", action="store", type=str2bool, nargs='?', const=True, dest="write_tsv",
+                    default=False, help="Also write the input dataset as input/gene_by_sample.tsv when using the python engine.")
+    ap.add_argument("--engine-socket", action="store", dest="engine_socket", default=os.environ.get("GSEA_ENGINE_SOCKET"),
+                    help="Unix socket of a running engine server (run.engine_server.py). Jobs run locally when no server is listening. Only --engine python jobs start warm on the server; julia jobs still launch a new gsea process and pay its start-up and compilation time.")
+    ap.add_argument("--batch", action="store", type=str2bool, nargs='?', const=True, dest="batch",
+                    default=False, help="Analyze every ranking column of the dataset as a separate contrast (python engine only).")
+    ap.add_argument("--dtype", action="store", dest="dtype", default="float64",
+                    help="Numeric type used to load GCT/TSV datasets, 'float64' or 'float32' (halves memory for very large datasets).")
+    ap.add_argument("--memoize", action="store", type=str2bool, nargs='?', const=True, dest="memoize",
+                    default=False, help="Keep the parsed (and collapsed) dataset and the engine results in a cache ($GSEA_CACHE_DIR, default ~/.cache/gsea2) and reuse them in later runs. The dataset is reused when the dataset file, CHIP file, --collapse and --dtype match. Engine results also need the same gene sets, settings and seed, so they are only reused with a fixed --seed.")
+    ap.add_argument("--null-library", action="store", type=str2bool, nargs='?', const=True, dest="null_library",
+                    default=False, help="Keep the python engine's gene set permutation nulls in a persistent library and reuse them in later jobs with the same list length (--exponent 0) or ranking weights. The library is kept in the nulls/ folder of $GSEA_CACHE_DIR (default ~/.cache/gsea2), which is bounded by $GSEA_CACHE_MAX_BYTES (default 2 GiB).")
+    ap.add_argument("--adaptive-nperm", action="store", dest="adaptive_nperm", default=0, type=int,
+                    help="Maximum number of permutations per gene set for adaptive sequential permutation (python engine). Sets with fewer than --adaptive-exceedances null scores as extreme as their own after --nperm permutations get further rounds, each doubling the total, up to this number. 0 disables.")
+    ap.add_argument("--adaptive-exceedances", action="store", dest="adaptive_exceedances", default=10, type=int,
+                    help="Number of null scores at least as extreme as a gene set's enrichment after which adaptive permutation stops for that set.")
+    ap.add_argument("--tail-pvalues", action="store", type=str2bool, nargs='?', const=True, dest="tail_pvalues",
+                    default=False, help="Also report p-values from a generalized Pareto fit to the tail of each gene set's null, with a goodness of fit flag, for sets with fewer than 10 more extreme null scores (python engine, needs about 500 or more permutations). Scores past the end of a bounded fit are flagged 'beyond-endpoint' and get an exponential tail p-value; sets whose null enumerated every phenotype labeling keep their exact p-value.")
+    ap.add_argument("--leading-edge-fdr", action="store", dest="leading_edge_fdr", default=0.25, type=float,
+                    help="Adjusted p-value below which gene sets are included in the leading edge overlap analysis.")
+    ap.add_argument("--redundancy-jaccard", action="store", dest="redundancy_jaccard", default=0, type=float,
+                    help="Cluster gene sets whose members overlap with at least this Jaccard index and report the cluster representatives (0 disables clustering).")
+    ap.add_argument("--representatives", action="store", dest="representatives", default="none",
+                    help="Restrict to redundancy cluster representatives: 'none', 'plot' (only representatives are plotted) or 'test' (only representatives are tested).")
+    ap.add_argument("--report-only", action="store", dest="report_only",
+                    help="Results directory of an earlier run to re-render the reports of (for example with a larger --nplot) from its result files, without running the engine ('ks' and 'ksa' results only).")
+    options = ap.parse_args()
+
+    sys.path.insert(1, options.libdir)
+    import GSEAlib
+
+    # Re-render the reports of an earlier run from its results directory
+    if options.report_only != None:
+        os.chdir(options.report_only)
+        if not os.path.exists('set_x_statistic_x_number.tsv'):
+            sys.exit("No set_x_statistic_x_number.tsv was found in " + options.report_only + ". Batch results have no per-set reports to re-render.")
+        with open('input/gsea_settings.json') as path:
+            gsea_settings = json.load(path)
+        # The per-set pages of a run replace the engine plots, so re-rendering
+        # redraws them in-process, which only 'ks' and 'ksa' results allow
+        if gsea_settings['algorithm'] not in GSEAlib.python_engine_algorithms:
+            sys.exit("--report-only can only re-render results of the " + ", ".join(GSEAlib.python_engine_algorithms) +
+                     " algorithms. Run the analysis again to re-render '" + str(gsea_settings['algorithm']) + "' results.")
+        report_settings = {}
+        if os.path.exists('input/report_settings.json'):
+            with open('input/report_settings.json') as path:
+                report_settings = json.load(path)
+        options.seed = gsea_settings['random_seed']
+        options.min = gsea_settings['minimum_gene_set_size']
+        options.max = gsea_settings['maximum_gene_set_size']
+        options.exponent = gsea_settings['exponent']
+        options.dataset = report_settings.get('dataset', options.dataset or os.getcwd())
+        options.collapse = report_settings.get('collapse', "none")
+        options.redundancy_jaccard = report_settings.get('redundancy_jaccard', 0)
+        options.representatives = report_settings.get('representatives', "none")
+        gsea_settings['number_of_sets_to_plot'] = options.nplot
+        labels = {0: 'Positive', 1: 'Negative'}
+        phenotypes = pandas.DataFrame([['User_Metric', 0]], columns=[
+                                      'Labels', 'Phenotypes'])
+        input_ds = GSEAlib.read_dataset_handoff('input/gene_by_sample')
+        with open('input/raw_set_to_genes.json') as path:
+            genesets = json.load(path)
+        genesets_descr = {name: "" for name in genesets}
+        if os.path.exists('input/raw_set_to_description.json'):
+            with open('input/raw_set_to_description.json') as path:
+                genesets_descr = json.load(path)
+        # The size filter is redone as in the analysis, while the tested sets
+        # are those of the results (only the cluster representatives with
+        # '--representatives test')
+        gsea_stats = pandas.read_csv('set_x_statistic_x_number.tsv', sep="\t", index_col=0)
+        filtered_lengths = GSEAlib.filter_sets(genesets, input_ds.index)['lengths']
+        passing_lengths = dict((key, value) for key, value in filtered_lengths.items(
+        ) if (value >= max(options.min, 1) and value <= options.max))
+        representatives = None
+        if os.path.exists('set_x_redundancy_cluster.tsv') and options.representatives == "plot":
+            redundancy = pandas.read_csv('set_x_redundancy_cluster.tsv', sep="\t", index_col=0)
+            representatives = redundancy.index[(redundancy.index == redundancy['Representative']) &
+                                               redundancy.index.isin(gsea_stats.index)].to_list()
+        # The per-set pages were rendered over the engine plots, so the plots
+        # of the top sets are redrawn in-process
+        GSEAlib.redraw_set_plots(gsea_stats, GSEAlib.ranked_list(input_ds), genesets, gsea_settings, os.getcwd(), representatives)
+        options.engine = "python"
+        write_reports(options, input_ds, phenotypes, labels, genesets, genesets_descr, passing_lengths,
+                      report_settings.get('input_length', len(input_ds)), report_settings.get('collapse_length'))
+        if options.zip == True:
+            if os.path.exists("gsea_results.zip"):
+                os.remove("gsea_results.zip")
+            zip_results()
+        return
+
+    if options.engine == "python" and options.method not in GSEAlib.python_engine_algorithms:
+        sys.exit("The python engine supports the following enrichment algorithms: " +
+                 ", ".join(GSEAlib.python_engine_algorithms) + ". Use '--engine julia' for '" + str(options.method) + "'.")
+    if options.batch == True and options.engine != "python":
+        sys.exit("Batch mode requires '--engine python'.")
+    if options.batch == True and options.adaptive_nperm > 0:
+        sys.exit("Adaptive permutation is not available in batch mode.")
+
+    if options.adaptive_nperm > 0 and options.engine != "python":
+        sys.exit("Adaptive permutation requires '--engine python'.")
+    if options.tail_pvalues == True and options.engine != "python":
+        sys.exit("Tail p-values require '--engine python'.")
+    if options.dtype not in ["float64", "float32"]:
+        sys.exit("--dtype must be 'float64' or 'float32'.")
+    if options.representatives not in ["none", "plot", "test"]:
+        sys.exit("--representatives must be 'none', 'plot' or 'test'.")
+
+    # Make a directory to store processed input files
+    os.makedirs("input", exist_ok=True)
+
+    # Generate and set the random seed at the Python level and save it to pass to GSEA
+    if options.seed == "timestamp":
+        options.seed = int(round(datetime.now().timestamp()))
+        random.seed(options.seed)
+    else:
+        options.seed = int(round(float(options.seed)))
+        random.seed(options.seed)
+
+    # Parse the dataset, or with --memoize reuse the one parsed by an earlier run
+    if options.memoize == True:
+        input_stage = GSEAlib.read_input_dataset(options.dataset, options.collapse, options.chip, options.dtype, options.cpu, preranked=True)
+    else:
+        input_stage = GSEAlib.parse_input_dataset(options.dataset, options.collapse, options.chip, options.dtype, options.cpu, preranked=True)
+    input_ds = input_stage['data']
+    input_length = input_stage['input_length']
+    collapse_length = input_stage['collapse_length']
+    if input_stage['mappings'] is not None:
+        input_stage['mappings'].to_csv(
+            'input/collapse_dataset_mapping_details.tsv', sep="\t", na_rep="No Symbol Mapping")
+
+    if len(input_ds) < 10000 and options.override == False and options.collapse == "none":
+        sys.exit(print("Only ", len(input_ds), "genes were identified in the dataset.\nEither the dataset did not contain all expressed genes, or collapse dataset may need to be run with an appropriate chip file.\n\nIf this was intentional, to bypass this check you can set 'override gene list length validation' (--ogllv) to 'True' but this is not recommended."))
+    if len(input_ds) < 10000 and options.override == False and options.collapse != "none":
+        sys.exit(print("Only ", len(input_ds), "genes were identified in the dataset.\nEither the dataset did not contain all expressed genes, or there was possibly a problem with the chip selected for collapse dataset.\n\nIf this was intentional, to bypass this check you can set 'override gene list length validation' (--ogllv) to 'True' but this is not recommended."))
+    if len(input_ds) < 10000 and options.override == True:
+        print("Only", len(input_ds), "genes were identified in the dataset, but the user specified overriding this check. Continuing analysis, as-is however this is not recommended. The input dataset should include all expressed genes.")
+
+    # # Parse CLS file
+    # labels, phenotypes = GSEAlib.read_cls(options.cls)
+    # phenotypes = GSEAlib.match_phenotypes(input_ds, phenotypes)
+    # if options.reverse == True and phenotypes.columns[0] == "Labels":
+    #     phenotypes["Phenotypes"] = numpy.where((phenotypes["Phenotypes"] == 0) | (
+    #         phenotypes["Phenotypes"] == 1), phenotypes["Phenotypes"] ^ 1, phenotypes["Phenotypes"])
+    #     labels = {0: labels[1], 1: labels[0]}
+    # phenotypes = phenotypes.sort_values('Phenotypes')
+    #
+    # # Order the dataset using the phenotypes and write out both files
+    # input_ds = input_ds.reindex(columns=phenotypes.index)
+    GSEAlib.write_dataset_handoff(input_ds, 'input/gene_by_sample', dtype=options.dtype)
+    if options.engine != "python" or options.write_tsv == True:
+        input_ds.to_csv('input/gene_by_sample.tsv', sep="\t")
+    # pandas.DataFrame(phenotypes['Phenotypes']).transpose().to_csv(
+    #     'input/target_by_sample.tsv', sep="\t", index=False)
+    # No CLS in Preranked, use;
+
+    labels = {0: 'Positive', 1: 'Negative'}
+    phenotypes = pandas.DataFrame([['User_Metric', 0]], columns=[
+                                  'Labels', 'Phenotypes'])
+
+    # Parse GMT/GMX gene sets files from a list of inputs and create a name:members dict written out as a json file
+    if options.gsdb != None:
+        with open(options.gsdb) as f:
+            gene_sets_dbfile_list = f.read().splitlines()
+
+    gs_data = GSEAlib.read_sets(gene_sets_dbfile_list)
+    genesets = gs_data['genesets']
+    genesets_descr = gs_data['descriptions']
+    with open('input/raw_set_to_genes.json', 'w') as path:
+        json.dump(genesets, path,  indent=2)
+    with open('input/raw_set_to_description.json', 'w') as path:
+        json.dump(genesets_descr, path,  indent=2)
+
+    # Filter gene sets to just genes in input dataset
+    gs_data_subset = GSEAlib.filter_sets(genesets, input_ds.index)
+    gs_data_subset_sets = gs_data_subset['genesets']
+    gs_data_subset_lengths = gs_data_subset['lengths']
+    passing_lengths = dict((key, value) for key, value in gs_data_subset_lengths.items(
+    ) if (value >= max(options.min, 1) and value <= options.max))
+    passing_sets = {key: gs_data_subset_sets[key]
+                    for key in passing_lengths.keys()}
+
+    # Cluster near-duplicate gene sets, keeping only the cluster
+    # representatives for testing or plotting when asked to
+    representatives = None
+    if options.redundancy_jaccard > 0:
+        set_rows = {name: row for row, name in enumerate(gs_data_subset_lengths.keys())}
+        redundancy = GSEAlib.set_redundancy_clusters(gs_data_subset['membership'][[set_rows[name] for name in passing_lengths]],
+                                                     list(passing_lengths.keys()), options.redundancy_jaccard)
+        redundancy.to_csv('set_x_redundancy_cluster.tsv', sep="\t")
+        representatives = redundancy.index[redundancy.index == redundancy['Representative']].to_list()
+        if options.representatives == "test":
+            passing_sets = {key: passing_sets[key] for key in representatives}
+    with open('input/filtered_set_to_genes.json', 'w') as path:
+        json.dump(genesets if representatives is None or options.representatives != "test" else
+                  {key: genesets[key] for key in representatives}, path,  indent=2)
+
+    # Construct GSEA Settings json file
+    gsea_settings = {
+        "number_of_permutations": options.nperm,
+        "permutation": 'set',
+        "feature_name": "Features",
+        # "metric": options.rank_metric,
+        "score_name": "Ranking Metric",
+        "algorithm": options.method,
+        "exponent": options.exponent,
+        "maximum_gene_set_size": options.max,
+        "minimum_gene_set_size": options.min,
+        "remove_gene_set_genes": True,
+        "random_seed": options.seed,
+        "high_text" : str(labels[0]),
+        "low_text" : str(labels[1]),
+        "number_of_jobs": options.cpu,
+        "number_of_sets_to_plot": options.nplot,
+        "gene_sets_to_plot": [],
+        "null_library": options.null_library,
+        "maximum_number_of_permutations": options.adaptive_nperm,
+        "number_of_exceedances": options.adaptive_exceedances,
+        "tail_pvalues": options.tail_pvalues
+    }
+
+    with open('input/gsea_settings.json', 'w') as path:
+        json.dump(gsea_settings, path,  indent=2)
+
+    # Keep what the reports need besides the result files, for --report-only
+    report_settings = {
+        "dataset": os.path.basename(options.dataset),
+        "collapse": options.collapse,
+        "input_length": int(input_length),
+        "collapse_length": None if collapse_length is None else int(collapse_length),
+        "redundancy_jaccard": options.redundancy_jaccard,
+        "representatives": options.representatives
+    }
+    with open('input/report_settings.json', 'w') as path:
+        json.dump(report_settings, path,  indent=2)
+
+    # Run GSEA, on the warm engine server when one is listening
+    if options.batch == True:
+        engine_job = GSEAlib.engine_job(
+            'user-rank-batch', "python", os.getcwd(), dataset='input/gene_by_sample',
+            gene_sets=passing_sets, settings=gsea_settings, cpu=options.cpu)
+    elif options.engine == "python":
+        engine_job = GSEAlib.engine_job(
+            'user-rank', "python", os.getcwd(), dataset='input/gene_by_sample',
+            gene_sets=passing_sets, settings=gsea_settings, cpu=options.cpu)
+    else:
+        gsea_command = ['gsea', 'user-rank',
+                        str(os.getcwd()),
+                        'input/gene_by_sample.tsv',
+                        'input/filtered_set_to_genes.json',
+                        '--minimum-set-size', str(options.min),
+                        '--maximum-set-size', str(options.max),
+                        # '--metric', str(options.rank_metric),
+                        '--algorithm', str(options.method),
+                        '--exponent', str(options.exponent),
+                        '--permutation', 'set',
+                        '--number-of-permutations', str(options.nperm),
+                        '--random-seed', str(options.seed),
+                        '--number-of-sets-to-plot', str(options.nplot),
+                        '--feature-name', 'Features',
+                        '--score-name', 'Ranking_Metric',
+                        '--low-text', str(labels[1]),
+                        '--high-text', str(labels[0]),
+                        '--write-set-x-index-x-enrichment-tsv']
+        engine_job = GSEAlib.engine_job(
+            'user-rank', "julia", os.getcwd(), arguments=gsea_command, cpu=options.cpu)
+    GSEAlib.run_engine_job(engine_job, options.engine_socket, memoize=options.memoize)
+
+    # GSEA.jl writes no running enrichment arrays, for 'ks' and 'ksa' they
+    # follow from the ranked list so leading edges need not be read from plots
+    if options.engine != "python" and options.method in GSEAlib.python_engine_algorithms:
+        ranked_metric = GSEAlib.ranked_list('input/gene_by_sample')
+        GSEAlib.write_ranked_running_enrichment(ranked_metric, passing_sets, options.exponent, os.getcwd())
+
+    # Only the representatives of redundant gene sets are plotted, 'ks' and
+    # 'ksa' plots are redrawn in-process from the ranked list, other
+    # algorithms keep the engine plots of the representatives among the top sets
+    if representatives is not None and options.representatives == "plot" and options.batch == False:
+        if options.method in GSEAlib.python_engine_algorithms:
+            GSEAlib.redraw_set_plots(pandas.read_csv('set_x_statistic_x_number.tsv', sep="\t", index_col=0),
+                                     GSEAlib.ranked_list('input/gene_by_sample'), genesets, gsea_settings, os.getcwd(), representatives)
+            options.engine = "python"
+        else:
+            GSEAlib.drop_set_plots(pandas.read_csv('set_x_statistic_x_number.tsv', sep="\t", index_col=0),
+                                   os.getcwd(), representatives)
+
+    # Batch mode writes per-contrast result tables and a combined NES matrix
+    if options.batch == True:
+        contrast_dirs = GSEAlib.contrast_directories(input_ds.columns, os.getcwd())
+        for contrast, contrast_dir in contrast_dirs.items():
+            contrast_stats = pandas.read_csv(os.path.join(
+                contrast_dir, 'set_x_statistic_x_number.tsv'), sep="\t", index_col=0)
+            contrast_stats.insert(0, 'Size', [passing_lengths[set_name]
+                                              for set_name in contrast_stats.index])
+            contrast_stats.to_csv(os.path.join(
+                contrast_dir, 'set_x_statistic_x_number.tsv'), sep="\t")
+        batch_index = dominate.document(
+            title="GSEA Batch Report for Dataset " + os.path.splitext(os.path.basename(options.dataset))[0])
+        batch_index += h1("GSEA Batch Report for Dataset " +
+                          os.path.splitext(os.path.basename(options.dataset))[0])
+        batch_index += ul(
+            li(str(len(contrast_dirs)) + " contrasts were analyzed against " +
+               str(len(passing_sets)) + " gene sets"),
+            li(a("Normalized enrichment of every gene set in every contrast (.tsv file)",
+                 href='set_x_contrast_x_normalized_enrichment.tsv')),
+            li(a("Parameters used for every contrast (.json file)",
+                 href='input/gsea_settings.json'))
+        )
+        batch_index += h3("Contrasts")
+        batch_index += ul([li(a(str(contrast) + " enrichment statistics (.tsv file)", href=os.path.relpath(
+            os.path.join(contrast_dir, 'set_x_statistic_x_number.tsv')))) for contrast, contrast_dir in contrast_dirs.items()])
+        with open('index.html', 'w') as f:
+            f.write(batch_index.render())
+        if options.zip == True:
+            zip_results()
+        return
+
+    write_reports(options, input_ds, phenotypes, labels, genesets, genesets_descr,
+                  passing_lengths, input_length, collapse_length)
+
     # Zip up results
     if options.zip == True:
-        gsea_files = []
-        for folderName, subfolders, filenames in os.walk(os.path.relpath(os.getcwd())):
-            for filename in filenames:
-                # create complete filepath of file in directory
-                filePath = os.path.join(folderName, filename)
-                # Add file to zip
-                gsea_files.append(filePath)
-        with ZipFile("gsea_results.zip", "w") as gsea_zip:
-            for filename in gsea_files:
-                gsea_zip.write(filename)
+        zip_results()
 
 
 if __name__ == '__main__':
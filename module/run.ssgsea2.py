@@ -1,6 +1,5 @@
 import os
 import sys
-import subprocess
 from optparse import OptionParser
 from datetime import datetime
 from zipfile import ZipFile
@@ -69,13 +68,30 @@ def main():
                                     dest="zip", default=False, help="Create ZIP bundle of results.")
     ap.add_argument("--cpu", action="store", dest="cpu",
                                     default=1, type=int, help="Job CPU Count.")
+    ap.add_argument("--engine", action="store", dest="engine", default="julia",
+                    help="Enrichment engine. 'julia' (GSEA.jl command line) or 'python' (in-process, supports 'ks' and 'ksa').")
+    ap.add_argument("--write-tsv", action="store", type=str2bool, nargs='?', const=True, dest="write_tsv",
+                    default=False, help="Also write the input dataset as input/gene_by_sample.tsv when using the python engine.")
+    ap.add_argument("--engine-socket", action="store", dest="engine_socket", default=os.environ.get("GSEA_ENGINE_SOCKET"),
+                    help="Unix socket of a running engine server (run.engine_server.py). Jobs run locally when no server is listening. Only --engine python jobs start warm on the server; julia jobs still launch a new gsea process and pay its start-up and compilation time.")
+    ap.add_argument("--dtype", action="store", dest="dtype", default="float64",
+                    help="Numeric type used to load GCT/TSV datasets, 'float64' or 'float32' (halves memory for very large datasets).")
+    ap.add_argument("--memoize", action="store", type=str2bool, nargs='?', const=True, dest="memoize",
+                    default=False, help="Keep the parsed (and collapsed) dataset and the engine results in a cache ($GSEA_CACHE_DIR, default ~/.cache/gsea2) and reuse them in later runs. The dataset is reused when the dataset file, CHIP file, --collapse and --dtype match. Engine results also need the same gene sets and settings.")
     options = ap.parse_args()
 
     sys.path.insert(1, options.libdir)
     import GSEAlib
 
+    if options.engine == "python" and options.method not in GSEAlib.python_engine_algorithms:
+        sys.exit("The python engine supports the following enrichment algorithms: " +
+                 ", ".join(GSEAlib.python_engine_algorithms) + ". Use '--engine julia' for '" + str(options.method) + "'.")
+
+    if options.dtype not in ["float64", "float32"]:
+        sys.exit("--dtype must be 'float64' or 'float32'.")
+
     # Make a directory to store processed input files
-    os.mkdir("input")
+    os.makedirs("input", exist_ok=True)
 
     # # Generate and set the random seed at the Python level and save it to pass to GSEA
     # if options.seed == "timestamp":
@@ -85,57 +101,15 @@ def main():
     #     options.seed = int(round(float(options.seed)))
     #     random.seed(options.seed)
 
-    # Parse GCT file
-    if options.dataset.split(".")[-1] == "gct":
-        if options.collapse != "none":
-            chip_file = GSEAlib.read_chip(options.chip)
-            input_ds = GSEAlib.collapse_dataset(
-                options.dataset, chip_file, method=options.collapse, drop=True)
-            input_ds['mappings'].to_csv(
-                'input/collapse_dataset_mapping_details.tsv', sep="\t", na_rep="No Symbol Mapping")
-            collapse_length = input_ds['collapse_length']
-        else:
-            input_ds = GSEAlib.read_gct(options.dataset)
-        input_length = input_ds['input_length']
-        input_ds = input_ds['data']
-    elif options.dataset.split(".")[-1] == "rnk":
-        input_ds = pandas.read_csv(
-            options.dataset, sep='\t', index_col=0, skip_blank_lines=True, header=None)
-        if any(input_ds.index.str.startswith('#')):
-            input_ds = input_ds.rename(columns=input_ds.iloc[int(
-                numpy.where(input_ds.index.str.startswith('#'))[0])])
-            input_ds = input_ds[input_ds.index.str.startswith('#') != True]
-        else:
-            input_ds = input_ds.rename(columns={1: "Preranked Metric"})
-        input_ds.index.name = "Name"
-        input_length = len(input_ds.index)
-        if options.collapse != "none":
-            chip_file = GSEAlib.read_chip(options.chip)
-            input_ds = GSEAlib.collapse_dataset(
-                input_ds, chip_file, method=options.collapse, drop=True)
-            input_ds['mappings'].to_csv(
-                'input/collapse_dataset_mapping_details.tsv', sep="\t", na_rep="No Symbol Mapping")
-            input_length = input_ds['input_length']
-            collapse_length = input_ds['collapse_length']
-            input_ds = input_ds['data']
+    # Parse the dataset, or with --memoize reuse the one parsed by an earlier run
+    if options.memoize == True:
+        input_stage = GSEAlib.read_input_dataset(options.dataset, options.collapse, options.chip, options.dtype, options.cpu, preranked=True)
     else:
-        input_ds = pandas.read_csv(
-            options.dataset, sep='\t', index_col=0, skip_blank_lines=True)
-        if "description" in input_ds.columns.str.lower():
-            description_loc = input_ds.columns.str.lower().to_list().index('description')
-            input_ds.drop(
-                input_ds.columns[[description_loc]], axis=1, inplace=True)
-        input_ds.index.name = "Name"
-        input_length = len(input_ds.index)
-        if options.collapse != "none":
-            chip_file = GSEAlib.read_chip(options.chip)
-            input_ds = GSEAlib.collapse_dataset(
-                input_ds, chip_file, method=options.collapse, drop=True)
-            input_ds['mappings'].to_csv(
-                'input/collapse_dataset_mapping_details.tsv', sep="\t", na_rep="No Symbol Mapping")
-            input_length = input_ds['input_length']
-            collapse_length = input_ds['collapse_length']
-            input_ds = input_ds['data']
+        input_stage = GSEAlib.parse_input_dataset(options.dataset, options.collapse, options.chip, options.dtype, options.cpu, preranked=True)
+    input_ds = input_stage['data']
+    if input_stage['mappings'] is not None:
+        input_stage['mappings'].to_csv(
+            'input/collapse_dataset_mapping_details.tsv', sep="\t", na_rep="No Symbol Mapping")
 
     if len(input_ds) < 10000 and options.override == False and options.collapse == "none":
         sys.exit(print("Only ", len(input_ds), "genes were identified in the dataset.\nEither the dataset did not contain all expressed genes, or collapse dataset may need to be run with an appropriate chip file.\n\nIf this was intentional, to bypass this check you can set 'override gene list length validation' (--ogllv) to 'True' but this is not recommended."))
@@ -155,7 +129,9 @@ def main():
     #
     # # Order the dataset using the phenotypes and write out both files
     # input_ds = input_ds.reindex(columns=phenotypes.index)
-    input_ds.to_csv('input/gene_by_sample.tsv', sep="\t")
+    GSEAlib.write_dataset_handoff(input_ds, 'input/gene_by_sample', dtype=options.dtype)
+    if options.engine != "python" or options.write_tsv == True:
+        input_ds.to_csv('input/gene_by_sample.tsv', sep="\t")
     # pandas.DataFrame(phenotypes['Phenotypes']).transpose().to_csv(
     #     'input/target_by_sample.tsv', sep="\t", index=False)
 
@@ -204,27 +180,35 @@ def main():
     with open('input/gsea_settings.json', 'w') as path:
         json.dump(gsea_settings, path,  indent=2)
 
-    # Run GSEA
-    subprocess.check_output(['gsea', 'data-rank',
-                             str(os.getcwd()),
-                             # 'input/target_by_sample.tsv',
-                             'input/gene_by_sample.tsv',
-                             'input/filtered_set_to_genes.json',
-                             '--minimum-set-size', str(options.min),
-                             '--maximum-set-size', str(options.max),
-                             # '--metric', str(options.rank_metric),
-                             '--algorithm', str(options.method),
-                             '--exponent', str(options.exponent),
-                             # '--permutation', str(options.perm),
-                             # '--number-of-permutations', str(options.nperm),
-                             # '--random-seed', str(options.seed),
-                             # '--number-of-sets-to-plot', str(options.nplot),
-                             # '--feature-name', 'Features',
-                             # '--score-name', str(options.rank_metric),
-                             # '--low-text', str(labels[1]),
-                             # '--high-text', str(labels[0]),
-                             # '--write-set-x-index-x-enrichment-tsv'
-                            ])
+    # Run GSEA, on the warm engine server when one is listening
+    if options.engine == "python":
+        engine_job = GSEAlib.engine_job(
+            'data-rank', "python", os.getcwd(), dataset='input/gene_by_sample',
+            gene_sets=passing_sets, settings=gsea_settings, cpu=options.cpu)
+    else:
+        gsea_command = ['gsea', 'data-rank',
+                        str(os.getcwd()),
+                        # 'input/target_by_sample.tsv',
+                        'input/gene_by_sample.tsv',
+                        'input/filtered_set_to_genes.json',
+                        '--minimum-set-size', str(options.min),
+                        '--maximum-set-size', str(options.max),
+                        # '--metric', str(options.rank_metric),
+                        '--algorithm', str(options.method),
+                        '--exponent', str(options.exponent),
+                        # '--permutation', str(options.perm),
+                        # '--number-of-permutations', str(options.nperm),
+                        # '--random-seed', str(options.seed),
+                        # '--number-of-sets-to-plot', str(options.nplot),
+                        # '--feature-name', 'Features',
+                        # '--score-name', str(options.rank_metric),
+                        # '--low-text', str(labels[1]),
+                        # '--high-text', str(labels[0]),
+                        # '--write-set-x-index-x-enrichment-tsv'
+                        ]
+        engine_job = GSEAlib.engine_job(
+            'data-rank', "julia", os.getcwd(), arguments=gsea_command, cpu=options.cpu)
+    GSEAlib.run_engine_job(engine_job, options.engine_socket, memoize=options.memoize)
 
     # Not Processing Results into figures for ssGSEA (yet?)
 
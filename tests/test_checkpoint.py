@@ -0,0 +1,83 @@
+import os
+import sys
+
+import numpy
+import pandas
+from scipy import sparse
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+def example_inputs():
+    rng = numpy.random.default_rng(0)
+    dataset = pandas.DataFrame(rng.normal(size=(40, 12)), index=pandas.Index(["G" + str(row) for row in range(40)], name="Name"),
+                               columns=["S" + str(column) for column in range(12)])
+    membership = sparse.csr_matrix((numpy.ones(9), [1, 4, 8, 20, 0, 2, 3, 30, 39], [0, 4, 9]), shape=(2, 40))
+    settings = {'number_of_permutations': 45, 'random_seed': 3, 'metric': "signal-to-noise-ratio",
+                'algorithm': "ks", 'exponent': 1.0}
+    return dataset, numpy.arange(12) < 6, membership, settings
+
+
+# Count the labelings scored, to tell resumed blocks from recomputed ones
+def counting_chunks(monkeypatch):
+    scored = []
+    permutation_chunk = GSEAlib._permutation_chunk
+
+    def chunk(labels):
+        scored.append(len(labels))
+        return permutation_chunk(labels)
+    monkeypatch.setattr(GSEAlib, "_permutation_chunk", chunk)
+    return scored
+
+
+# A run resumed from a partial checkpoint scores only the missing blocks and
+# returns the same null as an uninterrupted run; a checkpoint left by other
+# inputs is discarded
+def test_resume_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(GSEAlib, "permutation_block_size", 10)
+    dataset, class1, membership, settings = example_inputs()
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    uninterrupted = GSEAlib.phenotype_permutation_null(dataset.values, class1, membership, settings)
+    assert uninterrupted.shape == (2, 45)
+    checkpointed = GSEAlib.phenotype_permutation_null(dataset.values, class1, membership, settings, checkpoint_dir=checkpoint_dir)
+    assert numpy.array_equal(checkpointed, uninterrupted)
+    assert sorted(name for name in os.listdir(checkpoint_dir) if name.startswith("block_")) == \
+        ["block_" + str(block) + ".npy" for block in range(5)]
+    for block in [3, 4]:
+        os.remove(os.path.join(checkpoint_dir, "block_" + str(block) + ".npy"))
+    scored = counting_chunks(monkeypatch)
+    resumed = GSEAlib.phenotype_permutation_null(dataset.values, class1, membership, settings, checkpoint_dir=checkpoint_dir)
+    assert numpy.array_equal(resumed, uninterrupted)
+    assert sum(scored) == 15
+    del scored[:]
+    reseeded = GSEAlib.phenotype_permutation_null(dataset.values, class1, membership, dict(settings, random_seed=4),
+                                                  checkpoint_dir=checkpoint_dir)
+    assert sum(scored) == 45
+    assert numpy.array_equal(reseeded, GSEAlib.phenotype_permutation_null(
+        dataset.values, class1, membership, dict(settings, random_seed=4)))
+
+
+# Writing the same dataset handoff again keeps its files, so a restarted job
+# resumes the checkpoint keyed on them, while a changed dataset replaces them
+def test_handoff_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(GSEAlib, "permutation_block_size", 10)
+    dataset, class1, membership, settings = example_inputs()
+    prefix = str(tmp_path / "gene_by_sample")
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    GSEAlib.write_dataset_handoff(dataset, prefix)
+    first = GSEAlib.phenotype_permutation_null(prefix, class1, membership, settings, checkpoint_dir=checkpoint_dir)
+    assert numpy.array_equal(first, GSEAlib.phenotype_permutation_null(dataset.values, class1, membership, settings))
+    modified = os.stat(prefix + ".npy").st_mtime_ns
+    GSEAlib.write_dataset_handoff(dataset, prefix)
+    assert os.stat(prefix + ".npy").st_mtime_ns == modified
+    scored = counting_chunks(monkeypatch)
+    assert numpy.array_equal(GSEAlib.phenotype_permutation_null(prefix, class1, membership, settings,
+                                                                checkpoint_dir=checkpoint_dir), first)
+    assert sum(scored) == 0
+    GSEAlib.write_dataset_handoff(dataset, prefix, dtype=numpy.float32)
+    changed = dataset.values.astype(numpy.float32)
+    assert numpy.array_equal(GSEAlib.read_dataset_handoff(prefix).values, changed)
+    assert numpy.array_equal(GSEAlib.phenotype_permutation_null(prefix, class1, membership, settings, checkpoint_dir=checkpoint_dir),
+                             GSEAlib.phenotype_permutation_null(changed, class1, membership, settings))
+    assert sum(scored) == 90
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy
+import pandas
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+# Signed value with the largest magnitude of a column, the first one on ties
+def absmax(column):
+    column = column.dropna()
+    if len(column) == 0:
+        return numpy.nan
+    return column.values[numpy.argmax(numpy.abs(column.values))]
+
+
+def example_dataset():
+    rng = numpy.random.default_rng(0)
+    probes = ["P" + str(number) for number in range(60)]
+    dataset = pandas.DataFrame(rng.integers(-5, 6, size=(60, 5)).astype(float), index=pandas.Index(probes, name="Name"),
+                               columns=["S" + str(number) for number in range(5)])
+    dataset.values[rng.random(dataset.shape) < 0.15] = numpy.nan
+    dataset.loc["P7"] = numpy.nan
+    symbols = rng.choice(["GENE" + str(number) for number in range(15)], 60).astype(object)
+    symbols[[3, 11, 40]] = numpy.nan
+    chip = pandas.DataFrame({"Gene Symbol": symbols, "Gene Title": [symbol + " title" if isinstance(symbol, str) else numpy.nan
+                                                                    for symbol in symbols]}, index=pandas.Index(probes, name="Probe Set ID"))
+    chip = pandas.concat([chip, pandas.DataFrame({"Gene Symbol": ["GENE0"], "Gene Title": ["GENE0 title"]},
+                                                 index=pandas.Index(["P5"], name="Probe Set ID"))])
+    return dataset, chip
+
+
+# Every collapse method matches a pandas groupby of the probes by their gene
+# symbol, serially and in column blocks across threads, with the symbols of
+# duplicated CHIP probes taken from their first row
+def test_collapse_dataset():
+    dataset, chip = example_dataset()
+    symbols = chip[~chip.index.duplicated()]["Gene Symbol"].reindex(dataset.index)
+    grouped = dataset[symbols.notna().values].groupby(symbols.dropna().values)
+    for method in GSEAlib.collapse_methods:
+        if method == "absmax":
+            expected = grouped.agg(absmax)
+        else:
+            expected = grouped.agg(method)
+        for cpu in [1, 3]:
+            collapsed = GSEAlib.collapse_dataset(dataset, chip, method, cpu=cpu)
+            assert list(collapsed['data'].index) == list(expected.index)
+            assert numpy.allclose(collapsed['data'].values, expected.values, equal_nan=True)
+            assert list(collapsed['row_descriptions']) == [gene + " title" for gene in expected.index]
+            assert collapsed['input_length'] == 60
+            assert collapsed['collapse_length'] == len(expected)
+    mappings = collapsed['mappings']
+    unmapped = mappings.loc[mappings.index.isna(), 'Dataset ID(s)'].iloc[0]
+    assert sorted(unmapped.split(",")) == sorted(["P3", "P11", "P40"])
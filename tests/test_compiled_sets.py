@@ -0,0 +1,74 @@
+import json
+import os
+import sys
+
+import numpy
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+def write_databases(folder):
+    gmt = os.path.join(folder, "sets.gmt")
+    with open(gmt, "w") as f:
+        f.write("SET_A\tfirst set\tTP53\tMYC\tEGFR\tMYC\n")
+        f.write("SET_B\tsecond set\tGAPDH\n")
+        f.write("SET_C\t\tBRCA1\tBRCA2\tTP53\tATM\tCHEK2\n")
+    gmx = os.path.join(folder, "sets.gmx")
+    with open(gmx, "w") as f:
+        f.write("SET_D\tSET_E\n")
+        f.write("fourth set\tfifth set\n")
+        f.write("KRAS\tNRAS\n")
+        f.write("HRAS\t\n")
+        f.write("BRAF\t\n")
+    js = os.path.join(folder, "sets.json")
+    with open(js, "w") as f:
+        json.dump({"SET_F": {"geneSymbols": ["CDK4", "CDK6"], "msigdbURL": "url_f"},
+                   "SET_A": {"geneSymbols": ["PTEN"], "msigdbURL": "url_a"}}, f)
+    return [gmt, gmx, js]
+
+
+# The sets and descriptions read through the compiled cache, freshly and from
+# the cache, match the files as written: later files replace sets of the same
+# name and repeated members are dropped
+def test_read_sets_cached(tmp_path):
+    files = write_databases(str(tmp_path))
+    cache_dir = str(tmp_path / "cache")
+    expected = {"SET_A": {"PTEN"}, "SET_B": {"GAPDH"}, "SET_C": {"BRCA1", "BRCA2", "TP53", "ATM", "CHEK2"},
+                "SET_D": {"KRAS", "HRAS", "BRAF"}, "SET_E": {"NRAS"}, "SET_F": {"CDK4", "CDK6"}}
+    descriptions = {"SET_A": "url_a", "SET_B": "second set", "SET_C": "", "SET_D": "fourth set",
+                    "SET_E": "fifth set", "SET_F": "url_f"}
+    for load in range(2):
+        gs_data = GSEAlib.read_sets(files, cache_dir)
+        assert {name: set(members) for name, members in gs_data['genesets'].items()} == expected
+        assert all(len(members) == len(expected[name]) for name, members in gs_data['genesets'].items())
+        assert gs_data['descriptions'] == descriptions
+        assert gs_data['lengths'] == {name: len(members) for name, members in expected.items()}
+        assert len(os.listdir(os.path.join(cache_dir, "sets"))) == 3
+    assert set(GSEAlib.read_sets(files[:1], cache_dir)['genesets']["SET_A"]) == {"TP53", "MYC", "EGFR"}
+
+
+# Compiling and expanding gives back the parsed dicts in their order
+def test_compile_round_trip(tmp_path):
+    for gsdb in write_databases(str(tmp_path)):
+        genesets, genesets_descr = GSEAlib.parse_sets_file(gsdb)
+        expanded, expanded_descr = GSEAlib.expand_sets(GSEAlib.compile_sets(genesets, genesets_descr))
+        assert expanded == genesets
+        assert list(expanded) == list(genesets)
+        assert expanded_descr == {name: str(value) for name, value in genesets_descr.items()}
+
+
+# Pruning counts the entries of every cache folder against one limit and
+# evicts the least recently used ones first
+def test_prune_cache(tmp_path):
+    cache_root = str(tmp_path)
+    entries = []
+    for age, folder in enumerate(["sets", "nulls", "chips", "datasets"]):
+        entry = os.path.join(cache_root, folder, "entry")
+        GSEAlib.store_cache_entry(entry, {'values': numpy.zeros(1000)}, prune=False)
+        os.utime(entry, (1000 + age, 1000 + age))
+        entries.append(entry)
+    size = sum(os.path.getsize(os.path.join(entries[0], name)) for name in os.listdir(entries[0]))
+    GSEAlib.prune_cache(cache_root, max_bytes=2 * size)
+    assert [os.path.isdir(entry) for entry in entries] == [False, False, True, True]
+    assert GSEAlib.load_cache_entry(entries[2], ['values']) is not None
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy
+import pandas
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+# Filtered sets hold exactly the members found in the dataset, in dataset
+# order, as a naive intersection with the dataset's genes would give, and the
+# membership matrix flags the first row of each of those genes
+def test_filter_sets():
+    rng = numpy.random.default_rng(0)
+    universe = ["G" + str(number) for number in range(300)]
+    dataset_index = pandas.Index(list(rng.choice(universe[:200], 150, replace=False)) + ["G5", "G5"], name="Name")
+    genesets = {"SET_" + str(number): list(rng.choice(universe, rng.integers(0, 40), replace=False))
+                for number in range(50)}
+    genesets["EMPTY"] = []
+    genesets["MISSING"] = ["NOT_A_GENE", "G299"]
+    filtered = GSEAlib.filter_sets(genesets, dataset_index)
+    assert list(filtered['genesets']) == list(genesets)
+    positions = {}
+    for position, gene in enumerate(dataset_index):
+        positions.setdefault(gene, position)
+    for row, (name, members) in enumerate(genesets.items()):
+        expected = sorted(set(members) & set(dataset_index), key=positions.get)
+        assert filtered['genesets'][name] == expected
+        assert filtered['lengths'][name] == len(expected)
+        columns = filtered['membership'][row].indices
+        assert list(columns) == [positions[gene] for gene in expected]
+    assert filtered['lengths']["MISSING"] == 0
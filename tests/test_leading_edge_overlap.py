@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy
+import pandas
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+def example_gene_lists(seed=0, n_lists=30):
+    rng = numpy.random.default_rng(seed)
+    genes = ["G" + str(number) for number in range(200)]
+    gene_lists = [list(rng.choice(genes, rng.integers(1, 90), replace=False)) for _ in range(n_lists)]
+    gene_lists.append(list(gene_lists[0]))
+    return gene_lists
+
+
+# Packed pairwise intersections and Jaccard indices match Python set
+# operations, whole and in blocks of rows
+def test_bitset_overlap(monkeypatch):
+    gene_lists = example_gene_lists()
+    words, genes = GSEAlib.pack_gene_lists(gene_lists)
+    assert sorted(genes) == sorted(set(gene for genes in gene_lists for gene in genes))
+    expected_intersections = numpy.array([[len(set(first) & set(second)) for second in gene_lists] for first in gene_lists])
+    expected_jaccard = numpy.array([[len(set(first) & set(second)) / len(set(first) | set(second))
+                                     for second in gene_lists] for first in gene_lists])
+    for block_words in [GSEAlib.overlap_block_words, 4 * words.shape[1] * len(gene_lists)]:
+        monkeypatch.setattr(GSEAlib, "overlap_block_words", block_words)
+        intersections, jaccard = GSEAlib.bitset_overlap(words)
+        assert numpy.array_equal(intersections, expected_intersections)
+        assert numpy.allclose(jaccard, expected_jaccard)
+    assert list(GSEAlib.bit_counts(words)) == [len(genes) for genes in gene_lists]
+
+
+# Sets with the same leading edge end up in one cluster, whose summary shares
+# their core genes (those in at least half of the members, most shared first)
+# and picks the member with the largest |NES|
+def test_write_leading_edge_overlap(tmp_path):
+    cores = ["A,B,C,D", "A,B,C,D", "X,Y,Z", "X,Y,Z,W", "Q"]
+    names = ["S" + str(number) for number in range(5)]
+    stats = pandas.DataFrame({'Normalized Enrichment': [1.5, -2.0, 1.8, 1.2, 1.0],
+                              'Adjusted P-Value': [0.01, 0.02, 0.03, 0.04, 0.5]}, index=pandas.Index(names, name="Set"))
+    leading_edge = pandas.DataFrame({'Core Enrichment': cores}, index=pandas.Index(names, name="Set"))
+    summary = GSEAlib.write_leading_edge_overlap(stats, leading_edge, str(tmp_path))
+    assert sorted(summary['Gene Sets']) == ["S1,S0", "S2,S3"]
+    clusters = summary.set_index('Representative')
+    assert clusters.loc["S1", 'Shared Core Genes'] == "A,B,C,D"
+    assert clusters.loc["S2", 'Shared Core Genes'] == "X,Y,Z,W"
+    assert numpy.isclose(clusters.loc["S2", 'Mean Jaccard'], 0.75)
+    jaccard = pandas.read_csv(str(tmp_path / "set_x_set_x_leading_edge_jaccard.tsv"), sep="\t", index_col=0)
+    assert sorted(jaccard.index) == ["S0", "S1", "S2", "S3"]
+    assert numpy.isclose(jaccard.loc["S2", "S3"], 0.75)
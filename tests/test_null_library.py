@@ -0,0 +1,69 @@
+import os
+import sys
+
+import numpy
+from scipy import sparse
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+def example_membership(n_genes=120):
+    sets = [[1, 5, 9], [0, 2, 40, 41, 80], [7, 8, 100], [3, 60, 70, 90, 110, 119]]
+    return sparse.csr_matrix((numpy.ones(sum(map(len, sets))), numpy.concatenate(sets),
+                              numpy.cumsum([0] + [len(members) for members in sets])), shape=(len(sets), n_genes))
+
+
+# Count the random sets drawn, to tell library nulls from fresh ones
+def counting_draws(monkeypatch):
+    drawn = []
+    sample_positions = GSEAlib._sample_positions
+
+    def sample(rng, n_genes, size, nperm, selected=None):
+        drawn.append(nperm)
+        return sample_positions(rng, n_genes, size, nperm, selected)
+    monkeypatch.setattr(GSEAlib, "_sample_positions", sample)
+    return drawn
+
+
+# Nulls stored in the library, and reloaded from it, equal fresh nulls; a
+# later list of the same length reuses the stored sizes with uniform weights
+# but not with weights of its own
+def test_null_library(tmp_path, monkeypatch):
+    library = GSEAlib.null_library({'null_library': True}, str(tmp_path))
+    assert GSEAlib.null_library({}, str(tmp_path)) is None
+    membership = example_membership()
+    rng = numpy.random.default_rng(0)
+    for weights in [numpy.ones(120), numpy.abs(rng.normal(size=120))]:
+        fresh = GSEAlib.set_permutation_null(membership, weights, "ks", 200, 9)
+        drawn = counting_draws(monkeypatch)
+        stored = GSEAlib.set_permutation_null(membership, weights, "ks", 200, 9, library)
+        assert sum(drawn) == 600
+        del drawn[:]
+        reused = GSEAlib.set_permutation_null(membership, weights, "ks", 200, 9, library)
+        assert sum(drawn) == 0
+        assert numpy.array_equal(stored, fresh) and numpy.array_equal(reused, fresh)
+        monkeypatch.undo()
+    drawn = counting_draws(monkeypatch)
+    other_membership = example_membership()[[1, 3]]
+    assert numpy.array_equal(GSEAlib.set_permutation_null(other_membership, numpy.full(120, 0.5), "ks", 200, 9, library),
+                             GSEAlib.set_permutation_null(other_membership, numpy.full(120, 0.5), "ks", 200, 9))
+    assert sum(drawn) == 400
+    del drawn[:]
+    weights = numpy.abs(rng.normal(size=120))
+    assert numpy.array_equal(GSEAlib.set_permutation_null(membership, weights, "ks", 200, 9, library),
+                             GSEAlib.set_permutation_null(membership, weights, "ks", 200, 9))
+    assert sum(drawn) == 1200
+
+
+# Several ranked lists sharing the library each get the null they would get
+# on their own
+def test_null_library_lists(tmp_path):
+    library = GSEAlib.null_library({'null_library': True}, str(tmp_path))
+    rng = numpy.random.default_rng(1)
+    weights = numpy.vstack([numpy.ones(120), numpy.abs(rng.normal(size=120)), numpy.ones(120)])
+    sizes = numpy.array([3, 5, 6])
+    for _ in range(2):
+        nulls = GSEAlib.size_permutation_nulls(sizes, weights, "ksa", 100, 4, library)
+        for row, list_weights in enumerate(weights):
+            assert numpy.array_equal(nulls[row], GSEAlib.size_permutation_null(sizes, list_weights, "ksa", 100, 4))
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy
+from scipy import sparse
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+# Class 1 vs class 0 metric of one gene from its two groups of values
+def brute_force_metric(class1, class0, metric):
+    mean1, mean0 = numpy.mean(class1), numpy.mean(class0)
+    if metric == "mean-difference":
+        return mean1 - mean0
+    sd1 = max(numpy.std(class1, ddof=1), 0.2 * abs(mean1) if mean1 != 0 else 0.2)
+    sd0 = max(numpy.std(class0, ddof=1), 0.2 * abs(mean0) if mean0 != 0 else 0.2)
+    if metric == "signal-to-noise-ratio":
+        return (mean1 - mean0) / (sd1 + sd0)
+    return (mean1 - mean0) / numpy.sqrt(sd1 ** 2 / len(class1) + sd0 ** 2 / len(class0))
+
+
+# 'ks' enrichment score of one set from the explicit running sum
+def brute_force_ks(positions, weights):
+    hits = set(int(position) for position in positions)
+    total = sum(weights[position] for position in hits)
+    running, value = [], 0.0
+    for position in range(len(weights)):
+        value += weights[position] / total if position in hits else -1 / (len(weights) - len(hits))
+        running.append(value)
+    peak, trough = max(max(running), 0), min(min(running), 0)
+    return peak if peak >= -trough else trough
+
+
+def example_dataset(seed=0, n_genes=60, n_samples=10):
+    rng = numpy.random.default_rng(seed)
+    data = rng.normal(5, 2, size=(n_genes, n_samples))
+    data[0] = 0  # Both class means 0: the floor is 0.2
+    data[1] = 3  # No spread: the floor is 0.2 * |mean|
+    return data
+
+
+# Every labeling's column matches the metric computed gene by gene, including
+# the standard deviation floor
+def test_rank_metric_matrix():
+    data = example_dataset()
+    labels = GSEAlib.permuted_labelings(numpy.arange(10) < 4, 25, 3)
+    for metric in GSEAlib.python_engine_metrics:
+        metrics = GSEAlib.rank_metric_matrix(data, labels, metric)
+        assert metrics.shape == (60, 25)
+        for column, labeling in enumerate(labels):
+            expected = [brute_force_metric(row[labeling], row[~labeling], metric) for row in data]
+            assert numpy.allclose(metrics[:, column], expected)
+
+
+# Labelings are distinct, keep the class sizes, and are all enumerated when
+# there are at most nperm of them
+def test_permuted_labelings():
+    class1 = numpy.arange(8) < 3
+    labels = GSEAlib.permuted_labelings(class1, 40, 1)
+    assert len(labels) == 40 and numpy.all(labels.sum(axis=1) == 3)
+    assert len(set(map(bytes, labels))) == 40
+    labels = GSEAlib.permuted_labelings(class1, 1000, 1)
+    assert len(labels) == GSEAlib.distinct_labelings(class1) == 56
+    assert len(set(map(bytes, labels))) == 56
+
+
+# Each null column is the score of every set against the list ranked by that
+# labeling's metric, serially and across a process pool
+def test_phenotype_permutation_null():
+    data = example_dataset(1)
+    class1 = numpy.arange(10) < 5
+    sets = [numpy.array([2, 5, 9, 30]), numpy.array([0, 1, 7, 11, 40, 59]), numpy.array([3, 4])]
+    membership = sparse.csr_matrix((numpy.ones(12), numpy.concatenate(sets), [0, 4, 10, 12]), shape=(3, 60))
+    settings = {'number_of_permutations': 30, 'random_seed': 5, 'metric': "signal-to-noise-ratio",
+                'algorithm': "ks", 'exponent': 1.0}
+    null = GSEAlib.phenotype_permutation_null(data, class1, membership, settings)
+    labels = GSEAlib.permuted_labelings(class1, 30, 5)
+    for column, labeling in enumerate(labels):
+        metric = numpy.array([brute_force_metric(row[labeling], row[~labeling], settings['metric']) for row in data])
+        order = list(numpy.argsort(-metric, kind='mergesort'))
+        weights = numpy.abs(metric[order])
+        expected = [brute_force_ks([order.index(gene) for gene in members], weights) for members in sets]
+        assert numpy.allclose(null[:, column], expected)
+    assert numpy.array_equal(GSEAlib.phenotype_permutation_null(data, class1, membership, settings, cpu=2), null)
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import numpy
+import pandas
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+def write_matrix(path, n_rows, header_rows, with_description):
+    rng = numpy.random.default_rng(0)
+    values = rng.normal(size=(n_rows, 4)).round(6).astype(str).astype(object)
+    values[3, 1] = "NA"
+    values[8, 2] = ""
+    with open(path, "w") as f:
+        f.writelines(header_rows)
+        f.write("\t".join(["Name"] + (["Description"] if with_description else []) + ["S1", "S2", "S3", "S4"]) + "\n")
+        for row in range(n_rows):
+            f.write("\t".join(["GENE" + str(row)] + (["na"] if with_description else []) + list(values[row])) + "\n")
+
+
+def check_matrix(dataset, path, skiprows, dtype):
+    expected = pandas.read_csv(path, sep="\t", skiprows=skiprows, index_col=0)
+    expected = expected.drop(columns=[column for column in expected.columns if column == "Description"])
+    assert list(dataset.index) == list(expected.index)
+    assert list(dataset.columns) == list(expected.columns)
+    assert dataset.values.dtype == dtype
+    assert numpy.array_equal(numpy.isnan(dataset.values), numpy.isnan(expected.values))
+    assert numpy.allclose(dataset.values, expected.values.astype(dtype), equal_nan=True)
+
+
+# GCT and TSV files read in several chunks, with a correct or a wrong row count
+# in the GCT header and in either dtype, match pandas.read_csv, missing values
+# included
+def test_read_matrix(tmp_path, monkeypatch):
+    monkeypatch.setattr(GSEAlib, "matrix_chunk_rows", 7)
+    gct, short_gct, tsv = [str(tmp_path / name) for name in ["ds.gct", "short.gct", "ds.tsv"]]
+    write_matrix(gct, 30, ["#1.2\n", "30\t4\n"], True)
+    write_matrix(short_gct, 30, ["#1.2\n", "12\t4\n"], True)
+    write_matrix(tsv, 30, [], False)
+    for engine in ["auto", "pandas"]:
+        for dtype in [numpy.float64, numpy.float32]:
+            for path in [gct, short_gct]:
+                gct_data = GSEAlib.read_gct(path, dtype=dtype, engine=engine)
+                check_matrix(gct_data['data'], path, 2, dtype)
+                assert list(gct_data['row_descriptions']) == ["na"] * 30
+                assert gct_data['input_length'] == 30
+            tsv_data = GSEAlib.read_tsv(tsv, dtype=dtype, engine=engine)
+            check_matrix(tsv_data['data'], tsv, 0, dtype)
+            assert tsv_data['row_descriptions'] is None
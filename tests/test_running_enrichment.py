@@ -0,0 +1,64 @@
+import os
+import sys
+
+import numpy
+import pandas
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+# Explicit running sum of one set over the whole ranked list
+def brute_force_running(hits, weights):
+    total = sum(weights[position] for position in hits)
+    running, value = [], 0.0
+    for position in range(len(weights)):
+        value += weights[position] / total if position in hits else -1 / (len(weights) - len(hits))
+        running.append(value)
+    return numpy.array(running)
+
+
+def example_ranking():
+    rng = numpy.random.default_rng(0)
+    metric = numpy.sort(rng.normal(size=150))[::-1]
+    ranked_metric = pandas.Series(metric, index=pandas.Index(["G" + str(row) for row in range(150)], name="Name"))
+    genesets = {"TOP": ["G" + str(row) for row in [0, 2, 3, 7, 60, 120]],
+                "BOTTOM": ["G" + str(row) for row in [10, 100, 140, 145, 149]],
+                "FIRST": ["G0"], "LAST": ["G149"]}
+    for number in range(20):
+        genesets["RANDOM_" + str(number)] = ["G" + str(row) for row in rng.choice(150, rng.integers(2, 30), replace=False)]
+    return ranked_metric, genesets
+
+
+# The saved running scores at the hits, the peak of every set and its leading
+# edge statistics match the explicit running sum over the whole list
+def test_write_running_enrichment(tmp_path):
+    ranked_metric, genesets = example_ranking()
+    weights = numpy.abs(ranked_metric.values)
+    GSEAlib.write_ranked_running_enrichment(ranked_metric, genesets, 1.0, str(tmp_path))
+    running = GSEAlib.read_running_enrichment(str(tmp_path / "set_x_running_enrichment.npz"))
+    leading_edge = pandas.read_csv(str(tmp_path / "set_x_leading_edge.tsv"), sep="\t", index_col=0, keep_default_na=False)
+    assert list(running['sets']) == list(genesets) == list(leading_edge.index)
+    for name, members in genesets.items():
+        row = running['rows'][name]
+        hits = slice(running['indptr'][row], running['indptr'][row + 1])
+        positions = sorted(ranked_metric.index.get_loc(gene) for gene in members)
+        assert list(running['positions'][hits]) == positions
+        full = brute_force_running(set(positions), weights)
+        assert numpy.allclose(running['running_es'][hits], full[positions])
+        peak = int(numpy.argmax(full)) if full.max() >= -min(full.min(), 0) else int(numpy.argmin(full))
+        assert running['peak'][row] == peak
+        assert numpy.isclose(running['peak_es'][row], full[peak])
+        if full[peak] >= 0:
+            core = [position for position in positions if position <= peak]
+            list_size = peak + 1
+        else:
+            core = [position for position in positions if position > peak]
+            list_size = 150 - peak - 1
+        assert leading_edge.loc[name, 'Core Enrichment'] == ",".join(ranked_metric.index[core])
+        assert leading_edge.loc[name, 'Leading Edge Size'] == len(core)
+        assert numpy.isclose(leading_edge.loc[name, 'Tag %'], 100 * len(core) / len(positions))
+        assert numpy.isclose(leading_edge.loc[name, 'List %'], 100 * list_size / 150)
+        structured = GSEAlib.get_structured_leading_edge(running, name)[1]
+        from_list = GSEAlib.get_running_leading_edge(ranked_metric.to_frame("Metric"), members, 1.0)[1]
+        assert set(structured.split(",")) - {""} == set(from_list.split(",")) - {""} == set(ranked_metric.index[core])
@@ -0,0 +1,75 @@
+import os
+import sys
+
+import numpy
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+# draw_null handing out the successive columns of a fixed null after the
+# first ones, or a separate enumerated null when every labeling is asked for
+def column_draws(null, first, enumerated=None, labelings=None):
+    drawn = [first]
+
+    def draw_null(rows, seed, nperm, round):
+        if labelings is not None and nperm == labelings:
+            return enumerated[rows]
+        round_null = null[rows, drawn[0]:drawn[0] + nperm]
+        drawn[0] += nperm
+        return round_null
+    return draw_null
+
+
+def example_scores(seed=0, n_sets=40, n_columns=1280):
+    rng = numpy.random.default_rng(seed)
+    null = rng.normal(size=(n_sets, n_columns))
+    scores = rng.normal(0, 2, size=n_sets)
+    scores[:3] = [4.0, -4.5, 0.05]
+    return scores, null
+
+
+def check_summary(summary, row, expected):
+    for key in ['count', 'exceeding']:
+        assert summary[key][row] == expected[key][0]
+    assert numpy.isclose(summary['sum'][row], expected['sum'][0])
+
+
+# Each set's summary is the summary of the columns it drew: the total doubles
+# every round until it has seen number_of_exceedances more extreme scores or
+# reaches the maximum
+def test_sequential_null_summary():
+    scores, null = example_scores()
+    settings = {'maximum_number_of_permutations': 1280, 'number_of_exceedances': 10, 'random_seed': 1}
+    draw_null = column_draws(null, 20)
+    summary = GSEAlib.sequential_null_summary(scores, null[:, :20], draw_null, settings)
+    for row in range(len(scores)):
+        permutations = 20
+        while GSEAlib.null_summary(scores[[row]], null[[row], :permutations])['exceeding'][0] < 10 and permutations < 1280:
+            permutations = min(2 * permutations, 1280)
+        assert summary['permutations'][row] == permutations
+        check_summary(summary, row, GSEAlib.null_summary(scores[[row]], null[[row], :permutations]))
+    assert summary['permutations'][0] == summary['permutations'][1] == 1280
+    assert summary['permutations'][2] == 20
+
+
+# A round that would reach the number of distinct labelings enumerates them
+# all, and that exact null replaces the random draws of the sets still active
+def test_sequential_labeling_cap():
+    scores, null = example_scores(1)
+    enumerated = numpy.random.default_rng(2).normal(size=(len(scores), 70))
+    settings = {'maximum_number_of_permutations': 1000, 'number_of_exceedances': 10, 'random_seed': 1,
+                'number_of_labelings': 70}
+    draw_null = column_draws(null, 20, enumerated, 70)
+    summary = GSEAlib.sequential_null_summary(scores, null[:, :20], draw_null, settings)
+    for row in range(len(scores)):
+        permutations = 20
+        while GSEAlib.null_summary(scores[[row]], null[[row], :permutations])['exceeding'][0] < 10 and permutations < 40:
+            permutations = 2 * permutations
+        if GSEAlib.null_summary(scores[[row]], null[[row], :permutations])['exceeding'][0] < 10:
+            assert summary['permutations'][row] == 70
+            check_summary(summary, row, GSEAlib.null_summary(scores[[row]], enumerated[[row]]))
+        else:
+            assert summary['permutations'][row] == permutations
+            check_summary(summary, row, GSEAlib.null_summary(scores[[row]], null[[row], :permutations]))
+    assert summary['permutations'][0] == 70
@@ -0,0 +1,101 @@
+import os
+import sys
+from collections import Counter
+
+import numpy
+from scipy import sparse
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+# Enrichment score of one set from the explicit running sum over the whole
+# ranked list: 'ks' is the largest deviation from zero, 'ksa' the mean
+def brute_force_score(positions, weights, algorithm):
+    hits = set(int(position) for position in positions)
+    total = sum(weights[position] for position in hits)
+    running, value = [], 0.0
+    for position in range(len(weights)):
+        if position in hits:
+            value += weights[position] / total if total > 0 else 1 / len(hits)
+        else:
+            value -= 1 / (len(weights) - len(hits))
+        running.append(value)
+    if algorithm == "ksa":
+        return sum(running) / len(running)
+    peak, trough = max(max(running), 0), min(min(running), 0)
+    return peak if peak >= -trough else trough
+
+
+# Scores agree with the brute force ones; a 'ks' set whose peak and trough
+# tie may take either sign
+def assert_scores(scores, expected):
+    expected = numpy.asarray(expected)
+    assert numpy.allclose(numpy.abs(scores), numpy.abs(expected))
+    tied = numpy.isclose(scores, -expected)
+    assert numpy.allclose(scores[~tied], expected[~tied])
+
+
+def random_sets(rng, n_genes, sizes):
+    return [numpy.sort(rng.choice(n_genes, size, replace=False)) for size in sizes]
+
+
+# Scoring at the hits matches the full running sum for both algorithms,
+# including uniform weights and sets at the very top or bottom of the list
+def test_enrichment_at_hits():
+    rng = numpy.random.default_rng(0)
+    weights = numpy.abs(rng.normal(size=200))
+    for algorithm in GSEAlib.python_engine_algorithms:
+        for size in [1, 5, 30]:
+            positions = numpy.vstack(random_sets(rng, 200, [size] * 20) +
+                                     [numpy.arange(size), numpy.arange(200 - size, 200)])
+            for set_weights in [weights, numpy.ones(200)]:
+                scores = GSEAlib._enrichment_at_hits(positions, set_weights, algorithm)
+                expected = [brute_force_score(row, set_weights, algorithm) for row in positions]
+                assert_scores(scores, expected)
+
+
+# score_gene_sets groups sets of mixed sizes and maps genes through gene_ranks
+def test_score_gene_sets():
+    rng = numpy.random.default_rng(1)
+    weights = numpy.abs(rng.normal(size=100))
+    sets = random_sets(rng, 100, [3, 10, 3, 25, 10, 1])
+    membership = sparse.csr_matrix((numpy.ones(sum(map(len, sets))), numpy.concatenate(sets),
+                                    numpy.cumsum([0] + [len(members) for members in sets])), shape=(len(sets), 100))
+    gene_ranks = rng.permutation(100)
+    for algorithm in GSEAlib.python_engine_algorithms:
+        scores = GSEAlib.score_gene_sets(membership, weights, algorithm)
+        assert_scores(scores, [brute_force_score(members, weights, algorithm) for members in sets])
+        scores = GSEAlib.score_gene_sets(membership, weights, algorithm, gene_ranks)
+        assert_scores(scores, [brute_force_score(gene_ranks[members], weights, algorithm) for members in sets])
+
+
+# Sampled positions are sorted, distinct and in range, and every subset of a
+# small list is drawn about equally often
+def test_sample_positions():
+    rng = numpy.random.default_rng(2)
+    positions = GSEAlib._sample_positions(rng, 6, 3, 40000)
+    assert positions.min() >= 0 and positions.max() < 6
+    assert numpy.all(numpy.diff(positions, axis=1) > 0)
+    counts = Counter(map(tuple, positions.tolist()))
+    assert len(counts) == 20
+    assert all(abs(count - 2000) < 250 for count in counts.values())
+
+
+# The set permutation null of a set is the score of random sets of its size:
+# it matches brute force scoring of the same draws, is shared by sets of equal
+# size and does not depend on the other sizes in the run
+def test_set_permutation_null():
+    rng = numpy.random.default_rng(3)
+    weights = numpy.sort(numpy.abs(rng.normal(size=80)))[::-1]
+    sets = random_sets(rng, 80, [4, 9, 4, 15])
+    membership = sparse.csr_matrix((numpy.ones(sum(map(len, sets))), numpy.concatenate(sets),
+                                    numpy.cumsum([0] + [len(members) for members in sets])), shape=(len(sets), 80))
+    null = GSEAlib.set_permutation_null(membership, weights, "ks", 50, 11)
+    assert null.shape == (4, 50)
+    assert numpy.array_equal(null[0], null[2])
+    for row, size in [(0, 4), (1, 9), (3, 15)]:
+        draws = GSEAlib._sample_positions(numpy.random.default_rng([11, size]), 80, size, 50)
+        assert_scores(null[row], [brute_force_score(positions, weights, "ks") for positions in draws])
+    alone = GSEAlib.size_permutation_null(numpy.array([9]), weights, "ks", 50, 11)
+    assert numpy.array_equal(alone[0], null[1])
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy
+from scipy.stats import genpareto
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "module"))
+import GSEAlib
+
+
+# A score beyond every null score of an exponential null gets close to the
+# exponential survival, far below 1 / nperm
+def test_exponential_tail():
+    null = numpy.random.default_rng(0).exponential(1.0, 20000)
+    tail, fit_flags = GSEAlib.tail_pvalues(numpy.array([9.0]), null[None, :], numpy.array([1 / 20001]))
+    assert fit_flags[0] == "good"
+    assert numpy.exp(-9.0) / 3 < tail[0] < numpy.exp(-9.0) * 3
+
+
+# A generalized Pareto null with a negative shape keeps its bounded tail:
+# scores inside it follow the known survival
+def test_bounded_tail():
+    null = genpareto.rvs(-0.3, size=20000, random_state=1)
+    tail, fit_flags = GSEAlib.tail_pvalues(numpy.array([3.0]), null[None, :], numpy.array([1 / 20001]))
+    assert fit_flags[0] == "good"
+    assert genpareto.sf(3.0, -0.3) / 3 < tail[0] < genpareto.sf(3.0, -0.3) * 3
+
+
+# Scores past the end point of a bounded fit get the exponential tail with the
+# same mean excess, positive and decreasing with the score
+def test_beyond_endpoint():
+    null = genpareto.rvs(-0.3, size=20000, random_state=1)
+    scores = numpy.array([3.5, 5.0])
+    tail, fit_flags = GSEAlib.tail_pvalues(scores, numpy.vstack([null, null]), numpy.full(2, 1 / 20001))
+    assert list(fit_flags) == ["beyond-endpoint", "beyond-endpoint"]
+    threshold, fraction, shape, scale, good, mean_excess = GSEAlib.fit_null_tail(null)
+    assert numpy.allclose(tail, fraction * numpy.exp(-(scores - threshold) / mean_excess))
+    assert 0 < tail[1] < tail[0]
+
+
+# Sets whose null enumerated every labeling keep their exact p-value
+def test_exact_pvalues_kept():
+    null = numpy.random.default_rng(0).exponential(1.0, 20000)
+    tail, fit_flags = GSEAlib.tail_pvalues(numpy.array([9.0, 9.0]), numpy.vstack([null, null]),
+                                           numpy.full(2, 1 / 20001), numpy.array([True, False]))
+    assert list(fit_flags) == ["exact", "good"]
+    assert tail[0] == 1 / 20001
+    assert numpy.exp(-9.0) / 3 < tail[1] < numpy.exp(-9.0) * 3
+
+
+# Sets with enough more extreme null scores keep their empirical p-value
+def test_empirical_pvalues_kept():
+    null = numpy.random.default_rng(2).exponential(1.0, 20000)
+    tail, fit_flags = GSEAlib.tail_pvalues(numpy.array([1.0, -0.5]), numpy.vstack([null, -null]), numpy.array([0.37, 0.6]))
+    assert list(fit_flags) == ["empirical", "empirical"]
+    assert list(tail) == [0.37, 0.6]